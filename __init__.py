@@ -49,11 +49,20 @@ __contributors__ = {}
 # This is a url where the most recent plugin package can be downloaded.
 __url__ = '' # 'http://supybot.com/Members/yourname/Meeting/download'
 
+import sys
 import config
 import plugin
-reload(plugin) # In case we're being reloaded.
+# the plugin imports its other modules itself, those only some commands need
+# when they are first used; a reload forgets them all, so they are imported
+# afresh along with the plugin
+if '_loaded' in globals():
+    for name in ['tally', 'events', 'active', 'status', 'announce', 'minutes',
+                 'flood', 'weights', 'fsck']:
+        sys.modules.pop('%s.%s' % (__name__, name), None)
+    reload(plugin) # In case we're being reloaded.
 # Add more reloads here if you add third-party modules and want them to be
 # reloaded when this plugin is reloaded.  Don't forget to import them as well!
+_loaded = True
 
 if world.testing:
     import test
@@ -0,0 +1,143 @@
+###
+# Copyright (c) 2013, Arik Baratz
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+###
+
+"""
+The cross-channel index of meetings in progress and open votes, kept in a
+single file so that it can be read without opening any channel database.
+"""
+
+import os
+import json
+import sqlite3
+import threading
+
+def entry_from_state(state):
+    """returns the index entry for a channel's state, or None if the channel
+    has no meeting that is prepared or in progress"""
+    meeting_id = state['currents']['meeting']
+    if meeting_id is None:
+        return None
+    meeting = state['meetings'][str(meeting_id)]
+    if meeting['end_time']:
+        return None
+
+    vote = None
+    motion_item = state['currents']['motion']
+    motions = meeting['motions']
+    # the current motion is only reset when the meeting starts, so a meeting
+    # that is only prepared can still point into the previous one
+    if (motion_item is not None and motion_item <= len(motions)
+        and motions[motion_item - 1]['vote_open']):
+        vote = motion_item
+    return {'meeting_id': meeting_id, 'name': meeting['name'],
+            'started': meeting['start_time'] is not None, 'vote': vote}
+
+def entry_from_db(filename):
+    """returns the index entry for a channel database, reading only the
+    current meeting and motion"""
+    db = sqlite3.connect(filename)
+    try:
+        cursor = db.cursor()
+        cursor.execute("""SELECT meeting.id, meeting.name, meeting.start_time,
+                                 motion.item_order
+                          FROM currents
+                          JOIN meeting
+                          ON meeting.id=currents.value
+                          LEFT JOIN currents AS current_motion
+                          ON current_motion.name='motion'
+                          LEFT JOIN motion
+                          ON motion.meeting_id=meeting.id
+                          AND motion.item_order=current_motion.value
+                          AND motion.vote_open=1
+                          WHERE currents.name='meeting'
+                          AND meeting.end_time IS NULL""")
+        results = cursor.fetchall()
+    finally:
+        db.close()
+    if len(results) == 0:
+        return None
+    meeting_id, name, start_time, vote = results[0]
+    return {'meeting_id': meeting_id, 'name': name,
+            'started': start_time is not None, 'vote': vote}
+
+class ActiveIndex(object):
+    """the meetings in progress on every channel and network"""
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._entries = {}
+        if os.path.exists(filename):
+            try:
+                with open(filename) as fd:
+                    for entry in json.load(fd):
+                        # json gives unicode, supybot's names are utf-8 str
+                        key = (entry.pop('network').encode('utf-8'),
+                               entry.pop('channel').encode('utf-8'))
+                        self._entries[key] = entry
+            except ValueError:
+                # a damaged index is rebuilt by the startup rescan
+                self._entries = {}
+
+    def update(self, key, entry):
+        """set the entry for (network, channel), None removes it"""
+        with self._lock:
+            if self._entries.get(key) == entry:
+                return
+            if entry is None:
+                del self._entries[key]
+            else:
+                self._entries[key] = entry
+            self._flush()
+
+    def keys(self):
+        with self._lock:
+            return list(self._entries.keys())
+
+    def entries(self):
+        """returns the sorted ((network, channel), entry) pairs"""
+        with self._lock:
+            return sorted(self._entries.items())
+
+    def _flush(self):
+        """rewrite the index file, atomically replacing the old one"""
+        entries = []
+        for (network, channel), entry in sorted(self._entries.items()):
+            entry = dict(entry)
+            entry['network'], entry['channel'] = network, channel
+            entries.append(entry)
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'w') as fd:
+            json.dump(entries, fd)
+        if os.name == 'nt' and os.path.exists(self.filename):
+            os.remove(self.filename)
+        os.rename(tmp, self.filename)
+
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
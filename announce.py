@@ -0,0 +1,145 @@
+###
+# Copyright (c) 2013, Arik Baratz
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+###
+
+"""
+Rate-aware outbound announcements: a token bucket matching the server's
+flood limit, and a priority queue of announcements that keeps each
+channel's in order and merges superseded topic changes.
+"""
+
+import time
+import collections
+
+# announcement priorities, most urgent first
+VOTE = 0        # vote open/close
+TOPIC = 1       # meeting topic changes
+NORMAL = 2      # meeting and agenda progress
+
+# slack for float rounding, so a bucket that is due never reports a delay
+# too small to move the clock forward
+EPSILON = 1e-9
+
+class TokenBucket(object):
+    """allows bursts of up to `burst` messages, refilled at `rate` per second"""
+    def __init__(self, rate, burst, clock=time.time):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.clock = clock
+        self.tokens = self.burst
+        self.last = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def consume(self, n=1):
+        """take n tokens if they're available, returns whether it did"""
+        self._refill()
+        if self.tokens + EPSILON >= n:
+            self.tokens = max(0.0, self.tokens - n)
+            return True
+        return False
+
+    def delay(self, n=1):
+        """returns how many seconds until n tokens will be available"""
+        self._refill()
+        if self.tokens + EPSILON >= n:
+            return 0.0
+        return (n - self.tokens) / self.rate
+
+class AnnounceQueue(object):
+    """the outbound announcements waiting for one network's rate limit.
+    each channel's announcements are sent in the order they were queued;
+    the channel with the most urgent announcement queued goes first, and
+    one that has waited max_wait seconds is more urgent than any other"""
+    def __init__(self, bucket, max_wait):
+        self.bucket = bucket
+        self.max_wait = max_wait
+        # channel -> deque of [priority, sequence, queued at, msg]
+        self._channels = {}
+        self._seq = 0
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    def put(self, channel, msg, priority=NORMAL):
+        """queue a message to the channel; a topic change still queued for
+        the channel is superseded by this one, and dropped"""
+        queue = self._channels.setdefault(channel, collections.deque())
+        if priority == TOPIC:
+            for entry in queue:
+                if entry[0] == TOPIC:
+                    queue.remove(entry)
+                    self._len -= 1
+                    break
+        queue.append([priority, self._seq, self.bucket.clock(), msg])
+        self._seq += 1
+        self._len += 1
+
+    def _next(self):
+        """returns the channel to send the next message to"""
+        aged = self.bucket.clock() - self.max_wait
+        chosen, chosen_rank = None, None
+        for channel, queue in self._channels.items():
+            # the oldest waits first, but is sent as urgently as any after it
+            if queue[0][2] <= aged:
+                urgency = -1
+            else:
+                urgency = min(entry[0] for entry in queue)
+            rank = (urgency, queue[0][1])
+            if chosen_rank is None or rank < chosen_rank:
+                chosen, chosen_rank = channel, rank
+        return chosen
+
+    def drain(self, send):
+        """send as many queued messages as the rate limit allows, returns
+        the number sent"""
+        sent = 0
+        while self._len and self.bucket.consume():
+            channel = self._next()
+            queue = self._channels[channel]
+            send(queue.popleft()[3])
+            if not queue:
+                del self._channels[channel]
+            self._len -= 1
+            sent += 1
+        return sent
+
+    def delay(self):
+        """returns how many seconds until the next message can be sent, or
+        None if nothing is queued"""
+        if not self._len:
+            return None
+        return self.bucket.delay()
+
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
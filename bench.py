@@ -0,0 +1,884 @@
+###
+# Copyright (c) 2013, Arik Baratz
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+###
+
+"""
+Benchmarks for the Meeting plugin.  Run them from the plugin directory with
+
+    python bench.py [<benchmark> ...]
+
+With no arguments every benchmark is run.
+"""
+
+import gc
+import array
+import atexit
+import os
+import sys
+import json
+import time
+import shutil
+import sqlite3
+import tempfile
+import random
+import threading
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+try:
+    intern
+except NameError:
+    from sys import intern
+
+try:
+    import httplib
+    import BaseHTTPServer
+    import SocketServer
+except ImportError:
+    import http.client as httplib
+    import http.server as BaseHTTPServer
+    import socketserver as SocketServer
+
+import tally
+import fsck
+import flood
+import events
+import status
+import announce
+import replay
+
+BENCHMARKS = []
+
+def benchmark(f):
+    BENCHMARKS.append(f)
+    return f
+
+def percentile(values, fraction):
+    """returns the value below which the given fraction of values fall"""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def report(title, values, unit):
+    print("  %-28s n=%-6d p50=%8.2f%s p95=%8.2f%s max=%8.2f%s" % (
+        title, len(values), percentile(values, 0.5), unit,
+        percentile(values, 0.95), unit, max(values or [0]), unit))
+
+
+class VirtualClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+def announcement_burst(channels, rng):
+    """the announcements of a busy evening: every channel starts a meeting
+    within the same few seconds, steps through its agenda, runs a vote and
+    adjourns.  returns (time, channel, priority)"""
+    messages = []
+    for channel in range(channels):
+        t = rng.uniform(0, 5)
+        messages.append((t, channel, announce.TOPIC))
+        messages.append((t, channel, announce.NORMAL))
+        for item in range(3):
+            t += rng.uniform(0, 2)
+            messages.append((t, channel, announce.NORMAL))
+        t += rng.uniform(0, 5)
+        messages.append((t, channel, announce.VOTE))
+        t += rng.uniform(5, 15)
+        messages.append((t, channel, announce.VOTE))
+        t += rng.uniform(0, 5)
+        messages.append((t, channel, announce.TOPIC))
+        messages.append((t, channel, announce.NORMAL))
+    messages.sort(key=lambda message: message[0])
+    return messages
+
+def simulate_naive(messages, rate, burst):
+    """everything is sent at once; the server then throttles the bot, so
+    each message waits behind all those sent before it"""
+    clock = VirtualClock()
+    server = announce.TokenBucket(rate, burst, clock)
+    latencies = {}
+    for t, channel, priority in messages:
+        clock.now = max(clock.now, t)
+        clock.now += server.delay()
+        server.consume()
+        latencies.setdefault(priority, []).append(clock.now - t)
+    return latencies, len(messages)
+
+def simulate_queued(messages, rate, burst, max_wait):
+    """messages go through the announcement queue, which never sends faster
+    than the server accepts them"""
+    clock = VirtualClock()
+    queue = announce.AnnounceQueue(announce.TokenBucket(rate, burst, clock),
+                                   max_wait)
+    latencies = {}
+    sent = []
+    last = {}
+
+    def send(msg):
+        t, channel, seq, priority = msg
+        latencies.setdefault(priority, []).append(clock.now - t)
+        # each channel's announcements must go out in order
+        assert last.get(channel, -1) < seq
+        last[channel] = seq
+        sent.append(msg)
+
+    pending = list(messages)
+    pending.reverse()
+    while pending or len(queue):
+        # arrive everything that is due, then send what we may
+        while pending and pending[-1][0] <= clock.now:
+            t, channel, priority = pending.pop()
+            queue.put(channel, (t, channel, len(messages) - len(pending), priority),
+                      priority)
+        queue.drain(send)
+
+        next_times = []
+        if pending:
+            next_times.append(pending[-1][0])
+        if len(queue):
+            next_times.append(clock.now + queue.delay())
+        if next_times:
+            clock.now = max(clock.now, min(next_times))
+    return latencies, len(sent)
+
+@benchmark
+def announcements():
+    """announcement latency under multi-channel bursts, simulated"""
+    names = {announce.VOTE: 'vote open/close',
+             announce.TOPIC: 'topic',
+             announce.NORMAL: 'meeting/agenda'}
+    rate, burst = 0.5, 5
+    for channels in (1, 10, 50):
+        messages = announcement_burst(channels, random.Random(channels))
+        print("%d channels, %d announcements, server allows %d burst + "
+              "%.1f/s" % (channels, len(messages), burst, rate))
+        runs = [('naive', simulate_naive, ()),
+                ('queued, strict priority', simulate_queued, (float('inf'), )),
+                ('queued, waiting at most 300s', simulate_queued, (300, ))]
+        for title, simulate, args in runs:
+            latencies, sent = simulate(messages, rate, burst, *args)
+            print(" %s: %d messages sent" % (title, sent))
+            for priority in sorted(latencies):
+                report(names[priority], latencies[priority], 's')
+
+def synthetic_status(meetings, motions):
+    """a status document the size of a busy evening's"""
+    document = {'meetings': []}
+    for i in range(meetings):
+        document['meetings'].append({
+            'network': 'net%d' % (i % 3), 'channel': '#meeting%d' % i,
+            'id': i, 'name': 'meeting %d' % i,
+            'start_time': '2013-01-01 10:00:00',
+            'agenda': ['agenda item %d' % j for j in range(10)],
+            'current_agenda_item': 3,
+            'motions': [{'text': 'motion %d' % j, 'vote_open': False,
+                         'aye': j, 'nay': 1, 'abstain': 0, 'carries': True,
+                         'decision_at': '2013-01-01 10:30:00'}
+                        for j in range(motions)],
+            'current_motion': motions,
+            'tally': {'aye': 10, 'nay': 3, 'abstain': 1}})
+    return document
+
+@benchmark
+def http_status():
+    """HTTP status endpoint throughput against a local server, while the
+    state changes ten times a second"""
+    lock = threading.RLock()
+    document = synthetic_status(50, 20)
+    builds = [0]
+    def build():
+        builds[0] += 1
+        return document
+    snapshot = status.StatusSnapshot(build, lock)
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # python 2 writes every header separately
+        disable_nagle_algorithm = True
+        def do_GET(self):
+            status.respond(self, snapshot)
+        def log_message(self, *args):
+            pass
+
+    class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+
+    server = Server(('127.0.0.1', 0), Handler)
+    port = server.server_address[1]
+    threading.Thread(target=server.serve_forever).start()
+
+    duration, clients = 3.0, 8
+    stop = time.time() + duration
+    results = {200: 0, 304: 0}
+    latencies = []
+    results_lock = threading.Lock()
+
+    def mutate():
+        while time.time() < stop:
+            with lock:
+                snapshot.changed()
+            time.sleep(0.1)
+
+    def poll():
+        connection = httplib.HTTPConnection('127.0.0.1', port)
+        etag, local = None, {200: 0, 304: 0}
+        local_latencies = []
+        while time.time() < stop:
+            headers = {}
+            if etag:
+                headers['If-None-Match'] = etag
+            start = time.time()
+            connection.request('GET', '/', headers=headers)
+            response = connection.getresponse()
+            response.read()
+            local_latencies.append((time.time() - start) * 1000)
+            local[response.status] += 1
+            etag = response.getheader('ETag')
+        connection.close()
+        with results_lock:
+            for code in local:
+                results[code] += local[code]
+            latencies.extend(local_latencies)
+
+    threads = [threading.Thread(target=mutate)]
+    threads += [threading.Thread(target=poll) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    server.shutdown()
+    server.server_close()
+
+    total = results[200] + results[304]
+    print("%d clients for %.0fs: %d requests, %.0f requests/s, %d 304s, "
+          "%d 200s, document rendered %d times (%d bytes)" % (
+          clients, duration, total, total / duration, results[304],
+          results[200], builds[0], len(snapshot.get()[1])))
+    report('request latency', latencies, 'ms')
+
+def synthetic_ballots(n, candidates, rng):
+    """ranked ballots with a few popular candidates and short rankings, as
+    in a real officer election"""
+    popularity = [rng.paretovariate(1.5) for candidate in range(candidates)]
+    ballots = []
+    for i in range(n):
+        length = min(candidates, int(rng.expovariate(0.5)) + 1)
+        ranking = []
+        while len(ranking) < length:
+            candidate = weighted_choice(popularity, rng)
+            if candidate not in ranking:
+                ranking.append(candidate)
+        ballots.append(tuple(ranking))
+    return ballots
+
+def weighted_choice(weights, rng):
+    point = rng.uniform(0, sum(weights))
+    for index, weight in enumerate(weights):
+        point -= weight
+        if point <= 0:
+            return index
+    return len(weights) - 1
+
+def naive_irv(ballots, candidates):
+    """instant-runoff counted the obvious way, re-reading every ballot in
+    every round, for comparison"""
+    continuing = set(range(candidates))
+    while True:
+        totals = dict((candidate, 0) for candidate in continuing)
+        for ballot in ballots:
+            for candidate in ballot:
+                if candidate in continuing:
+                    totals[candidate] += 1
+                    break
+        if len(continuing) == 1:
+            return list(continuing)
+        top = max(continuing, key=lambda c: (totals[c], -c))
+        if totals[top] * 2 > sum(totals.values()):
+            return [top]
+        continuing.remove(min(continuing, key=lambda c: (totals[c], -c)))
+
+@benchmark
+def election_tally():
+    """counting 100k synthetic ranked ballots"""
+    candidates = 12
+    ballots = synthetic_ballots(100000, candidates, random.Random(33))
+
+    start = time.time()
+    groups = tally.group_ballots(ballots)
+    grouped = time.time() - start
+    packed = sum(len(tally.pack_ranking(ranking)) + 4 for ranking in groups)
+    print("%d ballots, %d candidates: %d distinct rankings, grouped in "
+          "%.3fs, %d bytes packed" % (len(ballots), candidates, len(groups),
+                                     grouped, packed))
+
+    for seats in (1, 3, 5):
+        start = time.time()
+        result = tally.count(groups, candidates, seats)
+        print("  STV %d seat(s): elected %s in %d rounds, %.3fs" % (
+            seats, result.elected, len(result.rounds), time.time() - start))
+
+    start = time.time()
+    elected = naive_irv(ballots, candidates)
+    print("  naive IRV re-reading every ballot each round: elected %s, "
+          "%.3fs" % (elected, time.time() - start))
+
+def vote_flood(rng, honest, trolls, duration, troll_rate):
+    """the messages of a vote: honest voters vote once and sometimes change
+    their mind, trolls flip between aye and nay as fast as they can.
+    returns sorted (time, voter, vote)"""
+    messages = []
+    for n in range(honest):
+        t = rng.uniform(0, duration)
+        messages.append((t, 'voter%d' % n, rng.choice(['aye', 'nay', 'abstain'])))
+        if rng.random() < 0.2:
+            t = rng.uniform(t, duration)
+            messages.append((t, 'voter%d' % n, rng.choice(['aye', 'nay'])))
+    for n in range(trolls):
+        t = rng.expovariate(troll_rate)
+        while t < duration:
+            messages.append((t, 'troll%d' % n, rng.choice(['aye', 'nay'])))
+            t += rng.expovariate(troll_rate)
+    messages.sort()
+    return messages
+
+class VoteSink(object):
+    """the work done for every vote that is applied: the cache update and
+    a write to the database, as per-vote persistence would do"""
+    def __init__(self):
+        self.decisions = {}
+        self.writes = 0
+        self.db = sqlite3.connect(':memory:')
+        self.db.execute("""CREATE TABLE vote (voter TEXT PRIMARY KEY, vote TEXT)""")
+
+    def apply(self, voter, vote):
+        if self.decisions.get(voter) == vote:
+            return
+        self.decisions[voter] = vote
+        self.db.execute("""INSERT OR REPLACE INTO vote
+                           VALUES (?, ?)""", (voter, vote))
+        self.writes += 1
+
+@benchmark
+def vote_flood_guard():
+    """vote spam: 500 voters and 10 trolls flipping at 200 messages/s"""
+    duration = 30.0
+    messages = vote_flood(random.Random(38), 500, 10, duration, 200)
+    print("%d messages over %.0fs" % (len(messages), duration))
+
+    # every message goes straight to the cache
+    sink = VoteSink()
+    start = time.time()
+    for t, voter, vote in messages:
+        sink.apply(voter, vote)
+    naive = sink
+    print("  %-10s %6d writes %7.3fs" % ('unguarded', sink.writes,
+                                           time.time() - start))
+
+    # through the flood guard, with held back votes applied ten times a
+    # second and the rest when the vote closes
+    clock = VirtualClock()
+    guard = flood.FloodGuard(1.0, 5, 2.0, clock)
+    sink = VoteSink()
+    start = time.time()
+    next_tick = 0.1
+    for t, voter, vote in messages:
+        while next_tick <= t:
+            clock.now = next_tick
+            for held in guard.due():
+                sink.apply(*held)
+            next_tick += 0.1
+        clock.now = t
+        if guard.offer(voter, vote) is not None:
+            sink.apply(voter, vote)
+    for held in guard.drain():
+        sink.apply(*held)
+    print("  %-10s %6d writes %7.3fs, %d shed, %d collapsed" % (
+        'guarded', sink.writes, time.time() - start, guard.shed,
+        guard.collapsed))
+
+    honest = [voter for voter in naive.decisions if voter.startswith('voter')]
+    same = all(naive.decisions[voter] == sink.decisions[voter]
+               for voter in honest)
+    print("  honest voters' final votes identical: %s" % same)
+
+def vote_lines(voters):
+    """the vote messages of a channel's voters, split out of raw lines as
+    the parser does, so that each one has its own strings"""
+    votes = ('aye', 'nay', 'abstain')
+    for n in range(voters):
+        line = ':voter%d!user%d@host%d.example PRIVMSG #meeting :%s' % (
+            n, n, n % 251, votes[n % 3])
+        prefix, text = line[1:].split(' PRIVMSG #meeting :')
+        yield prefix, text
+
+def dict_store(voters):
+    """the plugin's voter -> vote dict, keeping each message's vote text"""
+    decisions = {}
+    for voter, text in vote_lines(voters):
+        decisions[voter] = text
+    return decisions
+
+def shared_text_store(voters):
+    """the plugin's voter -> vote dict, with the vote text shared"""
+    decisions = {}
+    for voter, text in vote_lines(voters):
+        decisions[voter] = intern(text)
+    return decisions
+
+def voter_id_store(voters):
+    """the compact store that was tried: voters interned to integer ids
+    shared by the open votes, and a byte per voter id in each vote"""
+    ids, codes = {}, array.array('b')
+    for voter, text in vote_lines(voters):
+        voter_id = ids.setdefault(voter, len(ids))
+        while len(codes) <= voter_id:
+            codes.append(0)
+        codes[voter_id] = ('aye', 'nay', 'abstain').index(text) + 1
+    return ids, codes
+
+def deep_size(value, seen):
+    """sys.getsizeof of the value and what it holds, each object once"""
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        for key, item in value.items():
+            size += deep_size(key, seen) + deep_size(item, seen)
+    elif isinstance(value, (tuple, list)):
+        for item in value:
+            size += deep_size(item, seen)
+    return size
+
+def held_bytes(build, voters):
+    """the bytes held by what build(voters) returns, measured with
+    tracemalloc where there is one (python 3.4 and later), otherwise
+    added up with sys.getsizeof"""
+    gc.collect()
+    if tracemalloc is None:
+        return deep_size(build(voters), set())
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    store = build(voters)
+    held = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return held
+
+@benchmark
+def ballot_memory():
+    """memory per ballot of an open vote's store, at 1k, 10k and 100k voters"""
+    print("measured with %s, in bytes per ballot" % (
+        tracemalloc and 'tracemalloc' or 'sys.getsizeof'))
+    stores = [('voter -> vote dict, vote text per message', dict_store),
+              ('voter -> vote dict, vote text shared', shared_text_store),
+              ('voter ids and a byte array', voter_id_store)]
+    for title, build in stores:
+        print("  %-44s %s" % (title, "  ".join(
+            "%dk: %4.0f" % (voters // 1000, float(held_bytes(build, voters)) / voters)
+            for voters in (1000, 10000, 100000))))
+
+_bench_irc = []
+
+def bench_irc():
+    """the bot with no connection the plugin benchmarks load the plugin
+    into; supybot's registry is only opened once, so they share it, and its
+    directory is removed at exit"""
+    if not _bench_irc:
+        directory = tempfile.mkdtemp()
+        atexit.register(shutil.rmtree, directory)
+        _bench_irc.append(replay.make_irc(directory, 'bench', 'MeetBot', '@'))
+    return _bench_irc[0]
+
+def make_channel_db(filename, meeting_in_progress, rng):
+    """a channel database with the tables startup reads, and a few hundred
+    events of meeting history"""
+    db = sqlite3.connect(filename)
+    db.executescript("""
+        CREATE TABLE meeting (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT,
+                              start_time TIMESTAMP NULL, end_time TIMESTAMP NULL);
+        CREATE TABLE agenda (id INTEGER PRIMARY KEY, meeting_id INTEGER,
+                             item_order INTEGER, item_text TEXT);
+        CREATE TABLE motion (id INTEGER PRIMARY KEY, meeting_id INTEGER,
+                             item_order INTEGER, motion_text TEXT,
+                             vote_open BOOLEAN, votes_aye INTEGER,
+                             votes_nay INTEGER, votes_abstain INTEGER,
+                             carries BOOLEAN, decision_at TIMESTAMP,
+                             weighted_aye REAL, weighted_nay REAL,
+                             weighted_abstain REAL);
+        CREATE TABLE vote (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                           motion_id INTEGER, voter TEXT, vote TEXT);
+        CREATE TABLE member_weight (member TEXT PRIMARY KEY, weight REAL);
+        CREATE TABLE proxy (member TEXT PRIMARY KEY, holder TEXT);
+        CREATE TABLE currents (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                               name TEXT, value INTEGER);
+        CREATE TABLE event (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                            at TIMESTAMP, kind TEXT, payload TEXT);
+        CREATE INDEX event_at ON event (at);
+        CREATE TABLE snapshot (event_id INTEGER PRIMARY KEY, state TEXT,
+                               full BOOLEAN);
+        CREATE TABLE election (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                               meeting_id INTEGER, seats INTEGER,
+                               candidates TEXT, vote_open BOOLEAN,
+                               ballots INTEGER, elected TEXT,
+                               decision_at TIMESTAMP);
+        CREATE TABLE ballot (election_id INTEGER, ranking BLOB, count INTEGER);
+        CREATE INDEX motion_decision ON motion (decision_at, carries);
+        CREATE INDEX meeting_start ON meeting (start_time);
+        CREATE TABLE hand (meeting_id INTEGER, agenda_item INTEGER,
+                           position INTEGER, nick TEXT);
+        INSERT INTO currents VALUES (NULL, 'meeting', NULL);
+        INSERT INTO currents VALUES (NULL, 'agenda', NULL);
+        INSERT INTO currents VALUES (NULL, 'motion', NULL);
+        INSERT INTO currents VALUES (NULL, 'vote', NULL);
+    """)
+    state = events.empty_state()
+    log = []
+    meetings = 3 if meeting_in_progress else 2
+    for meeting_id in range(1, meetings + 1):
+        log.append(('prepare', {'meeting_id': meeting_id, 'name': 'meeting %d' % meeting_id}))
+        log.append(('start', {'meeting_id': meeting_id}))
+        for item in range(1, 6):
+            log.append(('agenda_add', {'meeting_id': meeting_id, 'text': 'item %d' % item}))
+            db.execute("""INSERT INTO agenda
+                          VALUES (NULL, ?, ?, ?)""", (meeting_id, item, 'item %d' % item))
+        for item in range(1, rng.randint(20, 60)):
+            log.append(('motion_add', {'meeting_id': meeting_id, 'text': 'motion %d' % item}))
+            log.append(('vote_start', {'meeting_id': meeting_id, 'item': item}))
+            log.append(('vote_end', {'meeting_id': meeting_id, 'item': item,
+                                     'aye': 3, 'nay': 1, 'abstain': 0}))
+            motion_id = db.execute("""INSERT INTO motion
+                                      VALUES (NULL, ?, ?, ?, 0, 3, 1, 0, 1,
+                                              '2013-01-01 10:00:00', 3, 1, 0)""",
+                                   (meeting_id, item, 'motion %d' % item)).lastrowid
+            db.executemany("""INSERT INTO vote
+                              VALUES (NULL, ?, ?, ?)""",
+                           [(motion_id, 'voter%d' % voter, vote) for voter, vote
+                            in enumerate(('aye', 'aye', 'aye', 'nay'))])
+        db.execute("""INSERT INTO meeting
+                      VALUES (?, ?, '2013-01-01 10:00:00', NULL)""",
+                   (meeting_id, 'meeting %d' % meeting_id))
+        if meeting_id < meetings or not meeting_in_progress:
+            log.append(('adjourn', {'meeting_id': meeting_id}))
+            db.execute("""UPDATE meeting
+                          SET end_time='2013-01-01 11:00:00'
+                          WHERE id=?""", (meeting_id, ))
+    for event_id, (kind, payload) in enumerate(log):
+        events.apply_event(state, kind, payload, '2013-01-01 10:00:00')
+        db.execute("""INSERT INTO event
+                      VALUES (NULL, '2013-01-01 10:00:00', ?, ?)""",
+                   (kind, json.dumps(payload)))
+        if (event_id + 1) % 100 == 0:
+            events.store_snapshot(db, state, event_id + 1, 10)
+    db.execute("""UPDATE currents
+                  SET value=?
+                  WHERE name='meeting'""", (meetings, ))
+    db.commit()
+    db.close()
+
+def first_commands(meeting, keys):
+    """the latency of each channel's first command: its state and the
+    current meeting, as every command starts by reading them"""
+    latencies = []
+    for key in keys:
+        start = time.time()
+        meeting._get_state(key)
+        meeting._get_current(key, 'meeting')
+        latencies.append((time.time() - start) * 1000)
+    return latencies
+
+@benchmark
+def plugin_startup():
+    """plugin load/reload, and first command latency with 500 channel DBs"""
+    try:
+        import supybot
+    except ImportError:
+        print("  skipped, the plugin needs supybot to load")
+        return
+    irc = bench_irc()
+    import supybot.plugin as plugin
+    import supybot.plugins as plugins
+
+    rng = random.Random(41)
+    channels, in_progress = 500, 50
+    keys = []
+    for n in range(channels):
+        channel = '#c%d' % n
+        make_channel_db(plugins.makeChannelFilename('Meeting.bench.db', channel),
+                        n < in_progress, rng)
+        keys.append(('bench', channel))
+    print("%d channel databases, %d with a meeting in progress" % (
+        channels, in_progress))
+
+    # a first load has no index of the meetings in progress, the
+    # background startup only builds it
+    start = time.time()
+    meeting = replay.load_meeting(irc)
+    print("  first load: %.1fms" % ((time.time() - start) * 1000))
+    start = time.time()
+    meeting._workers.join()
+    print("  indexing all %d in the background: %.0fms, %d active" % (
+        channels, (time.time() - start) * 1000, len(meeting._active.entries())))
+    report('first command, cold', first_commands(meeting, keys[:in_progress]), 'ms')
+
+    # reload the way Owner's reload command does
+    name = os.path.basename(os.path.dirname(os.path.abspath(replay.__file__)))
+    start = time.time()
+    irc.removeCallback(meeting.name())
+    module = plugin.loadPluginModule(name)
+    meeting.die()
+    del meeting
+    gc.collect()
+    meeting = plugin.loadPluginClass(irc, module)
+    print("  reload: %.1fms" % ((time.time() - start) * 1000))
+    start = time.time()
+    meeting._workers.join()
+    print("  warming the %d in progress and rescanning all in the "
+          "background: %.0fms" % (in_progress, (time.time() - start) * 1000))
+    report('first command, warmed', first_commands(meeting, keys[:in_progress]), 'ms')
+    irc.removeCallback(meeting.name())
+    meeting.die()
+
+def damage_channel_db(filename):
+    """the leftovers of the old motion delete: a motion gone from the
+    middle of a meeting, its votes still there, the rest not renumbered"""
+    db = sqlite3.connect(filename)
+    db.execute("""DELETE FROM motion
+                  WHERE meeting_id=1
+                  AND item_order=2""")
+    db.execute("""UPDATE motion
+                  SET votes_aye=votes_aye+1
+                  WHERE id=1""")
+    db.commit()
+    db.close()
+
+def naive_check(filename):
+    """the same checks a row at a time: a query per meeting and per motion"""
+    db = sqlite3.connect(filename)
+    problems = 0
+    cursor = db.cursor()
+    cursor.execute("""SELECT id FROM meeting""")
+    meetings = [row[0] for row in cursor.fetchall()]
+    for meeting_id in meetings:
+        for table in ('agenda', 'motion'):
+            cursor.execute("""SELECT item_order FROM %s
+                              WHERE meeting_id=?
+                              ORDER BY item_order""" % table, (meeting_id, ))
+            orders = [row[0] for row in cursor.fetchall()]
+            if orders != list(range(1, len(orders) + 1)):
+                problems += 1
+        cursor.execute("""SELECT id, votes_aye, votes_nay, votes_abstain
+                          FROM motion
+                          WHERE meeting_id=?""", (meeting_id, ))
+        for motion_id, aye, nay, abstain in cursor.fetchall():
+            cursor.execute("""SELECT vote FROM vote
+                              WHERE motion_id=?""", (motion_id, ))
+            votes = [row[0] for row in cursor.fetchall()]
+            if (votes.count('aye'), votes.count('nay'), votes.count('abstain')) != (aye, nay, abstain):
+                problems += 1
+    cursor.execute("""SELECT motion_id FROM vote""")
+    for (motion_id, ) in cursor.fetchall():
+        cursor.execute("""SELECT 1 FROM motion WHERE id=?""", (motion_id, ))
+        if not cursor.fetchall():
+            problems += 1
+    db.close()
+    return problems
+
+@benchmark
+def fsck_scan():
+    """fsck of 500 channel DBs, a tenth of them damaged"""
+    directory = tempfile.mkdtemp()
+    try:
+        rng = random.Random(42)
+        filenames = []
+        for n in range(500):
+            channel = os.path.join(directory, '#channel%d' % n)
+            os.mkdir(channel)
+            filename = os.path.join(channel, 'Meeting.net.db')
+            make_channel_db(filename, n % 10 == 0, rng)
+            if n % 10 == 0:
+                damage_channel_db(filename)
+            filenames.append(filename)
+
+        start = time.time()
+        found = fsck.find_databases([directory])
+        print("finding %d databases: %.0fms" % (len(found), (time.time() - start) * 1000))
+
+        for title, check in (('row at a time', naive_check),
+                             ('set-based', fsck.check_file)):
+            times = []
+            start = time.time()
+            damaged = 0
+            for filename in filenames:
+                t = time.time()
+                if check(filename):
+                    damaged += 1
+                times.append((time.time() - t) * 1000)
+            print("%s: %.2fs for all, %d damaged" % (title, time.time() - start, damaged))
+            report('  per database', times, 'ms')
+
+        start = time.time()
+        repaired = [fsck.check_file(filename, repair=True) for filename in filenames]
+        print("set-based repair: %.2fs, %d repaired" % (
+            time.time() - start, len([problems for problems in repaired if problems])))
+        left = [fsck.check_file(filename) for filename in filenames]
+        print("  left after the repair: %d" % len([problems for problems in left if problems]))
+    finally:
+        shutil.rmtree(directory)
+
+def vote_end_log(channel, votes, voters, rng):
+    """raw lines of a meeting that votes on one motion after another"""
+    chair = ':chair!chair@bench.invalid PRIVMSG %s :@%%s' % channel
+    lines = [chair % 'prepare long history', chair % 'start']
+    for item in range(votes):
+        lines.append(chair % ('motion add motion %d' % item))
+        lines.append(chair % 'vote start')
+        for voter in range(voters):
+            lines.append(':voter%d!voter%d@bench.invalid PRIVMSG %s :%s' % (
+                voter, voter, channel, rng.choice(replay.VALID_VOTE)))
+        lines.append(chair % 'vote end')
+    return [(None, line) for line in lines]
+
+def add_report_history(db, motions, votes_each):
+    """a long history of decided motions for the reports to list"""
+    db.execute("BEGIN")
+    for item in range(1, motions + 1):
+        motion_id = db.execute("""INSERT INTO motion
+                                  VALUES (NULL, 0, ?, 'motion', 0, 100, 0, 0,
+                                          1, '2013-01-01 10:00:00',
+                                          100, 0, 0)""", (item, )).lastrowid
+        db.executemany("""INSERT INTO vote
+                          VALUES (NULL, ?, ?, 'aye')""",
+                       [(motion_id, 'voter%d' % voter) for voter in range(votes_each)])
+    db.execute("COMMIT")
+
+def long_report(meeting, key, snapshot, stop, reports):
+    """run a big listing over and over, the way a worker runs one: through
+    the plugin's snapshot connection, or a plain autocommit one as the
+    workers had before"""
+    if not snapshot:
+        db = sqlite3.connect(meeting.makeFilename(key))
+        db.isolation_level = None
+    while not stop.is_set():
+        start = time.time()
+        if snapshot:
+            db = meeting.getDb(key)
+        cursor = db.cursor()
+        cursor.execute("""SELECT motion_id, voter, vote
+                          FROM vote
+                          ORDER BY voter""")
+        for row in cursor:
+            "%s %s %s" % row
+        if snapshot:
+            meeting._end_snapshots()
+        reports.append(time.time() - start)
+    if snapshot:
+        meeting._close_thread_dbs()
+    else:
+        db.close()
+
+@benchmark
+def vote_end_under_report():
+    """vote end command latency while a long report runs on a worker"""
+    try:
+        import supybot
+    except ImportError:
+        print("  skipped, the plugin needs supybot to load")
+        return
+    irc = bench_irc()
+    import supybot.conf as conf
+    meeting = replay.load_meeting(irc)
+    # the closing announcements are not held back by the rate limit
+    rate, burst = meeting.registryValue('announceRate'), meeting.registryValue('announceBurst')
+    conf.supybot.plugins.Meeting.announceRate.setValue(1000.0)
+    conf.supybot.plugins.Meeting.announceBurst.setValue(1000)
+    meeting._workers.join()
+    try:
+        # the writes are one transaction in both, only the journal and the
+        # reader differ
+        configurations = [
+            ('rollback journal, autocommit reader (before)', '#before', False),
+            ('WAL, snapshot reader', '#after', True),
+        ]
+        rng = random.Random(44)
+        for title, channel, snapshot in configurations:
+            key = (irc.network, channel)
+            db = meeting.getDb(key)
+            if not snapshot:
+                db.execute("PRAGMA journal_mode=DELETE")
+            add_report_history(db, 2000, 100)
+
+            print(title)
+            for under_report in (False, True):
+                stop, reports = threading.Event(), []
+                if under_report:
+                    reader = threading.Thread(target=long_report,
+                                              args=(meeting, key, snapshot, stop, reports))
+                    reader.start()
+                    time.sleep(0.1)
+                result = replay.Replay(irc, meeting, timeout=30.0).run(
+                    vote_end_log(channel, 30, 50, rng))
+                stop.set()
+                stats = result['commands']['vote end']
+                print("  vote end, %-18s n=%-6d p50=%8.2fms p95=%8.2fms max=%8.2fms" % (
+                    under_report and 'during reports' or 'idle', stats['count'],
+                    stats['p50_ms'], stats['p95_ms'], stats['max_ms']))
+                if under_report:
+                    reader.join()
+                    print("    %d reports of %.0fms on average" % (
+                        len(reports), sum(reports) * 1000 / max(len(reports), 1)))
+            decided = db.execute("""SELECT count(*)
+                                    FROM motion
+                                    WHERE meeting_id>0
+                                    AND carries IS NOT NULL""").fetchall()[0][0]
+            print("  %d of %d votes decided" % (decided, 60))
+    finally:
+        conf.supybot.plugins.Meeting.announceRate.setValue(rate)
+        conf.supybot.plugins.Meeting.announceBurst.setValue(burst)
+        irc.removeCallback(meeting.name())
+        meeting.die()
+
+def main(names):
+    for f in BENCHMARKS:
+        if names and f.__name__ not in names:
+            continue
+        print("== %s: %s" % (f.__name__, f.__doc__))
+        f()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
+
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
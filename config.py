@@ -45,5 +45,55 @@ Meeting = conf.registerPlugin('Meeting')
 # conf.registerGlobalValue(Meeting, 'someConfigVariableName',
 #     registry.Boolean(False, """Help for someConfigVariableName."""))
 
+conf.registerGlobalValue(Meeting, 'workerThreads',
+    registry.PositiveInteger(2, """Determines how many worker threads run the
+    heavy read-only commands (such as agenda and motion listings), so that
+    they don't hold up the bot's main loop."""))
+conf.registerGlobalValue(Meeting, 'announceRate',
+    registry.PositiveFloat(0.5, """Determines how many meeting announcements
+    (topic changes, votes opening and closing, agenda progress) per second
+    the bot sends to a network once its burst allowance is used up.  Set it
+    to match the server's flood limit."""))
+conf.registerGlobalValue(Meeting, 'announceBurst',
+    registry.PositiveInteger(5, """Determines how many meeting announcements
+    the bot may send to a network in a burst before announceRate applies."""))
+conf.registerGlobalValue(Meeting, 'announceMaxWait',
+    registry.PositiveInteger(300, """Determines how many seconds a meeting
+    announcement may be held back for more urgent ones (votes opening and
+    closing first, then topic changes, then the rest) before it is sent
+    ahead of them.  Each channel's announcements are always sent in order."""))
+conf.registerGlobalValue(Meeting, 'handFlushDelay',
+    registry.PositiveInteger(5, """Determines how many seconds speaker queue
+    changes are collected before they are written to the channel database
+    in one batch."""))
+conf.registerGlobalValue(Meeting, 'snapshotInterval',
+    registry.PositiveInteger(100, """Determines how many events are logged
+    between snapshots of a channel's meeting state.  Rebuilding the state, at
+    startup or for the asof command, replays at most this many events."""))
+conf.registerGlobalValue(Meeting, 'fullSnapshotInterval',
+    registry.PositiveInteger(10, """Determines how many snapshots are stored
+    between snapshots of the whole state; the others hold only the meetings
+    changed since the snapshot before.  Rebuilding the state reads at most
+    this many snapshots."""))
+conf.registerGlobalValue(Meeting, 'historyPageSize',
+    registry.PositiveInteger(20, """Determines how many meetings or motions
+    the history commands list per page."""))
+conf.registerGlobalValue(Meeting, 'minutesSyncDelay',
+    registry.PositiveInteger(10, """Determines how many seconds lines
+    appended to the meeting minutes files are buffered before they are
+    written out and synced to disk.  The minutes of an adjourned meeting are
+    synced at once."""))
+conf.registerGlobalValue(Meeting, 'voteRate',
+    registry.PositiveFloat(1.0, """Determines how many vote messages per
+    second each voter may send once their burst allowance is used up.  Any
+    more are ignored."""))
+conf.registerGlobalValue(Meeting, 'voteBurst',
+    registry.PositiveInteger(5, """Determines how many vote messages a voter
+    may send in a burst before voteRate applies."""))
+conf.registerGlobalValue(Meeting, 'voteDebounce',
+    registry.Float(2.0, """Determines how many seconds after a vote is
+    counted the same voter's next votes are held back; only the last of them
+    is counted, when the time is up or the vote closes."""))
+
 
 # vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
@@ -0,0 +1,310 @@
+###
+# Copyright (c) 2013, Arik Baratz
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+###
+
+"""
+The meeting event log: every change to a channel's meetings is appended to
+the event table, and the state of the channel at any point can be rebuilt
+from the nearest snapshot plus the events that follow it.
+
+The state is a plain dict, so that snapshots can be stored as JSON:
+
+    {'meetings': {'<meeting id>': {'name': ..., 'start_time': ...,
+                                   'end_time': ..., 'agenda': [text, ...],
+                                   'motions': [motion, ...],
+                                   'elections': [election, ...]}},
+     'currents': {'meeting': ..., 'agenda': ..., 'motion': ..., 'vote': ...}}
+
+Agenda items and motions are numbered by their position in the lists.
+
+Every so often a snapshot holds the whole state; the ones in between hold
+the current pointers and only the meetings changed since the snapshot
+before, so they stay the size of the recent activity.  The state is rebuilt
+by laying the snapshots since the last whole one over each other in order.
+"""
+
+import json
+import time
+
+def now():
+    """returns the current UTC time in the same format as sqlite's datetime()"""
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())
+
+def empty_state():
+    """returns the state of a channel that never had a meeting"""
+    return {'meetings': {},
+            'currents': {'meeting': None, 'agenda': None,
+                         'motion': None, 'vote': None}}
+
+def new_motion(text):
+    """returns the state of a motion that has not been voted on"""
+    return {'text': text, 'vote_open': False, 'aye': None, 'nay': None,
+            'abstain': None, 'carries': None, 'decision_at': None}
+
+def _meeting(state, payload):
+    return state['meetings'][str(payload['meeting_id'])]
+
+def _shift_current(state, name, items, deleted):
+    """mirror the commands' handling of the current item after a delete"""
+    if not items:
+        state['currents'][name] = None
+    elif state['currents'][name] > deleted:
+        state['currents'][name] -= 1
+
+def _prepare(state, payload, at):
+    state['meetings'][str(payload['meeting_id'])] = {
+        'name': payload['name'], 'start_time': None, 'end_time': None,
+        'agenda': [], 'motions': [], 'elections': []}
+    state['currents']['meeting'] = payload['meeting_id']
+
+def _start(state, payload, at):
+    _meeting(state, payload)['start_time'] = at
+    state['currents']['agenda'] = None
+    state['currents']['motion'] = None
+
+def _adjourn(state, payload, at):
+    _meeting(state, payload)['end_time'] = at
+
+def _switch(state, payload, at):
+    state['currents']['meeting'] = payload['meeting_id']
+
+def _agenda_add(state, payload, at):
+    agenda = _meeting(state, payload)['agenda']
+    agenda.append(payload['text'])
+    state['currents']['agenda'] = len(agenda)
+
+def _agenda_delete(state, payload, at):
+    agenda = _meeting(state, payload)['agenda']
+    del agenda[payload['item'] - 1]
+    _shift_current(state, 'agenda', agenda, payload['item'])
+
+def _agenda_next(state, payload, at):
+    state['currents']['agenda'] = payload['item']
+
+def _motion_add(state, payload, at):
+    motions = _meeting(state, payload)['motions']
+    motions.append(new_motion(payload['text']))
+    state['currents']['motion'] = len(motions)
+
+def _motion_amend(state, payload, at):
+    motions = _meeting(state, payload)['motions']
+    motions[payload['item'] - 1]['text'] = payload['text']
+
+def _motion_delete(state, payload, at):
+    motions = _meeting(state, payload)['motions']
+    del motions[payload['item'] - 1]
+    _shift_current(state, 'motion', motions, payload['item'])
+
+def _vote_start(state, payload, at):
+    motion = _meeting(state, payload)['motions'][payload['item'] - 1]
+    motion['vote_open'] = True
+    motion['secret'] = payload.get('secret', False)
+
+def _vote_end(state, payload, at):
+    motion = _meeting(state, payload)['motions'][payload['item'] - 1]
+    motion['vote_open'] = False
+    for vote in ('aye', 'nay', 'abstain'):
+        motion[vote] = payload[vote]
+    # older events predate weighted voting
+    motion['carries'] = payload.get('carries', payload['aye'] > payload['nay'])
+    motion['decision_at'] = at
+
+def _election_start(state, payload, at):
+    elections = _meeting(state, payload).setdefault('elections', [])
+    elections.append({'id': payload['election_id'],
+                      'candidates': payload['candidates'],
+                      'seats': payload['seats'], 'vote_open': True,
+                      'ballots': None, 'elected': None, 'decision_at': None})
+
+def _repair(state, payload, at):
+    # the state after a repair is stored as the repair's own snapshot
+    pass
+
+def _election_end(state, payload, at):
+    for election in _meeting(state, payload).get('elections', []):
+        if election['id'] == payload['election_id']:
+            election['vote_open'] = False
+            election['ballots'] = payload['ballots']
+            election['elected'] = payload['elected']
+            election['decision_at'] = at
+
+APPLY = {
+    'prepare': _prepare,
+    'start': _start,
+    'adjourn': _adjourn,
+    'switch': _switch,
+    'agenda_add': _agenda_add,
+    'agenda_delete': _agenda_delete,
+    'agenda_next': _agenda_next,
+    'motion_add': _motion_add,
+    'motion_amend': _motion_amend,
+    'motion_delete': _motion_delete,
+    'vote_start': _vote_start,
+    'vote_end': _vote_end,
+    'election_start': _election_start,
+    'election_end': _election_end,
+    'repair': _repair,
+}
+
+def apply_event(state, kind, payload, at):
+    """apply a single event to the state, in place"""
+    APPLY[kind](state, payload, at)
+
+def import_state(db):
+    """build the state from the tables of a database that predates the
+    event log, so that it can be stored as the first snapshot"""
+    state = empty_state()
+    cursor = db.cursor()
+    cursor.execute("""SELECT id, name, start_time, end_time
+                      FROM meeting""")
+    for meeting_id, name, start_time, end_time in cursor.fetchall():
+        state['meetings'][str(meeting_id)] = {
+            'name': name, 'start_time': start_time, 'end_time': end_time,
+            'agenda': [], 'motions': [], 'elections': []}
+    cursor.execute("""SELECT meeting_id, item_text
+                      FROM agenda
+                      ORDER BY meeting_id, item_order""")
+    for meeting_id, item_text in cursor.fetchall():
+        if str(meeting_id) in state['meetings']:
+            state['meetings'][str(meeting_id)]['agenda'].append(item_text)
+    cursor.execute("""SELECT meeting_id, motion_text, vote_open, votes_aye,
+                             votes_nay, votes_abstain, carries, decision_at
+                      FROM motion
+                      ORDER BY meeting_id, item_order""")
+    for row in cursor.fetchall():
+        meeting_id = str(row[0])
+        if meeting_id not in state['meetings']:
+            continue
+        motion = new_motion(row[1])
+        motion['vote_open'] = bool(row[2])
+        motion['aye'], motion['nay'], motion['abstain'] = row[3:6]
+        if row[6] is not None:
+            motion['carries'] = bool(row[6])
+        motion['decision_at'] = row[7]
+        state['meetings'][meeting_id]['motions'].append(motion)
+    cursor.execute("""SELECT name, value
+                      FROM currents""")
+    for name, value in cursor.fetchall():
+        state['currents'][name] = value
+    return state
+
+def repaired_state(db, state):
+    """returns the state of a database whose tables were repaired, built
+    from the tables, with what only the log knows taken from the state
+    before the repair"""
+    repaired = import_state(db)
+    for meeting_id, meeting in repaired['meetings'].items():
+        before = state['meetings'].get(meeting_id)
+        if before is None:
+            continue
+        meeting['elections'] = before.get('elections', [])
+        # repairs renumber motions but keep their order
+        for motion, motion_before in zip(meeting['motions'], before['motions']):
+            if motion_before.get('secret'):
+                motion['secret'] = True
+    return repaired
+
+def last_event_before(db, timestamp):
+    """returns the id of the last event at or before the timestamp, or 0"""
+    cursor = db.cursor()
+    cursor.execute("""SELECT max(id)
+                      FROM event
+                      WHERE at<=?""", (timestamp, ))
+    return cursor.fetchall()[0][0] or 0
+
+def store_snapshot(db, state, event_id, full_every=1):
+    """store the snapshot of the state after the given event; every
+    full_every-th snapshot holds the whole state"""
+    cursor = db.cursor()
+    cursor.execute("""SELECT count(*)
+                      FROM snapshot
+                      WHERE event_id>(SELECT coalesce(max(event_id), 0)
+                                      FROM snapshot
+                                      WHERE full)""")
+    if cursor.fetchall()[0][0] + 1 >= full_every:
+        cursor.execute("""INSERT INTO snapshot
+                          VALUES (?, ?, 1)""", (event_id, json.dumps(state)))
+        return
+
+    cursor.execute("""SELECT payload
+                      FROM event
+                      WHERE id>(SELECT coalesce(max(event_id), 0)
+                                FROM snapshot)
+                      AND id<=?""", (event_id, ))
+    changed = set(str(json.loads(payload).get('meeting_id'))
+                  for (payload, ) in cursor.fetchall())
+    meetings = dict((meeting_id, state['meetings'][meeting_id])
+                    for meeting_id in changed
+                    if meeting_id in state['meetings'])
+    cursor.execute("""INSERT INTO snapshot
+                      VALUES (?, ?, 0)""",
+                      (event_id, json.dumps({'meetings': meetings,
+                                             'currents': state['currents']})))
+
+def load_state(db, until_event=None):
+    """rebuild the state after the given event (default: the latest one)
+    from the last whole snapshot before it, the snapshots that follow that
+    one, and the events that follow the last snapshot.
+
+    returns (state, number of events replayed)"""
+    cursor = db.cursor()
+    if until_event is None:
+        cursor.execute("""SELECT max(id)
+                          FROM event""")
+        until_event = cursor.fetchall()[0][0] or 0
+
+    # the whole state, overlaid by the changes of the newer snapshots
+    cursor.execute("""SELECT event_id, state
+                      FROM snapshot
+                      WHERE event_id>=(SELECT coalesce(max(event_id), 0)
+                                       FROM snapshot
+                                       WHERE full
+                                       AND event_id<=?)
+                      AND event_id<=?
+                      ORDER BY event_id ASC""", (until_event, until_event))
+    snapshot_event, state = 0, empty_state()
+    for event_id, stored in cursor.fetchall():
+        stored = json.loads(stored)
+        state['meetings'].update(stored['meetings'])
+        state['currents'] = stored['currents']
+        snapshot_event = event_id
+
+    cursor.execute("""SELECT at, kind, payload
+                      FROM event
+                      WHERE id>?
+                      AND id<=?
+                      ORDER BY id ASC""", (snapshot_event, until_event))
+    replayed = 0
+    for at, kind, payload in cursor:
+        apply_event(state, kind, json.loads(payload), at)
+        replayed += 1
+    return state, replayed
+
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
@@ -0,0 +1,111 @@
+###
+# Copyright (c) 2013, Arik Baratz
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+###
+
+"""
+Flood control for the vote path: every voter gets a token bucket, messages
+beyond it are shed before they reach the vote cache, and rapid changes of
+mind inside a short window collapse into the last one.
+"""
+
+import time
+import threading
+
+import announce
+
+class FloodGuard(object):
+    """rate limits and debounces the votes of each voter in one channel"""
+    def __init__(self, rate, burst, window, clock=time.time):
+        self.rate = rate
+        self.burst = burst
+        self.window = window
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._buckets = {}
+        # the end of each voter's debounce window, and the last vote they
+        # sent inside it
+        self._window_ends = {}
+        self._pending = {}
+        # messages dropped by the rate limit, and votes replaced by a later
+        # one in the same window
+        self.shed = 0
+        self.collapsed = 0
+
+    def offer(self, voter, vote):
+        """returns the vote if it is to be applied now, or None if it was
+        shed or is held back until the voter's window closes"""
+        with self._lock:
+            return self._offer(voter, vote)
+
+    def _offer(self, voter, vote):
+        bucket = self._buckets.get(voter)
+        if bucket is None:
+            bucket = self._buckets[voter] = announce.TokenBucket(self.rate,
+                                                                 self.burst,
+                                                                 self.clock)
+        if not bucket.consume():
+            self.shed += 1
+            return None
+
+        now = self.clock()
+        if now < self._window_ends.get(voter, 0):
+            if voter in self._pending:
+                self.collapsed += 1
+            self._pending[voter] = vote
+            return None
+        self._window_ends[voter] = now + self.window
+        return vote
+
+    def next_due(self):
+        """returns when the first held back vote is due, or None"""
+        with self._lock:
+            if not self._pending:
+                return None
+            return min(self._window_ends[voter] for voter in self._pending)
+
+    def due(self):
+        """returns the held back (voter, vote)s whose windows have closed;
+        each starts a new window"""
+        with self._lock:
+            now = self.clock()
+            due = [(voter, vote) for voter, vote in self._pending.items()
+                   if self._window_ends[voter] <= now]
+            for voter, vote in due:
+                del self._pending[voter]
+                self._window_ends[voter] = now + self.window
+            return due
+
+    def drain(self):
+        """returns every held back (voter, vote), for when the vote closes"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            return list(pending.items())
+
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
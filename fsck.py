@@ -0,0 +1,319 @@
+###
+# Copyright (c) 2013, Arik Baratz
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+###
+
+
+"""
+Consistency checks of the channel databases, for the fsck command and for
+running offline over a bot's data directory:
+
+    python fsck.py [--repair] [<data directory or database> ...]
+
+Each check is a single set-based query counting the rows that are wrong,
+so a database is checked in a handful of table scans however many
+meetings it holds; --repair runs the fixes of the checks that fail, all in
+one transaction per database, and appends the repair to the database's
+event log as the bot's fsck --repair does.
+"""
+
+import os
+import sys
+import json
+import time
+import sqlite3
+
+import events
+import weights
+
+VOTES = ('aye', 'nay', 'abstain')
+
+def _order_check(table, items):
+    """the check that a meeting's items are numbered 1..n with no gaps or
+    repeats; the repair renumbers them keeping their order"""
+    bad = """SELECT meeting_id
+             FROM %s
+             GROUP BY meeting_id
+             HAVING min(item_order)<>1
+             OR max(item_order)<>count(*)
+             OR count(DISTINCT item_order)<>count(*)""" % table
+    # the new numbers go through a temporary table, an UPDATE that counted
+    # the rows before it would see the ones it already renumbered
+    renumber = """INSERT INTO temp.renumber
+                  SELECT id, (SELECT count(*)
+                              FROM %(table)s AS earlier
+                              WHERE earlier.meeting_id=%(table)s.meeting_id
+                              AND (earlier.item_order<%(table)s.item_order
+                                   OR (earlier.item_order=%(table)s.item_order
+                                       AND earlier.id<=%(table)s.id)))
+                  FROM %(table)s
+                  WHERE meeting_id IN (%(bad)s)""" % {'table': table, 'bad': bad}
+    return ('%s_order' % table,
+            "meetings with %s out of sequence" % items,
+            (table, ),
+            "SELECT count(*) FROM (%s)" % bad,
+            ["""CREATE TEMP TABLE renumber (id INTEGER PRIMARY KEY,
+                                            item_order INTEGER)""",
+             renumber,
+             """UPDATE %s
+                SET item_order=(SELECT item_order
+                                FROM temp.renumber
+                                WHERE renumber.id=%s.id)
+                WHERE id IN (SELECT id FROM temp.renumber)""" % (table, table),
+             """DROP TABLE temp.renumber"""])
+
+def _current_check(table, items):
+    """the check that the current item is one of the current meeting's"""
+    dangling = """FROM currents
+                  WHERE name='%(table)s'
+                  AND value IS NOT NULL
+                  AND NOT EXISTS (SELECT 1
+                                  FROM %(table)s
+                                  WHERE meeting_id=(SELECT value
+                                                    FROM currents
+                                                    WHERE name='meeting')
+                                  AND item_order=currents.value)""" % {'table': table}
+    return ('%s_current' % table,
+            "current %s that doesn't exist" % items,
+            ('currents', table),
+            "SELECT count(*) %s" % dangling,
+            ["UPDATE currents SET value=NULL WHERE id IN (SELECT id %s)" % dangling])
+
+def _orphan_check(table, parent, column, items):
+    """the check for rows whose parent row was deleted"""
+    orphans = "%s WHERE %s NOT IN (SELECT id FROM %s)" % (table, column, parent)
+    return ('orphan_%s' % table, items, (table, parent),
+            "SELECT count(*) FROM %s" % orphans,
+            ["DELETE FROM %s" % orphans])
+
+# the decided motions whose counts don't match their vote rows, including
+# those with counts but no vote rows at all
+_MISCOUNTED = """SELECT motion.id
+                 FROM motion
+                 LEFT JOIN (SELECT motion_id, sum(vote='aye') AS aye,
+                                   sum(vote='nay') AS nay,
+                                   sum(vote='abstain') AS abstain
+                            FROM vote
+                            GROUP BY motion_id) AS counted
+                 ON motion.id=counted.motion_id
+                 WHERE motion.carries IS NOT NULL
+                 AND (ifnull(motion.votes_aye, -1)<>ifnull(counted.aye, 0)
+                      OR ifnull(motion.votes_nay, -1)<>ifnull(counted.nay, 0)
+                      OR ifnull(motion.votes_abstain, -1)<>ifnull(counted.abstain, 0))"""
+
+def _recount(db):
+    """count the miscounted motions again from their vote rows: the counts,
+    the weighted totals and whether the motion carries.  the ballots of a
+    secret vote can't be traced to their members, so they weigh one"""
+    table = weights.Weights.load(db)
+    cursor = db.cursor()
+    cursor.execute(_MISCOUNTED)
+    for (motion_id, ) in cursor.fetchall():
+        cursor.execute("""SELECT voter, vote
+                          FROM vote
+                          WHERE motion_id=?
+                          ORDER BY id""", (motion_id, ))
+        ballots = cursor.fetchall()
+        count = dict((vote, 0) for vote in VOTES)
+        for voter, vote in ballots:
+            count[vote] += 1
+        totals, members = table.tally([(weights.identity(voter), vote)
+                                       for voter, vote in ballots])
+        weighted = dict((vote, totals.get(vote, 0.0)) for vote in VOTES)
+        cursor.execute("""UPDATE motion
+                          SET votes_aye=?,
+                              votes_nay=?,
+                              votes_abstain=?,
+                              weighted_aye=?,
+                              weighted_nay=?,
+                              weighted_abstain=?,
+                              carries=?
+                          WHERE id=?""",
+                          (count['aye'], count['nay'], count['abstain'],
+                           weighted['aye'], weighted['nay'], weighted['abstain'],
+                           weighted['aye'] > weighted['nay'], motion_id))
+
+# (name, description, tables it reads, query counting the problems, repair
+# statements or functions of the database), in the order they run: orphans
+# go first, parents before children, so that the votes of a deleted motion
+# are caught in the same pass
+CHECKS = [
+    _orphan_check('agenda', 'meeting', 'meeting_id',
+                  "agenda items of meetings that don't exist"),
+    _orphan_check('motion', 'meeting', 'meeting_id',
+                  "motions of meetings that don't exist"),
+    _orphan_check('vote', 'motion', 'motion_id',
+                  "votes on motions that don't exist"),
+    _orphan_check('election', 'meeting', 'meeting_id',
+                  "elections of meetings that don't exist"),
+    _orphan_check('ballot', 'election', 'election_id',
+                  "ballots of elections that don't exist"),
+    _orphan_check('hand', 'meeting', 'meeting_id',
+                  "raised hands in meetings that don't exist"),
+    _order_check('agenda', 'agenda items'),
+    _order_check('motion', 'motions'),
+    ('meeting_current', "current meeting that doesn't exist",
+     ('currents', 'meeting'),
+     """SELECT count(*)
+        FROM currents
+        WHERE name='meeting'
+        AND value IS NOT NULL
+        AND value NOT IN (SELECT id FROM meeting)""",
+     ["""UPDATE currents
+         SET value=NULL
+         WHERE name='meeting'
+         AND value NOT IN (SELECT id FROM meeting)"""]),
+    _current_check('agenda', 'agenda item'),
+    _current_check('motion', 'motion'),
+    ('vote_count', "decided motions whose vote counts don't match the votes",
+     ('motion', 'vote', 'member_weight', 'proxy'),
+     "SELECT count(*) FROM (%s)" % _MISCOUNTED,
+     [_recount]),
+]
+
+DESCRIPTIONS = dict((name, description)
+                    for name, description, tables, query, fixes in CHECKS)
+
+def _tables(db):
+    cursor = db.cursor()
+    cursor.execute("""SELECT name
+                      FROM sqlite_master
+                      WHERE type='table'""")
+    return set(row[0] for row in cursor.fetchall())
+
+def check(db, repair=False):
+    """run the checks, and the repairs of those that fail if asked to; the
+    caller owns the transaction.  a database the bot hasn't upgraded yet
+    skips the checks of the tables it doesn't have.  returns [(check name,
+    problems found)]"""
+    cursor = db.cursor()
+    problems = []
+    present = _tables(db)
+    for name, description, tables, query, fixes in CHECKS:
+        if not present.issuperset(tables):
+            continue
+        cursor.execute(query)
+        found = cursor.fetchall()[0][0]
+        if not found:
+            continue
+        problems.append((name, found))
+        if repair:
+            for fix in fixes:
+                if callable(fix):
+                    fix(db)
+                else:
+                    cursor.execute(fix)
+    return problems
+
+def log_repair(db, problems, before):
+    """append the event of a repair to the database's log, with the state
+    rebuilt from the repaired tables as its snapshot, so that rebuilding the
+    state doesn't undo the repair.  before is the state before the repair"""
+    cursor = db.cursor()
+    cursor.execute("""INSERT INTO event
+                      VALUES (NULL, ?, 'repair', ?)""",
+                      (events.now(), json.dumps(dict(problems))))
+    events.store_snapshot(db, events.repaired_state(db, before), cursor.lastrowid)
+
+def check_file(filename, repair=False):
+    """check a database file, repairing it in one transaction if asked to;
+    the repair of a database with an event log is logged as the bot logs
+    it.  returns [(check name, problems found)]"""
+    db = sqlite3.connect(filename)
+    db.isolation_level = None
+    try:
+        cursor = db.cursor()
+        if not repair:
+            return check(db)
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            before = None
+            if 'event' in _tables(db):
+                cursor.execute("""PRAGMA table_info(snapshot)""")
+                if 'full' not in set(row[1] for row in cursor.fetchall()):
+                    raise sqlite3.DatabaseError("its snapshots predate this "
+                                                "version, load it in the bot "
+                                                "before repairing it")
+                before, replayed = events.load_state(db)
+            problems = check(db, repair=True)
+            if problems and before is not None:
+                log_repair(db, problems, before)
+        except:
+            cursor.execute("ROLLBACK")
+            raise
+        cursor.execute("COMMIT")
+        return problems
+    finally:
+        db.close()
+
+def describe(problems):
+    """returns the problems as text, e.g. '2 motions out of sequence'"""
+    return ", ".join("%d %s" % (found, DESCRIPTIONS[name])
+                     for name, found in problems)
+
+def find_databases(paths, prefix='Meeting.', suffix='.db'):
+    """returns the channel databases among the paths, searching directories"""
+    found = []
+    for path in paths:
+        if not os.path.isdir(path):
+            found.append(path)
+            continue
+        for directory, subdirectories, filenames in os.walk(path):
+            for filename in filenames:
+                if filename.startswith(prefix) and filename.endswith(suffix):
+                    found.append(os.path.join(directory, filename))
+    return sorted(found)
+
+def main(argv):
+    repair = '--repair' in argv
+    paths = [arg for arg in argv if arg != '--repair'] or ['.']
+    start = time.time()
+    filenames = find_databases(paths)
+    damaged, failed = 0, 0
+    for filename in filenames:
+        try:
+            problems = check_file(filename, repair)
+        except sqlite3.Error as e:
+            print("%s: cannot check: %s" % (filename, e))
+            failed += 1
+            continue
+        if problems:
+            print("%s: %s%s" % (filename, describe(problems),
+                                repair and " (repaired)" or ""))
+            damaged += 1
+    print("checked %d databases in %.2fs, %d with problems, %d failed" % (
+        len(filenames), time.time() - start, damaged, failed))
+    if failed or (damaged and not repair):
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
+
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
@@ -0,0 +1,162 @@
+###
+# Copyright (c) 2013, Arik Baratz
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+###
+
+"""
+The meeting minutes: a text file per meeting, appended to as the meeting
+proceeds so that it is already complete when the meeting adjourns.  Lines
+are buffered and only written out and synced to disk every so often.
+"""
+
+import os
+import threading
+
+def _start(meeting, payload):
+    return "Meeting started: %s" % meeting['name']
+
+def _adjourn(meeting, payload):
+    return "Meeting adjourned: %s" % meeting['name']
+
+def _agenda_next(meeting, payload):
+    return "Agenda item %d: %s" % (payload['item'],
+                                   meeting['agenda'][payload['item'] - 1])
+
+def _motion_add(meeting, payload):
+    return "Motion %d proposed: %s" % (len(meeting['motions']), payload['text'])
+
+def _motion_amend(meeting, payload):
+    return "Motion %d amended: %s" % (payload['item'], payload['text'])
+
+def _vote_start(meeting, payload):
+    if payload.get('secret'):
+        return "Secret voting opened on motion %d" % payload['item']
+    return "Voting opened on motion %d" % payload['item']
+
+def _vote_end(meeting, payload):
+    if payload.get('carries', payload['aye'] > payload['nay']):
+        decision = "carries"
+    else:
+        decision = "is dismissed"
+    return "Motion %d %s - %d aye | %d nay | %d abstained" % (
+        payload['item'], decision, payload['aye'], payload['nay'],
+        payload['abstain'])
+
+def _election_end(meeting, payload):
+    return "Election closed - %d ballots - elected: %s" % (
+        payload['ballots'], ", ".join(payload['elected']) or "nobody")
+
+LINES = {
+    'start': _start,
+    'adjourn': _adjourn,
+    'agenda_next': _agenda_next,
+    'motion_add': _motion_add,
+    'motion_amend': _motion_amend,
+    'vote_start': _vote_start,
+    'vote_end': _vote_end,
+    'election_end': _election_end,
+}
+
+def minutes_line(kind, payload, meeting, at):
+    """returns the minutes line of an event, or None if it isn't minuted.
+    meeting is the state of the meeting after the event"""
+    if kind not in LINES:
+        return None
+    return "[%s] %s\n" % (at, LINES[kind](meeting, payload))
+
+def tail(filename, lines, block_size=4096):
+    """returns the last lines of a file, reading only as much of its end as
+    they take up"""
+    with open(filename, 'rb') as fd:
+        fd.seek(0, os.SEEK_END)
+        end = fd.tell()
+        data = b''
+        while end > 0 and data.count(b'\n') <= lines:
+            step = min(block_size, end)
+            end -= step
+            fd.seek(end)
+            data = fd.read(step) + data
+    if not isinstance(data, str):
+        data = data.decode('utf-8', 'replace')
+    return data.splitlines()[-lines:]
+
+class MinutesWriter(object):
+    """buffered appends to the minutes files of the meetings in progress"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._files = {}
+        # files appended to since they were last synced
+        self._unsynced = set()
+
+    def append(self, filename, line):
+        """append a line, returns True if it is the first one since the
+        last sync"""
+        with self._lock:
+            fd = self._files.get(filename)
+            if fd is None:
+                fd = self._files[filename] = open(filename, 'a')
+            fd.write(line)
+            first = not self._unsynced
+            self._unsynced.add(filename)
+            return first
+
+    def flush(self, filename):
+        """write out the buffered lines of a file, so that they can be read"""
+        with self._lock:
+            fd = self._files.get(filename)
+            if fd is not None:
+                fd.flush()
+
+    def sync(self):
+        """write out and sync to disk everything appended since the last
+        sync"""
+        with self._lock:
+            for filename in self._unsynced:
+                fd = self._files[filename]
+                fd.flush()
+                os.fsync(fd.fileno())
+            self._unsynced.clear()
+
+    def close(self, filename):
+        """sync and close a file, for a meeting that adjourned"""
+        with self._lock:
+            fd = self._files.pop(filename, None)
+            if fd is None:
+                return
+            fd.flush()
+            os.fsync(fd.fileno())
+            fd.close()
+            self._unsynced.discard(filename)
+
+    def close_all(self):
+        self.sync()
+        for filename in list(self._files):
+            self.close(filename)
+
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
@@ -29,21 +29,223 @@
 ###
 
 import os
+import glob
+import hmac
+import json
+import hashlib
+import Queue
 import sqlite3
+import threading
+import time
 import collections
 
+import supybot.log as log
+import supybot.conf as conf
 import supybot.utils as utils
+import supybot.schedule as schedule
+import supybot.world as world
+import supybot.ircdb as ircdb
 from supybot.commands import *
 import supybot.plugins as plugins
 import supybot.ircutils as ircutils
 import supybot.callbacks as callbacks
 import supybot.ircmsgs as ircmsgs
 
-meeting_singleton = None
+import events
+import active
+import status
+import announce
+import minutes
+import weights
+
+try:
+    import supybot.httpserver as httpserver
+except ImportError:
+    # only newer bots have the built-in HTTP server
+    httpserver = None
 
 VALID_VOTE = ['aye', 'nay', 'abstain']
 
-class Meeting(callbacks.Plugin, plugins.ChannelDBHandler):
+TIMESTAMP_FORMATS = ['%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M',
+                     '%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M', '%Y-%m-%d']
+TIME_FORMATS = ['%H:%M:%S', '%H:%M']
+
+def parse_timestamp(text):
+    """returns the text as an sqlite UTC timestamp, or None if it isn't one"""
+    text = text.strip()
+    for fmt in TIMESTAMP_FORMATS:
+        try:
+            parsed = time.strptime(text, fmt)
+        except ValueError:
+            continue
+        return time.strftime('%Y-%m-%d %H:%M:%S', parsed)
+    for fmt in TIME_FORMATS:
+        try:
+            parsed = time.strptime(text, fmt)
+        except ValueError:
+            continue
+        return "%s %s" % (time.strftime('%Y-%m-%d', time.gmtime()),
+                          time.strftime('%H:%M:%S', parsed))
+    return None
+
+class WorkerPool(object):
+    """A small pool of daemon threads for heavy read-only commands, so that
+    a long listing doesn't block the bot's main loop.  on_exit is called on
+    each worker thread as it exits"""
+    def __init__(self, name, size, on_exit=None):
+        self._tasks = Queue.Queue()
+        self._on_exit = on_exit
+        self._threads = []
+        for i in range(size):
+            thread = threading.Thread(target=self._run,
+                                      name="%s worker %d" % (name, i))
+            thread.setDaemon(True)
+            thread.start()
+            world.threadsSpawned += 1
+            self._threads.append(thread)
+
+    def submit(self, f, *args):
+        """queue f(*args) to be run on one of the worker threads"""
+        self._tasks.put((f, args))
+
+    def stop(self, timeout=10):
+        """ask the workers to exit once the queued tasks are done, and wait
+        up to timeout seconds for each; returns whether they all exited"""
+        for thread in self._threads:
+            self._tasks.put(None)
+        stopped = True
+        for thread in self._threads:
+            thread.join(timeout)
+            stopped = stopped and not thread.isAlive()
+        return stopped
+
+    def join(self):
+        """wait until the queued tasks are done"""
+        self._tasks.join()
+
+    def _run(self):
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                if self._on_exit is not None:
+                    try:
+                        self._on_exit()
+                    except Exception:
+                        log.exception("Meeting worker exit failed")
+                self._tasks.task_done()
+                return
+            f, args = task
+            try:
+                f(*args)
+            except Exception:
+                log.exception("Meeting worker task %r failed", f)
+            self._tasks.task_done()
+
+class BatchAbort(Exception):
+    """a command in a batch failed, everything it did is rolled back"""
+    pass
+
+class BatchDb(object):
+    """a channel database inside a batch: the batch runs in one transaction,
+    so the commits of the commands in it are held back until it succeeds"""
+    def __init__(self, db):
+        self.db = db
+        db.cursor().execute("BEGIN")
+
+    def cursor(self):
+        return self.db.cursor()
+
+    def commit(self):
+        pass
+
+class BatchIrc(callbacks.RichReplyMethods):
+    """stands in for the irc object of the commands in a batch, collecting
+    their replies; the first error aborts the batch"""
+    def __init__(self, irc):
+        self.irc = irc
+        self.replies = []
+
+    def reply(self, s, *args, **kwargs):
+        self.replies.append(s)
+
+    def error(self, s='', *args, **kwargs):
+        raise BatchAbort(s)
+
+    def __getattr__(self, name):
+        return getattr(self.irc, name)
+
+class Batch(object):
+    """what a batch has done so far, and what it holds back until commit"""
+    def __init__(self):
+        self.dbs = {}
+        self.announcements = []
+        self.minutes = []
+
+class SpeakerQueue(object):
+    """The hands raised during discussion of one agenda item, in order.
+    
+    Raising, lowering and taking the next hand are all O(1): a lowered hand
+    stays in the deque with a stale ticket, and is skipped when it comes up"""
+    def __init__(self, meeting_id, agenda_item):
+        self.meeting_id = meeting_id
+        self.agenda_item = agenda_item
+        self._queue = collections.deque()
+        # normalised nick -> ticket of the nick's entry in the queue
+        self._tickets = {}
+        self._ticket = 0
+
+    def __len__(self):
+        return len(self._tickets)
+
+    def raise_hand(self, nick):
+        """returns the nick's place in the queue, or None if already in it"""
+        lowered = ircutils.toLower(nick)
+        if lowered in self._tickets:
+            return None
+        self._ticket += 1
+        self._tickets[lowered] = self._ticket
+        self._queue.append((self._ticket, nick))
+        
+        # don't let lowered hands pile up
+        if len(self._queue) > 2 * len(self._tickets) + 32:
+            self._queue = collections.deque(self.waiting_entries())
+        return len(self._tickets)
+
+    def lower(self, nick):
+        """returns whether the nick had a hand raised"""
+        return self._tickets.pop(ircutils.toLower(nick), None) is not None
+
+    def next(self):
+        """returns the nick that gets the floor, or None if nobody is waiting"""
+        while self._queue:
+            ticket, nick = self._queue.popleft()
+            if self._tickets.get(ircutils.toLower(nick)) == ticket:
+                del self._tickets[ircutils.toLower(nick)]
+                return nick
+        return None
+
+    def waiting_entries(self):
+        """returns the live (ticket, nick) entries in order"""
+        return [(ticket, nick) for ticket, nick in self._queue
+                if self._tickets.get(ircutils.toLower(nick)) == ticket]
+
+    def waiting(self):
+        """returns the nicks waiting for the floor, in order"""
+        return [nick for ticket, nick in self.waiting_entries()]
+
+if httpserver is not None:
+    class MeetingHTTPCallback(httpserver.SupyHTTPServerCallback):
+        """serves the status of the active meetings as JSON"""
+        name = 'Meeting status'
+        defaultResponse = """This is the status of the active meetings."""
+
+        def __init__(self, snapshot):
+            self._snapshot = snapshot
+
+        def doGet(self, handler, path):
+            status.respond(handler, self._snapshot)
+
+class Meeting(callbacks.Plugin):
     """This plugin deals with these entities:
     
     Meetings - the scope of the meeting containing agenda items and motions, and participants.
@@ -52,31 +254,251 @@ class Meeting(callbacks.Plugin, plugins.ChannelDBHandler):
     
     list this module to see the different options"""
     def __init__(self, irc):
-        global meeting_singleton
         #self.__parent = super(Meeting, self)
         #self.__parent.__init__(irc)
         callbacks.Plugin.__init__(self, irc)
-        plugins.ChannelDBHandler.__init__(self)
+        
+        # all meeting state is keyed by (network, channel), so the same
+        # channel name on two networks gets two separate meetings
+        
+        # main loop database connections
+        self._dbs = {}
         
         # cache channel vote results and verify uniqueness
         self._voter_decision = {}
         
-        # keep a reference to the singleton so that we can reference it from sub commands
-        meeting_singleton = self
+        # the ballot tokens of the eligible voters of each secret vote, and
+        # the secret votes each (network, identity) may vote in, so that a
+        # private ballot is routed without searching every channel; voters
+        # are known by hostmask, so a nick change keeps the ballot and
+        # whoever takes the nick over doesn't get it
+        self._secret = {}
+        self._secret_voters = {}
+        
+        # the flood guard of each channel with an open vote or election,
+        # and the pending apply of held back votes
+        self._flood = {}
+        self._flood_event = None
+        
+        # the voting weights and proxies of each channel, loaded when first
+        # needed
+        self._weights = {}
+        
+        # ranked ballots of the open election in each channel
+        self._ballots = {}
+        
+        # live channel state, rebuilt from the event log when first needed
+        self._states = {}
+        
+        # guards the vote cache and schema creation against other threads
+        self._lock = threading.RLock()
+        
+        # sqlite connections can't be shared between threads, so every
+        # thread other than the main loop keeps its own set
+        self._thread_dbs = threading.local()
+        
+        # the JSON status document, rebuilt when the state changes
+        self._status = status.StatusSnapshot(self._status_document, self._lock)
+        if httpserver is not None:
+            httpserver.hook('meeting', MeetingHTTPCallback(self._status))
+        
+        # speaker queues, and those changed since they were last written
+        self._hands = {}
+        self._dirty_hands = set()
+        self._hands_flush_event = None
+        
+        # the minutes files of meetings in progress, and the pending sync
+        self._minutes = minutes.MinutesWriter()
+        self._minutes_sync_event = None
+        
+        # per-network outbound announcement queues and their pending drains
+        self._announcers = {}
+        self._drain_events = {}
+        
+        # the batch command being run, if any
+        self._batch = None
+        
+        # heavy read-only commands are run here, off the main loop
+        self._workers = WorkerPool(self.name(),
+                                   self.registryValue('workerThreads'),
+                                   self._close_thread_dbs)
+        
+        # meetings in progress across all channels and networks; their
+        # channels are warmed up and the index is checked against the
+        # channel databases in the background
+        filename = conf.supybot.directories.data.dirize('%s.active.json' % self.name())
+        self._active = active.ActiveIndex(filename)
+        self._workers.submit(self._startup)
+        
+        # bind the sub commands to this instance
+        for cb in self.cbs:
+            cb._meeting = self
 
     def die(self):
         """so you're going to die"""
-        global meeting_singleton
+        if httpserver is not None:
+            httpserver.unhook('meeting')
+        if not self._workers.stop():
+            self.log.warning("Meeting workers still busy, their connections "
+                             "are left open")
+        for event_name in self._drain_events.values():
+            schedule.removeEvent(event_name)
+        if self._hands_flush_event is not None:
+            schedule.removeEvent(self._hands_flush_event)
+        self._flush_hands()
+        if self._minutes_sync_event is not None:
+            schedule.removeEvent(self._minutes_sync_event)
+        self._minutes.close_all()
+        if self._flood_event is not None:
+            schedule.removeEvent(self._flood_event)
+        for db in self._dbs.values():
+            db.close()
+        self._dbs.clear()
         
-        # allow efficient GC by removing the module level reference to the object
-        meeting_singleton = None
-        plugins.ChannelDBHandler.die(self)
+        # allow efficient GC by removing the sub commands' back references
+        for cb in self.cbs:
+            cb._meeting = None
         callbacks.Plugin.die(self)
 
-    def makeDb(self, filename):
+    def _key(self, irc, channel):
+        """returns the state key of a channel on the irc's network"""
+        return (irc.network, ircutils.toLower(channel))
+
+    def makeFilename(self, key):
+        network, channel = key
+        filename = plugins.makeChannelFilename('%s.%s.db' % (self.name(), network),
+                                               channel)
+        if not os.path.exists(filename):
+            # a channel's database used to be shared by all networks; the
+            # first network to use the channel takes the old one over
+            old = plugins.makeChannelFilename('%s.db' % self.name(), channel)
+            with self._lock:
+                if os.path.exists(old) and not os.path.exists(filename):
+                    self.log.info("Moving %s to %s", old, filename)
+                    for suffix in ('', '-wal', '-shm'):
+                        if os.path.exists(old + suffix):
+                            os.rename(old + suffix, filename + suffix)
+        return filename
+
+    def getDb(self, key):
+        """returns the channel database connection for the calling thread"""
+        if not world.isMainThread():
+            return self._snapshot_db(key)
+        dbs = self._dbs
+        if key not in dbs:
+            db = self.makeDb(self.makeFilename(key))
+            db.isolation_level = None
+            dbs[key] = db
+        if self._batch is not None:
+            if key not in self._batch.dbs:
+                self._batch.dbs[key] = BatchDb(dbs[key])
+            return self._batch.dbs[key]
+        return dbs[key]
+
+    def _snapshot_db(self, key):
+        """returns the worker thread's read-only connection to the channel
+        database.  the task's first query begins a read transaction, so the
+        whole task reads one consistent snapshot of the channel, and it
+        lasts until the task ends"""
+        # worker threads are long lived, so their connections are cached too
+        local = self._thread_dbs
+        dbs = local.__dict__.setdefault('dbs', {})
+        snapshots = local.__dict__.setdefault('snapshots', set())
+        if key not in dbs:
+            filename = self.makeFilename(key)
+            if key not in self._dbs:
+                # the schema is only created or upgraded through the main
+                # loop's connection, so that is opened first, as a warm up
+                # does
+                db = self.makeDb(filename, check_same_thread=False)
+                db.isolation_level = None
+                with self._lock:
+                    if key not in self._dbs:
+                        self._dbs[key] = db
+                        db = None
+                if db is not None:
+                    db.close()
+            db = sqlite3.connect(filename)
+            db.text_factory = str
+            db.isolation_level = None
+            db.cursor().execute("PRAGMA query_only=1")
+            dbs[key] = db
+        if key not in snapshots:
+            dbs[key].cursor().execute("BEGIN")
+            snapshots.add(key)
+        return dbs[key]
+
+    def _end_snapshots(self):
+        """end the read transactions of the worker task that just ran"""
+        local = self._thread_dbs
+        snapshots = local.__dict__.get('snapshots', ())
+        for key in snapshots:
+            local.dbs[key].cursor().execute("COMMIT")
+        local.snapshots = set()
+
+    def _close_thread_dbs(self):
+        """close the worker thread's connections, as it exits"""
+        self._end_snapshots()
+        for db in self._thread_dbs.__dict__.get('dbs', {}).values():
+            db.close()
+        self._thread_dbs.dbs = {}
+
+    def _run_in_worker(self, irc, f, *args):
+        """run a read-only command body on the worker pool"""
+        if self._batch is not None:
+            # it must see the batch's uncommitted changes, and reply in order
+            f(irc, *args)
+            return
+        def task():
+            try:
+                f(irc, *args)
+            except Exception as e:
+                self.log.exception("Meeting command %r failed", f)
+                irc.error(utils.exnToString(e))
+            finally:
+                self._end_snapshots()
+        self._workers.submit(task)
+
+    def _announce(self, irc, msg, priority=announce.NORMAL):
+        """queue an outbound announcement behind the network's rate limit"""
+        if self._batch is not None:
+            self._batch.announcements.append((irc, msg, priority))
+            return
+        irc = irc.getRealIrc()
+        queue = self._announcers.get(irc.network)
+        if queue is None:
+            bucket = announce.TokenBucket(self.registryValue('announceRate'),
+                                          self.registryValue('announceBurst'))
+            queue = announce.AnnounceQueue(bucket,
+                                           self.registryValue('announceMaxWait'))
+            self._announcers[irc.network] = queue
+        queue.put(msg.args[0], msg, priority)
+        self._drain_announcements(irc)
+
+    def _drain_announcements(self, irc):
+        """send what the rate limit allows, and come back for the rest"""
+        network = irc.network
+        queue = self._announcers[network]
+        queue.drain(irc.queueMsg)
+        
+        delay = queue.delay()
+        if delay is None or network in self._drain_events:
+            return
+        def drain():
+            del self._drain_events[network]
+            self._drain_announcements(irc)
+        self._drain_events[network] = schedule.addEvent(drain,
+                                                        time.time() + delay)
+
+    def makeDb(self, filename, check_same_thread=True):
+        # two threads opening a fresh channel must not both create the schema
+        with self._lock:
+            return self._make_db(filename, check_same_thread)
+
+    def _make_db(self, filename, check_same_thread=True):
         need_to_create = not os.path.exists(filename)
         
-        db = sqlite3.connect(filename)
+        db = sqlite3.connect(filename, check_same_thread=check_same_thread)
         db.text_factory = str
 
         if need_to_create:
@@ -132,11 +554,402 @@ class Meeting(callbacks.Plugin, plugins.ChannelDBHandler):
             
             db.commit()
 
+        self._upgrade_schema(db)
+
+        # in WAL mode readers see a snapshot and don't block the writer, so
+        # a long report on a worker never holds up a vote; the mode sticks
+        # to the file, so this only changes it once
+        try:
+            db.cursor().execute("PRAGMA journal_mode=WAL")
+        except sqlite3.OperationalError:
+            # another connection is busy, the next one will switch it
+            pass
+
         return db
 
-    def _get_current(self, channel, current_name):
+    def _upgrade_schema(self, db):
+        """add the tables introduced after the original schema"""
+        cursor = db.cursor()
+        cursor.execute("""SELECT name
+                          FROM sqlite_master
+                          WHERE type='table'""")
+        tables = set(row[0] for row in cursor.fetchall())
+
+        if 'event' not in tables:
+            # the append-only log of everything that happened in the channel
+            cursor.execute("""CREATE TABLE event (
+                                  id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                  at TIMESTAMP,
+                                  kind TEXT,
+                                  payload TEXT
+                              )""")
+            cursor.execute("""CREATE INDEX event_at
+                              ON event (at)""")
+            cursor.execute("""CREATE TABLE snapshot (
+                                  event_id INTEGER PRIMARY KEY,
+                                  state TEXT,
+                                  full BOOLEAN
+                              )""")
+            
+            # whatever happened before the log existed becomes snapshot zero
+            cursor.execute("""INSERT INTO snapshot
+                              VALUES (0, ?, 1)""",
+                              (json.dumps(events.import_state(db)), ))
+            db.commit()
+
+        cursor.execute("""PRAGMA table_info(snapshot)""")
+        if 'full' not in set(row[1] for row in cursor.fetchall()):
+            # which snapshots hold the whole state; of those stored before,
+            # the first does and the others are laid over it
+            cursor.execute("""ALTER TABLE snapshot
+                              ADD COLUMN full BOOLEAN""")
+            cursor.execute("""UPDATE snapshot
+                              SET full=(event_id=(SELECT min(event_id)
+                                                  FROM snapshot))""")
+            db.commit()
+
+        if 'election' not in tables:
+            # ranked-choice elections, with their ballots grouped by ranking
+            cursor.execute("""CREATE TABLE election (
+                                  id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                  meeting_id INTEGER,
+                                  seats INTEGER,
+                                  candidates TEXT,
+                                  vote_open BOOLEAN,
+                                  ballots INTEGER,
+                                  elected TEXT,
+                                  decision_at TIMESTAMP,
+                                  
+                                  FOREIGN KEY(meeting_id) REFERENCES meeting(id)
+                              )""")
+            cursor.execute("""CREATE TABLE ballot (
+                                  election_id INTEGER,
+                                  ranking BLOB,
+                                  count INTEGER,
+                                  
+                                  FOREIGN KEY(election_id) REFERENCES election(id)
+                              )""")
+            db.commit()
+
+        cursor.execute("""SELECT name
+                          FROM sqlite_master
+                          WHERE type='index'""")
+        indexes = set(row[0] for row in cursor.fetchall())
+
+        if 'motion_decision' not in indexes:
+            # the history commands seek through these, a page at a time
+            cursor.execute("""CREATE INDEX motion_decision
+                              ON motion (decision_at, carries)""")
+            cursor.execute("""CREATE INDEX meeting_start
+                              ON meeting (start_time)""")
+            db.commit()
+
+        if 'member_weight' not in tables:
+            # weighted and proxy voting
+            cursor.execute("""CREATE TABLE member_weight (
+                                  member TEXT PRIMARY KEY,
+                                  weight REAL
+                              )""")
+            cursor.execute("""CREATE TABLE proxy (
+                                  member TEXT PRIMARY KEY,
+                                  holder TEXT
+                              )""")
+            db.commit()
+
+        cursor.execute("""PRAGMA table_info(motion)""")
+        if 'weighted_aye' not in set(row[1] for row in cursor.fetchall()):
+            # the weighted totals, next to the raw counts
+            for vote in VALID_VOTE:
+                cursor.execute("""ALTER TABLE motion
+                                  ADD COLUMN weighted_%s REAL""" % vote)
+            db.commit()
+
+        if 'hand' not in tables:
+            # the speaker queue of the current agenda item
+            cursor.execute("""CREATE TABLE hand (
+                                  meeting_id INTEGER,
+                                  agenda_item INTEGER,
+                                  position INTEGER,
+                                  nick TEXT,
+                                  
+                                  FOREIGN KEY(meeting_id) REFERENCES meeting(id)
+                              )""")
+            db.commit()
+
+    def _get_hands(self, key, meeting_id):
+        """returns the speaker queue of the current agenda item"""
+        agenda_item = self._get_current(key, 'agenda')
+        queue = self._hands.get(key)
+        if queue is not None and (queue.meeting_id, queue.agenda_item) == (meeting_id, agenda_item):
+            return queue
+        
+        # a different item than the one in memory, it may have been saved
+        queue = SpeakerQueue(meeting_id, agenda_item)
+        db = self.getDb(key)
+        cursor = db.cursor()
+        cursor.execute("""SELECT nick
+                          FROM hand
+                          WHERE meeting_id=?
+                          AND agenda_item IS ?
+                          ORDER BY position ASC""", (meeting_id, agenda_item))
+        for (nick, ) in cursor.fetchall():
+            queue.raise_hand(nick)
+        self._hands[key] = queue
+        return queue
+
+    def _reset_hands(self, key, meeting_id, agenda_item):
+        """start an empty speaker queue for a new agenda item"""
+        self._hands[key] = SpeakerQueue(meeting_id, agenda_item)
+        self._hands_changed(key)
+
+    def _renumber_hands(self, key, meeting_id, agenda_item, new_item):
+        """carry the speaker queue of an agenda item over to the item's new
+        number, in memory and in the table; call it in the transaction that
+        renumbers the agenda"""
+        queue = self._hands.get(key)
+        if queue is not None and (queue.meeting_id, queue.agenda_item) == (meeting_id, agenda_item):
+            queue.agenda_item = new_item
+        cursor = self.getDb(key).cursor()
+        cursor.execute("""UPDATE hand
+                          SET agenda_item=?
+                          WHERE meeting_id=?
+                          AND agenda_item=?""", (new_item, meeting_id, agenda_item))
+
+    def _hands_changed(self, key):
+        """note a speaker queue change, to be written with the next batch"""
+        self._dirty_hands.add(key)
+        if self._hands_flush_event is None:
+            self._hands_flush_event = schedule.addEvent(self._flush_hands,
+                time.time() + self.registryValue('handFlushDelay'))
+
+    def _flush_hands(self):
+        """write the changed speaker queues, one transaction per channel"""
+        self._hands_flush_event = None
+        dirty, self._dirty_hands = self._dirty_hands, set()
+        for key in dirty:
+            queue = self._hands[key]
+            db = self.getDb(key)
+            cursor = db.cursor()
+            self._begin(db)
+            cursor.execute("""DELETE FROM hand
+                              WHERE meeting_id=?""", (queue.meeting_id, ))
+            cursor.executemany("""INSERT INTO hand
+                                  VALUES (?, ?, ?, ?)""",
+                               [(queue.meeting_id, queue.agenda_item, position, nick)
+                                for position, nick in enumerate(queue.waiting())])
+            db.commit()
+
+    def _get_weights(self, key):
+        """returns the channel's voting weights and proxies"""
+        table = self._weights.get(key)
+        if table is None:
+            table = weights.Weights.load(self.getDb(key))
+            with self._lock:
+                self._weights[key] = table
+        return table
+
+    def _get_state(self, key):
+        """returns the live state of the channel"""
+        state = self._states.get(key)
+        if state is None:
+            state, replayed = events.load_state(self.getDb(key))
+            if not world.isMainThread():
+                # a worker reads a snapshot, which may already be behind the
+                # main loop's writes; only the main loop's state is kept
+                return state
+            with self._lock:
+                self._states[key] = state
+                self._restore_votes(key, state)
+        return state
+
+    def _restore_votes(self, key, state):
+        """reopen the caches of a vote or election that was open when the
+        state was last in memory, call with the lock held.  the ballots cast
+        before then are lost, but it can be voted on and closed again"""
+        meeting_id = state['currents']['meeting']
+        if meeting_id is None:
+            return
+        meeting = state['meetings'][str(meeting_id)]
+        
+        # the current motion is only reset when a meeting starts, so it can
+        # be one of an earlier meeting with more motions
+        motion_item = state['currents']['motion']
+        motions = meeting['motions']
+        if (motion_item is not None and motion_item <= len(motions)
+            and key not in self._voter_decision):
+            motion = motions[motion_item - 1]
+            if motion['vote_open']:
+                self._voter_decision[key] = {}
+                if motion.get('secret'):
+                    # who could vote went with the old process
+                    self.log.warning("Secret vote in %s on %s reopened with no "
+                                     "eligible voters", key[1], key[0])
+                    self._start_secret(key, [])
+        
+        for election in meeting.get('elections', []):
+            if election['vote_open'] and key not in self._ballots:
+                self._ballots[key] = {'election_id': election['id'],
+                                      'meeting_id': meeting_id,
+                                      'seats': election['seats'],
+                                      'candidates': election['candidates'],
+                                      'rankings': {}}
+
+    def _startup(self):
+        """warm up the channels with meetings in progress, then check the
+        index of them against every channel database"""
+        for key, entry in self._active.entries():
+            filename = self.makeFilename(key)
+            if not os.path.exists(filename):
+                continue
+            try:
+                self._warm(key, filename)
+            except sqlite3.Error as e:
+                self.log.warning("Cannot warm up %s: %s", filename, e)
+        self._rescan_active()
+
+    def _warm(self, key, filename):
+        """open the main loop's connection to a channel database and load
+        the channel's state, so that its first command doesn't wait for
+        them and doPrivmsg takes votes at once"""
+        # made here, used only by the main loop once handed over
+        db = self.makeDb(filename, check_same_thread=False)
+        db.isolation_level = None
+        state, replayed = events.load_state(db)
+        with self._lock:
+            # the main loop may have got there first
+            if key not in self._dbs:
+                self._dbs[key] = db
+                db = None
+            if key not in self._states:
+                self._states[key] = state
+                self._restore_votes(key, state)
+                self._status.changed()
+                self._active.update(key, active.entry_from_state(state))
+        if db is not None:
+            db.close()
+
+    def _status_document(self):
+        """returns the active meetings with their agendas, motions and live
+        tallies, for the HTTP status endpoint"""
+        meetings = []
+        for key, state in sorted(self._states.items()):
+            meeting_id = state['currents']['meeting']
+            if meeting_id is None:
+                continue
+            meeting = state['meetings'][str(meeting_id)]
+            if meeting['end_time']:
+                continue
+            
+            # count the open vote, if there is one
+            tally = None
+            decisions = self._voter_decision.get(key)
+            if decisions is not None and key not in self._secret:
+                tally = dict((vote, 0) for vote in VALID_VOTE)
+                for vote in decisions.values():
+                    tally[vote] += 1
+            
+            # vote messages ignored so far
+            flood_counts = None
+            guard = self._flood.get(key)
+            if guard is not None:
+                flood_counts = {'shed': guard.shed, 'collapsed': guard.collapsed}
+            
+            network, channel = key
+            meetings.append({'network': network,
+                             'channel': channel,
+                             'id': meeting_id,
+                             'name': meeting['name'],
+                             'start_time': meeting['start_time'],
+                             'agenda': meeting['agenda'],
+                             'current_agenda_item': state['currents']['agenda'],
+                             'motions': meeting['motions'],
+                             'current_motion': state['currents']['motion'],
+                             'tally': tally,
+                             'flood': flood_counts})
+        return {'meetings': meetings}
+
+    def _channel_databases(self):
+        """returns the ((network, channel), filename) of every channel
+        database"""
+        databases = []
+        prefix, suffix = '%s.' % self.name(), '.db'
+        pattern = os.path.join(conf.supybot.directories.data(), '*',
+                               prefix + '*' + suffix)
+        for filename in glob.glob(pattern):
+            channel = os.path.basename(os.path.dirname(filename))
+            network = os.path.basename(filename)[len(prefix):-len(suffix)]
+            databases.append(((network, channel), filename))
+        return sorted(databases)
+
+    def _rescan_active(self):
+        """check the active meeting index against the channel databases"""
+        found = {}
+        for key, filename in self._channel_databases():
+            try:
+                found[key] = active.entry_from_db(filename)
+            except sqlite3.Error as e:
+                self.log.warning("Cannot check %s for active meetings: %s",
+                                 filename, e)
+        
+        for key in set(found) | set(self._active.keys()):
+            with self._lock:
+                # channels used since startup are already up to date
+                if key not in self._states:
+                    self._active.update(key, found.get(key))
+
+    def _record(self, key, kind, **payload):
+        """append an event to the channel's log and apply it to the live
+        state.  this is the last write of a command, and commits the
+        command's changes to the tables together with their event"""
+        state = self._get_state(key)
+        at = events.now()
+
+        db = self.getDb(key)
+        cursor = db.cursor()
+        cursor.execute("""INSERT INTO event
+                          VALUES (NULL, ?, ?, ?)""",
+                          (at, kind, json.dumps(payload)))
+        event_id = cursor.lastrowid
+        with self._lock:
+            events.apply_event(state, kind, payload, at)
+            self._status.changed()
+            self._active.update(key, active.entry_from_state(state))
+            line = minutes.minutes_line(kind, payload,
+                                        state['meetings'][str(payload['meeting_id'])], at)
+        if line is not None:
+            self._append_minutes(key, payload['meeting_id'], kind, line)
+
+        # snapshot every so often, so a rebuild only replays a short tail
+        if event_id % self.registryValue('snapshotInterval') == 0:
+            events.store_snapshot(db, state, event_id,
+                                  self.registryValue('fullSnapshotInterval'))
+        db.commit()
+
+    def _minutes_filename(self, key, meeting_id):
+        network, channel = key
+        return plugins.makeChannelFilename('%s.%s.minutes.%d.txt' % (self.name(), network, meeting_id),
+                                           channel)
+
+    def _append_minutes(self, key, meeting_id, kind, line):
+        """append a line to the meeting's minutes; lines are synced to disk
+        in batches, and the file is closed when the meeting adjourns"""
+        if self._batch is not None:
+            self._batch.minutes.append((key, meeting_id, kind, line))
+            return
+        filename = self._minutes_filename(key, meeting_id)
+        if self._minutes.append(filename, line) and self._minutes_sync_event is None:
+            self._minutes_sync_event = schedule.addEvent(self._sync_minutes,
+                time.time() + self.registryValue('minutesSyncDelay'))
+        if kind == 'adjourn':
+            self._minutes.close(filename)
+
+    def _sync_minutes(self):
+        self._minutes_sync_event = None
+        self._minutes.sync()
+
+    def _get_current(self, key, current_name):
         """returns the meeting ID or None if doesn't exist"""
-        db = self.getDb(channel)
+        db = self.getDb(key)
         cursor = db.cursor()
         cursor.execute("""SELECT value
                           FROM currents
@@ -147,62 +960,130 @@ class Meeting(callbacks.Plugin, plugins.ChannelDBHandler):
 
         return results[0][0]
 
-    def _set_current(self, channel, current_name, value):
-        """returns the meeting ID or None if doesn't exist"""
-        db = self.getDb(channel)
+    def _set_current(self, key, current_name, value):
+        """set a current pointer; it is committed with the command's event"""
+        db = self.getDb(key)
         cursor = db.cursor()
         cursor.execute("""UPDATE currents
                           SET value=?
                           WHERE name=?""", (value, current_name))
-        db.commit()
 
-    def _start_vote_cache(self, channel):
-        """initialise the voter decision cache"""
-        if channel in self._voter_decision:
-            return False
-        
-        # prepare the voter decision cache for the channel
-        self._voter_decision[channel] = {}
+    def _begin(self, db):
+        """start a transaction on a channel database, unless the command is
+        part of a batch, which already runs in one"""
+        if not isinstance(db, BatchDb):
+            cursor = db.cursor()
+            try:
+                cursor.execute("BEGIN")
+            except sqlite3.OperationalError:
+                # a command that failed halfway left its transaction open
+                cursor.execute("ROLLBACK")
+                cursor.execute("BEGIN")
+
+    def _start_vote_cache(self, key, voters=None):
+        """initialise the voter decision cache, a secret vote when the nicks
+        of the eligible voters are given"""
+        with self._lock:
+            if key in self._voter_decision:
+                return False
+            
+            # prepare the voter decision cache for the channel
+            self._voter_decision[key] = {}
+            if voters is not None:
+                self._start_secret(key, voters)
         
         # get the current meeting ID
-        meeting_id = self._get_current(channel, 'meeting')
+        meeting_id = self._get_current(key, 'meeting')
         if meeting_id is None:
             return False
         # get the motion order
-        motion_item_order = self._get_current(channel, 'motion')
+        motion_item_order = self._get_current(key, 'motion')
         if motion_item_order is None:
             return False
         # Get the database        
-        db = self.getDb(channel)
+        db = self.getDb(key)
         
         # get the motion ID from the database
         cursor = db.cursor()
         # update the motion
+        self._begin(db)
         cursor.execute("""UPDATE motion
                           SET vote_open=1
                           WHERE meeting_id=?
                           AND item_order=?""",
                           (meeting_id, motion_item_order))
 
-        db.commit()
+        if voters is None:
+            self._record(key, 'vote_start', meeting_id=meeting_id,
+                         item=motion_item_order)
+        else:
+            self._record(key, 'vote_start', meeting_id=meeting_id,
+                         item=motion_item_order, secret=True)
         return True
+
+    def _start_secret(self, key, voters):
+        """give every eligible voter, by hostmask, a ballot token; call with
+        the lock held.
+
+        a token is a hash of the voter's identity with a salt that is thrown
+        away straight after, so the stored ballots can't be linked to them"""
+        network = key[0]
+        salt = os.urandom(16)
+        tokens = {}
+        for hostmask in voters:
+            identity = weights.identity(hostmask)
+            tokens[identity] = hmac.new(salt, identity, hashlib.sha256).hexdigest()
+            self._secret_voters.setdefault((network, identity), set()).add(key)
+        self._secret[key] = tokens
+
+    def _end_secret(self, key):
+        """forget the tokens of a secret vote, call with the lock held"""
+        network = key[0]
+        for identity in self._secret.pop(key, {}):
+            keys = self._secret_voters.get((network, identity))
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._secret_voters[(network, identity)]
+
+    def _cast_secret(self, network, prefix, vote, channel=None):
+        """record a secret ballot sent by private message from the prefix.
+
+        returns (channel, None) when counted, or (None, error message)"""
+        identity = weights.identity(prefix)
+        with self._lock:
+            keys = self._secret_voters.get((network, identity))
+            if not keys:
+                return None, "You have no open secret vote"
+            if channel is None:
+                if len(keys) > 1:
+                    channels = sorted(key[1] for key in keys)
+                    return None, "You may vote in %s, please name the channel" % ", ".join(channels)
+                key = next(iter(keys))
+            else:
+                key = (network, ircutils.toLower(channel))
+                if key not in keys:
+                    return None, "You have no open secret vote in %s" % channel
+            token = self._secret[key][identity]
+            self._voter_decision[key][token] = vote
+            return key[1], None
         
 
-    def _end_vote_cache(self, channel):
+    def _end_vote_cache(self, key):
         """store the votes in the vote database"""
-        if not channel in self._voter_decision:
+        if not key in self._voter_decision:
             return
 
         # get the current meeting ID
-        meeting_id = self._get_current(channel, 'meeting')
+        meeting_id = self._get_current(key, 'meeting')
         if meeting_id is None:
             return
         # get the motion order
-        motion_item_order = self._get_current(channel, 'motion')
+        motion_item_order = self._get_current(key, 'motion')
         if motion_item_order is None:
             return
         # Get the database        
-        db = self.getDb(channel)
+        db = self.getDb(key)
         
         # get the motion ID from the database
         cursor = db.cursor()
@@ -215,38 +1096,70 @@ class Meeting(callbacks.Plugin, plugins.ChannelDBHandler):
             return
         motion_id = results[0][0]
         
-        # do it
+        # take the cache away from doPrivmsg before counting it
+        self._settle_flood(key)
+        with self._lock:
+            decisions = self._voter_decision.pop(key, None)
+            # a secret ballot's weight is that of the nick it was given to
+            identities = dict((token, identity) for identity, token in self._secret.get(key, {}).items())
+            self._end_secret(key)
+        if decisions is None:
+            return
+
+        # a member voting under two prefixes is counted once, with the last
+        # of their votes in voter order, in the raw counts and the weighted
+        # totals alike; a secret ballot is the member's it was given to
+        ballots = {}
+        for voter, vote in sorted(decisions.items()):
+            ballots[weights.identity(identities.get(voter, voter))] = (voter, vote)
+        identified = sorted((identity, vote) for identity, (voter, vote)
+                            in ballots.items())
+        decisions = sorted(ballots.values())
+
+        # do it, the votes and the decision in one transaction
         cursor = db.cursor()
+        self._begin(db)
         count = {}
         for vote in VALID_VOTE:
             count[vote] = 0
         
-        # insert the lines into the vote table
-        for voter, vote in self._voter_decision[channel].items():
-            cursor.execute("""INSERT INTO vote
+        # insert the lines into the vote table, in voter order so that the
+        # rows of a secret vote don't give away the order of the ballots
+        cursor.executemany("""INSERT INTO vote
                               VALUES (NULL, ?, ?, ?)""",
-                              (motion_id, voter, vote))
+                           [(motion_id, voter, vote) for voter, vote in decisions])
+        for voter, vote in decisions:
             count[vote] += 1
         
+        # weigh the votes, in one pass; the motion is decided by the weights
+        totals, members = self._get_weights(key).tally(identified)
+        weighted = dict((vote, totals.get(vote, 0.0)) for vote in VALID_VOTE)
+        carries = weighted['aye'] > weighted['nay']
+        
         # update the motion
         cursor.execute("""UPDATE motion
                           SET vote_open=0,
                               votes_aye=?,
                               votes_nay=?,
                               votes_abstain=?,
+                              weighted_aye=?,
+                              weighted_nay=?,
+                              weighted_abstain=?,
                               carries=?,
                               decision_at=datetime('now')
                           WHERE id=?""",
                           (count['aye'], count['nay'], count['abstain'],
-                           count['aye'] > count['nay'], motion_id))
+                           weighted['aye'], weighted['nay'], weighted['abstain'],
+                           carries, motion_id))
         
-        # done
-        db.commit()
-
-        # delete the local cache
-        del self._voter_decision[channel]
+        # done, the event commits it
+        self._record(key, 'vote_end', meeting_id=meeting_id,
+                     item=motion_item_order, aye=count['aye'],
+                     nay=count['nay'], abstain=count['abstain'],
+                     weighted=weighted, carries=carries)
 
-        return (count['aye'], count['nay'], count['abstain'])
+        return ((count['aye'], count['nay'], count['abstain']),
+                (weighted['aye'], weighted['nay'], weighted['abstain']))
 
     def doPrivmsg(self, irc, msg):
         """check regular IRC chat for votes"""
@@ -257,8 +1170,9 @@ class Meeting(callbacks.Plugin, plugins.ChannelDBHandler):
         if not irc.isChannel(channel):
             return
         
-        # is there an active vote in the channel?
-        if not (channel in self._voter_decision):
+        # is there an active vote or election in the channel?
+        key = self._key(irc, channel)
+        if not (key in self._voter_decision or key in self._ballots):
             return
         
         # get the text of the vote
@@ -267,34 +1181,105 @@ class Meeting(callbacks.Plugin, plugins.ChannelDBHandler):
         else:
             text = msg.args[1]
         
-        # is it a vote?
-        if not text in VALID_VOTE:
+        # is it a ranked ballot or a vote?  secret votes are only taken by
+        # private message
+        if not text.startswith('rank ') and (text not in VALID_VOTE or key in self._secret):
+            return
+        
+        # shed floods and hold back rapid changes of mind before doing any
+        # real work
+        guard = self._flood.get(key)
+        if guard is None:
+            with self._lock:
+                guard = self._flood.get(key)
+                if guard is None:
+                    import flood
+                    guard = self._flood[key] = flood.FloodGuard(self.registryValue('voteRate'),
+                                                                self.registryValue('voteBurst'),
+                                                                self.registryValue('voteDebounce'))
+        if guard.offer(msg.prefix, text) is None:
+            if self._flood_event is None and world.isMainThread():
+                self._schedule_flood(guard.next_due())
             return
         
-        # get the voter
-        voter = msg.prefix
+        self._apply_vote(key, msg.prefix, text)
 
-        # update the cache
-        self._voter_decision[channel][voter] = text
+    def _apply_vote(self, key, voter, text):
+        """put a vote or a ranked ballot in the cache"""
+        if text.startswith('rank '):
+            self._cast_ballot(key, voter, text.split()[1:])
+            return
+
+        # update the cache, unless the vote was closed in the meantime
+        with self._lock:
+            decisions = self._voter_decision.get(key)
+            if decisions is not None and decisions.get(voter) != text:
+                # every ballot shares the one string of its vote, rather
+                # than keeping the text of the message it came in
+                decisions[voter] = intern(text)
+                self._status.changed()
+
+    def _schedule_flood(self, when):
+        if when is not None:
+            self._flood_event = schedule.addEvent(self._apply_held_votes, when)
+
+    def _apply_held_votes(self):
+        """apply the held back votes whose debounce windows have closed"""
+        self._flood_event = None
+        next_due = []
+        for key, guard in list(self._flood.items()):
+            for voter, text in guard.due():
+                self._apply_vote(key, voter, text)
+            if guard.next_due() is not None:
+                next_due.append(guard.next_due())
+        if next_due:
+            self._schedule_flood(min(next_due))
+
+    def _settle_flood(self, key):
+        """apply the votes still held back in a channel whose vote or
+        election is closing, and retire its flood guard"""
+        with self._lock:
+            guard = self._flood.pop(key, None)
+        if guard is None:
+            return
+        for voter, text in guard.drain():
+            self._apply_vote(key, voter, text)
+        if guard.shed or guard.collapsed:
+            self.log.info("Meeting vote in %s on %s: %d messages shed, "
+                          "%d votes collapsed", key[1], key[0], guard.shed,
+                          guard.collapsed)
+
+    def _cast_ballot(self, key, voter, words):
+        """record a ranked ballot, the voter's last valid ballot counts"""
+        with self._lock:
+            election = self._ballots.get(key)
+            if election is None:
+                return
+            import tally
+            ranking = tally.parse_ranking(election['candidates'], words)
+            if ranking is not None:
+                election['rankings'][voter] = ranking
 
     def prepare(self, irc, msg, args, channel, meet_name):
         """[<channel>] <meeting name>
         
         Initialises a meeting
         """
+        key = self._key(irc, channel)
         
         # get the database
-        db = self.getDb(channel)
+        db = self.getDb(key)
 
-        # insert the new meeting
+        # insert the new meeting, and its event in the same transaction
         cursor = db.cursor()
+        self._begin(db)
         cursor.execute("""INSERT INTO meeting
                           VALUES (NULL, ?, NULL, NULL)""", (meet_name, ))
         meeting_id = cursor.lastrowid
-        db.commit()
 
         # set it as current
-        self._set_current(channel, 'meeting', meeting_id)
+        self._set_current(key, 'meeting', meeting_id)
+        self._record(key, 'prepare', meeting_id=meeting_id, name=meet_name)
 
         irc.reply("Meeting initialised, meeting id %d on channel %s" % (meeting_id, channel))
         
@@ -305,15 +1290,16 @@ class Meeting(callbacks.Plugin, plugins.ChannelDBHandler):
         
         Starts the meeting
         """
+        key = self._key(irc, channel)
 
         # get the meeting id
-        meeting_id = self._get_current(channel, 'meeting')
+        meeting_id = self._get_current(key, 'meeting')
         if meeting_id is None:
             irc.error("No active meeting on channel %s" % channel)
             return
 
         # get the database
-        db = self.getDb(channel)
+        db = self.getDb(key)
 
         # get the meeting details       
         cursor = db.cursor()
@@ -337,17 +1323,19 @@ class Meeting(callbacks.Plugin, plugins.ChannelDBHandler):
             return
         
         # mark the meeting as started
+        self._begin(db)
         cursor.execute("""UPDATE meeting
                           SET start_time=datetime('now')
                           WHERE id=? """, (meeting_id,))       
-        db.commit()
 
         # initialise the agenda and motion pointers
-        self._set_current(channel, 'agenda', None)
-        self._set_current(channel, 'motion', None)
+        self._set_current(key, 'agenda', None)
+        self._set_current(key, 'motion', None)
+        self._record(key, 'start', meeting_id=meeting_id)
 
-        irc.queueMsg(ircmsgs.topic(channel, meeting_name))
-        irc.reply("The meeting has started. Meeting topic: %s (meeting id %d)" % (meeting_name, meeting_id))
+        self._announce(irc, ircmsgs.topic(channel, meeting_name),
+                       announce.TOPIC)
+        self._announce(irc, ircmsgs.privmsg(channel, "The meeting has started. Meeting topic: %s (meeting id %d)" % (meeting_name, meeting_id)))
         
     start = wrap(start, ['channel'])
 
@@ -356,15 +1344,16 @@ class Meeting(callbacks.Plugin, plugins.ChannelDBHandler):
         
         Adjourns the meeting
         """
+        key = self._key(irc, channel)
 
         # get the meeting id
-        meeting_id = self._get_current(channel, 'meeting')        
+        meeting_id = self._get_current(key, 'meeting')        
         if meeting_id is None:
             irc.error("No active meeting on channel %s" % channel)
             return
 
         # get the database
-        db = self.getDb(channel)
+        db = self.getDb(key)
 
         # get the meeting details       
         cursor = db.cursor()
@@ -380,13 +1369,15 @@ class Meeting(callbacks.Plugin, plugins.ChannelDBHandler):
         meeting_name = results[0][0]
         
         # mark the meeting as ended
+        self._begin(db)
         cursor.execute("""UPDATE meeting
                           SET end_time=datetime('now')
                           WHERE id=? """, (meeting_id,))       
-        db.commit()
+        self._record(key, 'adjourn', meeting_id=meeting_id)
                 
-        irc.queueMsg(ircmsgs.topic(channel, meeting_name))
-        irc.reply("The meeting has adjourned. Meeting topic: %s (meeting id %d)" % (meeting_name, meeting_id))
+        self._announce(irc, ircmsgs.topic(channel, meeting_name),
+                       announce.TOPIC)
+        self._announce(irc, ircmsgs.privmsg(channel, "The meeting has adjourned. Meeting topic: %s (meeting id %d)" % (meeting_name, meeting_id)))
         
     adjourn = wrap(adjourn, ['channel'])
 
@@ -395,9 +1386,10 @@ class Meeting(callbacks.Plugin, plugins.ChannelDBHandler):
         
         Switch to a meeting with a given ID
         """
+        key = self._key(irc, channel)
 
         # get the database
-        db = self.getDb(channel)
+        db = self.getDb(key)
 
         # get the meeting details       
         cursor = db.cursor()
@@ -413,7 +1405,9 @@ class Meeting(callbacks.Plugin, plugins.ChannelDBHandler):
         meeting_name = results[0][0]
 
         # switch
-        self._set_current(channel, 'meeting', meeting_id)
+        self._begin(db)
+        self._set_current(key, 'meeting', meeting_id)
+        self._record(key, 'switch', meeting_id=meeting_id)
         
         irc.reply("Switched to meeting id %d, meeting name %s" % (meeting_id, meeting_name))
         
@@ -424,15 +1418,16 @@ class Meeting(callbacks.Plugin, plugins.ChannelDBHandler):
         
         Reply with the status of the current meeting
         """
+        key = self._key(irc, channel)
 
         # get the meeting id
-        meeting_id = self._get_current(channel, 'meeting')
+        meeting_id = self._get_current(key, 'meeting')
         if meeting_id is None:
             irc.reply("Channel %s does not have a current meeting" % channel)
             return
         
         # get the database
-        db = self.getDb(channel)
+        db = self.getDb(key)
 
         # get the meeting details       
         cursor = db.cursor()
@@ -457,6 +1452,400 @@ class Meeting(callbacks.Plugin, plugins.ChannelDBHandler):
         
     status = wrap(status, ['channel'])
 
+    def active(self, irc, msg, args):
+        """takes no arguments
+        
+        Lists the meetings in progress and the open votes on all channels and
+        networks
+        """
+        entries = self._active.entries()
+        if len(entries)==0:
+            irc.reply("There are no meetings in progress")
+            return
+        
+        meetings = []
+        for (network, channel), entry in entries:
+            if entry['vote'] is not None:
+                progress = "voting on motion %d" % entry['vote']
+            elif entry['started']:
+                progress = "in progress"
+            else:
+                progress = "not started"
+            meetings.append("%s %s: %s (id %d) %s" % (network, channel, entry['name'],
+                                                      entry['meeting_id'], progress))
+        irc.reply("; ".join(meetings))
+        
+    active = wrap(active, ['owner'])
+
+    def fsck(self, irc, msg, args, opts):
+        """[--repair]
+        
+        Checks every channel database for agenda items and motions out of
+        sequence, current items that don't exist, vote counts that don't
+        match the votes cast, and what deleted meetings and motions left
+        behind.  With --repair, fixes what it finds.
+        """
+        if 'repair' in dict(opts):
+            # repairs go through the main loop's connections, so that they
+            # are logged and the cached state is rebuilt after them
+            self._fsck(irc, repair=True)
+        else:
+            self._run_in_worker(irc, self._fsck)
+        
+    fsck = wrap(fsck, ['owner', getopts({'repair': ''})])
+
+    def _fsck(self, irc, repair=False):
+        """fsck body, run on a worker thread to check and on the main loop
+        to repair"""
+        import fsck
+        start = time.time()
+        databases = self._channel_databases()
+        damaged, failed = [], []
+        for (network, channel), filename in databases:
+            try:
+                if repair:
+                    problems = self._repair((network, channel))
+                else:
+                    problems = fsck.check_file(filename)
+            except sqlite3.Error as e:
+                failed.append("%s %s (%s)" % (network, channel, e))
+                continue
+            if problems:
+                damaged.append("%s %s: %s" % (network, channel, fsck.describe(problems)))
+        
+        reply = "Checked %d channel databases in %.2fs" % (len(databases),
+                                                          time.time() - start)
+        if len(damaged)==0:
+            reply += ", no problems found"
+        elif repair:
+            reply += ", repaired %s" % "; ".join(damaged)
+        else:
+            reply += ", found %s" % "; ".join(damaged)
+        if failed:
+            reply += ". Could not check %s" % "; ".join(failed)
+        irc.reply(reply)
+
+    def _repair(self, key):
+        """check a channel database and repair what is wrong in one
+        transaction with an event of the repair, whose snapshot is the state
+        rebuilt from the repaired tables.  returns [(check name, problems)]"""
+        # the speaker queues are written first, so none are lost with the cache
+        self._flush_hands()
+        before = self._get_state(key)
+        db = self.getDb(key)
+        cursor = db.cursor()
+        self._begin(db)
+        try:
+            import fsck
+            problems = fsck.check(db, repair=True)
+            if problems:
+                fsck.log_repair(db, problems, before)
+        except:
+            if not isinstance(db, BatchDb):
+                cursor.execute("ROLLBACK")
+            raise
+        db.commit()
+        if not problems:
+            return problems
+
+        # what was cached may be numbered as before the repair; the open
+        # vote is reopened empty, as after a restart
+        self._settle_flood(key)
+        with self._lock:
+            self._states.pop(key, None)
+            self._hands.pop(key, None)
+            self._dirty_hands.discard(key)
+            self._voter_decision.pop(key, None)
+            self._end_secret(key)
+        state = self._get_state(key)
+        with self._lock:
+            self._status.changed()
+            self._active.update(key, active.entry_from_state(state))
+        return problems
+
+    def asof(self, irc, msg, args, channel, timestamp):
+        """[<channel>] <timestamp>
+        
+        Reply with the state of the channel's meeting as it was at the given
+        UTC time (YYYY-MM-DD HH:MM[:SS], or HH:MM[:SS] for today)
+        """
+
+        timestamp = parse_timestamp(timestamp)
+        if timestamp is None:
+            irc.error("Cannot understand the time, try YYYY-MM-DD HH:MM:SS")
+            return
+        
+        self._run_in_worker(irc, self._asof, channel, timestamp)
+        
+    asof = wrap(asof, ['channel', 'text'])
+
+    def _asof(self, irc, channel, timestamp):
+        """asof body, run on a worker thread"""
+        key = self._key(irc, channel)
+
+        # rebuild from the nearest snapshot before the time
+        db = self.getDb(key)
+        event_id = events.last_event_before(db, timestamp)
+        state, replayed = events.load_state(db, event_id)
+        
+        meeting_id = state['currents']['meeting']
+        if meeting_id is None:
+            irc.reply("As of %s channel %s had no current meeting" % (timestamp, channel))
+            return
+        meeting = state['meetings'][str(meeting_id)]
+        
+        if meeting['end_time']:
+            progress = "adjourned"
+        elif meeting['start_time']:
+            progress = "in progress"
+        else:
+            progress = "not started"
+        parts = ["meeting %s (id %d) %s" % (meeting['name'], meeting_id, progress)]
+        
+        # the current agenda item is only reset when a meeting starts, so it
+        # can be one of an earlier meeting with more items
+        agenda_item = state['currents']['agenda']
+        if agenda_item is not None and 0 < agenda_item <= len(meeting['agenda']):
+            parts.append("agenda item %d of %d: %s" % (agenda_item, len(meeting['agenda']),
+                                                        meeting['agenda'][agenda_item - 1]))
+        
+        for item_order, motion in enumerate(meeting['motions']):
+            if motion['vote_open']:
+                decision = "voting"
+            elif motion['carries'] is None:
+                decision = "not voted"
+            elif motion['carries']:
+                decision = "carried %d:%d" % (motion['aye'], motion['nay'])
+            else:
+                decision = "dismissed %d:%d" % (motion['aye'], motion['nay'])
+            parts.append("motion %d %s" % (item_order + 1, decision))
+        
+        irc.reply("As of %s: %s" % (timestamp, "; ".join(parts)))
+
+    def _history_range(self, irc, opts):
+        """returns the (since, until) timestamps of the history options, or
+        None after replying with an error"""
+        bounds = []
+        # a timestamp, not '9999', which the column's numeric affinity would
+        # turn into a number that sorts before every timestamp
+        for name, default in (('since', ''), ('until', '9999-12-31 23:59:59')):
+            if name not in opts:
+                bounds.append(default)
+                continue
+            timestamp = parse_timestamp(opts[name])
+            if timestamp is None:
+                irc.error("Cannot understand --%s, try YYYY-MM-DD or YYYY-MM-DDTHH:MM" % name)
+                return None
+            bounds.append(timestamp)
+        return tuple(bounds)
+
+    def batch(self, irc, msg, args, text):
+        """<command>; <command>; ...
+        
+        Run several Meeting commands as one: their changes are made in one
+        transaction, and if any of them fails none of them take effect.
+        Replies are collected into one.
+        """
+        commands = [part.strip() for part in text.split(';') if part.strip()]
+        if not commands:
+            irc.error("There are no commands in the batch")
+            return
+        
+        # the queues are written outside of the batch's transaction
+        self._flush_hands()
+        
+        with self._lock:
+            saved = (dict(self._voter_decision), dict(self._ballots),
+                     dict(self._secret),
+                     dict((voter, set(keys)) for voter, keys in self._secret_voters.items()))
+        batch_irc = BatchIrc(irc)
+        batch = self._batch = Batch()
+        try:
+            for step, command_text in enumerate(commands):
+                try:
+                    self._batch_command(batch_irc, msg, command_text)
+                except BatchAbort as e:
+                    raise BatchAbort("step %d (%s) failed: %s" % (step + 1, command_text, e))
+        except BatchAbort as e:
+            self._batch = None
+            self._rollback_batch(batch, saved)
+            irc.error("Batch rolled back, %s" % e)
+            return
+        except Exception:
+            self._batch = None
+            self._rollback_batch(batch, saved)
+            raise
+        
+        self._batch = None
+        for db in batch.dbs.values():
+            db.cursor().execute("COMMIT")
+        for key, meeting_id, kind, line in batch.minutes:
+            self._append_minutes(key, meeting_id, kind, line)
+        for announcement in batch.announcements:
+            self._announce(*announcement)
+        
+        if batch_irc.replies:
+            irc.reply(" | ".join(batch_irc.replies))
+        else:
+            irc.replySuccess()
+        
+    batch = wrap(batch, ['text'])
+
+    def _batch_command(self, irc, msg, command_text):
+        """run one command of a batch, raises BatchAbort if it fails"""
+        args = callbacks.tokenize(command_text)
+        if len(args) > 1 and callbacks.canonicalName(args[0]) == self.canonicalName():
+            # "meeting motion add ..." names the plugin first
+            args = args[1:]
+        command = self.getCommand(args)
+        if not command or command == ['batch']:
+            raise BatchAbort("not a Meeting command")
+        # the capability check and callingCommand of the bot's _callCommand;
+        # its logging and its help on wrong arguments are left out.  each
+        # name of a nested command is checked, and a capability comes back
+        # when it is missing (True when only the default denies it)
+        for name in command:
+            capability = callbacks.checkCommandCapability(msg, self, name)
+            if capability:
+                if capability is True:
+                    capability = name
+                raise BatchAbort("you need the %s capability" % capability)
+        # the batch itself is the command being called around this one
+        calling = self.callingCommand
+        try:
+            self.callingCommand = command
+            self.callCommand(command, irc, msg, args[len(command):])
+        except callbacks.ArgumentError:
+            raise BatchAbort("wrong arguments")
+        except callbacks.Error as e:
+            raise BatchAbort(str(e))
+        finally:
+            self.callingCommand = calling
+
+    def _rollback_batch(self, batch, saved):
+        """undo a failed batch: the database changes are rolled back and the
+        live state is rebuilt from what was committed"""
+        for db in batch.dbs.values():
+            db.cursor().execute("ROLLBACK")
+        with self._lock:
+            (self._voter_decision, self._ballots, self._secret,
+             self._secret_voters) = saved
+            for key in batch.dbs:
+                self._states.pop(key, None)
+                self._weights.pop(key, None)
+                self._hands.pop(key, None)
+                self._dirty_hands.discard(key)
+        for key in batch.dbs:
+            state = self._get_state(key)
+            with self._lock:
+                self._status.changed()
+                self._active.update(key, active.entry_from_state(state))
+
+    def history(self, irc, msg, args, channel, opts):
+        """[<channel>] [--since <timestamp>] [--until <timestamp>] [--after <meeting id>]
+        
+        List the channel's meetings by start time, a page at a time.  Times are
+        UTC, YYYY-MM-DD or YYYY-MM-DDTHH:MM; --until is not included.  Use
+        --after with the last meeting ID listed to get the next page.
+        """
+        opts = dict(opts)
+        bounds = self._history_range(irc, opts)
+        if bounds is None:
+            return
+        
+        self._run_in_worker(irc, self._history, channel, bounds, opts.get('after'))
+        
+    history = wrap(history, ['channel', getopts({'since': 'something',
+                                                 'until': 'something',
+                                                 'after': 'positiveInt'})])
+
+    def _history(self, irc, channel, bounds, after):
+        """history body, run on a worker thread"""
+        key = self._key(irc, channel)
+        since, until = bounds
+        page_size = self.registryValue('historyPageSize')
+        
+        # get the database
+        db = self.getDb(key)
+        cursor = db.cursor()
+        
+        # seek past the last meeting of the previous page rather than
+        # counting an OFFSET through every meeting before it
+        cursor_time, cursor_id = since, 0
+        if after is not None:
+            cursor.execute("""SELECT start_time
+                              FROM meeting
+                              WHERE id=?""", (after, ))
+            results = cursor.fetchall()
+            if len(results) == 0 or results[0][0] is None:
+                irc.error("There is no started meeting %d in channel %s" % (after, channel))
+                return
+            if results[0][0] >= since:
+                cursor_time, cursor_id = results[0][0], after
+        
+        cursor.execute("""SELECT id, start_time
+                          FROM meeting
+                          WHERE start_time>=?
+                          AND start_time<?
+                          AND (start_time>? OR id>?)
+                          ORDER BY start_time, id
+                          LIMIT ?""",
+                          (cursor_time, until, cursor_time, cursor_id,
+                           page_size + 1))
+        page = cursor.fetchall()
+        if len(page) == 0:
+            irc.reply("No meetings in channel %s" % channel)
+            return
+        
+        # the names are only read for the meetings on the page
+        more = len(page) > page_size
+        page = page[:page_size]
+        cursor.execute("""SELECT id, name, end_time
+                          FROM meeting
+                          WHERE id IN (%s)""" % ",".join("?" * len(page)),
+                          [meeting_id for meeting_id, start_time in page])
+        details = dict((row[0], row[1:]) for row in cursor.fetchall())
+        
+        parts = []
+        for meeting_id, start_time in page:
+            name, end_time = details[meeting_id]
+            parts.append("#%d %s %s%s" % (meeting_id, start_time[:16], name,
+                                          "" if end_time else " (in progress)"))
+        if more:
+            parts.append("more with --after %d" % page[-1][0])
+        irc.reply(" | ".join(parts))
+
+    class minutes(callbacks.Commands):
+
+        def tail(self, irc, msg, args, channel, lines):
+            """[<channel>] [<lines>]
+            
+            Show the last lines (default 5, at most 50) of the current meeting's
+            minutes
+            """
+            key = self._meeting._key(irc, channel)
+
+            # get the current meeting ID
+            meeting_id = self._meeting._get_current(key, 'meeting')
+            if meeting_id is None:
+                irc.error("There is no current meeting in channel %s" % channel)
+                return
+
+            # let the worker see the lines still in the buffer
+            filename = self._meeting._minutes_filename(key, meeting_id)
+            self._meeting._minutes.flush(filename)
+            self._meeting._run_in_worker(irc, self._tail, channel, meeting_id,
+                                         filename, min(lines, 50))
+
+        tail = wrap(tail, ['channel', optional('positiveInt', 5)])
+
+        def _tail(self, irc, channel, meeting_id, filename, lines):
+            """minutes tail body, run on a worker thread"""
+            if not os.path.exists(filename):
+                irc.reply("Meeting %d has no minutes yet" % meeting_id)
+                return
+            irc.reply(" | ".join(minutes.tail(filename, lines)))
+
     class agenda(callbacks.Commands):
         
         def get_max_item_order(self, db, meeting_id):
@@ -478,27 +1867,30 @@ class Meeting(callbacks.Plugin, plugins.ChannelDBHandler):
             
             Add an agenda item to the end of the agenda
             """
+            key = self._meeting._key(irc, channel)
 
             # get the current meeting ID
-            meeting_id = meeting_singleton._get_current(channel, 'meeting')
+            meeting_id = self._meeting._get_current(key, 'meeting')
             if meeting_id is None:
                 irc.error("There is no current meeting in channel %s" % channel)
                 return
 
             # get the database
-            db = meeting_singleton.getDb(channel)
+            db = self._meeting.getDb(key)
             
             # figure out the highest agenda item id used so far
             agenda_item_order = self.get_max_item_order(db, meeting_id) + 1
             
             # insert the new item
             cursor = db.cursor()
+            self._meeting._begin(db)
             cursor.execute("""INSERT INTO agenda
                               VALUES (NULL, ?, ?, ?)""",
                               (meeting_id, agenda_item_order, agenda_text))
-            db.commit()
             
-            meeting_singleton._set_current(channel, 'agenda', agenda_item_order)
+            self._meeting._set_current(key, 'agenda', agenda_item_order)
+            self._meeting._record(key, 'agenda_add', meeting_id=meeting_id,
+                                  text=agenda_text)
             
             irc.reply("Agenda item %d added to the current meeting" % agenda_item_order)
                 
@@ -509,14 +1901,22 @@ class Meeting(callbacks.Plugin, plugins.ChannelDBHandler):
             
             List the agenda for the current meeting in the channel
             """
+            self._meeting._run_in_worker(irc, self._list, channel)
+            
+        list = wrap(list, ['channel'])
+
+        def _list(self, irc, channel):
+            """agenda list body, run on a worker thread"""
+            key = self._meeting._key(irc, channel)
+
             # get the current meeting ID
-            meeting_id = meeting_singleton._get_current(channel, 'meeting')
+            meeting_id = self._meeting._get_current(key, 'meeting')
             if meeting_id is None:
                 irc.error("There is no current meeting in channel %s" % channel)
                 return
 
             # get the database
-            db = meeting_singleton.getDb(channel)
+            db = self._meeting.getDb(key)
 
             # get the agenda items
             cursor = db.cursor()            
@@ -533,23 +1933,22 @@ class Meeting(callbacks.Plugin, plugins.ChannelDBHandler):
             
             for item_order, item_text in results:
                 irc.reply("Item %d: %s" % (item_order, item_text))
-            
-        list = wrap(list, ['channel'])
 
         def delete(self, irc, msg, args, channel, item_id):
             """[<channel>] <item_id>
             
             Delete an item from the agenda, renumbering following items
             """
+            key = self._meeting._key(irc, channel)
             
             # get the current meeting ID
-            meeting_id = meeting_singleton._get_current(channel, 'meeting')
+            meeting_id = self._meeting._get_current(key, 'meeting')
             if meeting_id is None:
                 irc.error("There is no current meeting in channel %s" % channel)
                 return
 
             # get the database
-            db = meeting_singleton.getDb(channel)
+            db = self._meeting.getDb(key)
 
             # see how many we have now
             total_items = self.get_max_item_order(db, meeting_id)
@@ -559,30 +1958,40 @@ class Meeting(callbacks.Plugin, plugins.ChannelDBHandler):
                 irc.error("Cannot delete non-existent item %d" % item_id)
                 return
                 
-            # do the delete
+            current_agenda = self._meeting._get_current(key, 'agenda')
+
+            # the delete, the renumbering and the current item change in one
+            # transaction
             cursor = db.cursor()
+            self._meeting._begin(db)
+
+            # do the delete
             cursor.execute("""DELETE FROM agenda
                               WHERE meeting_id=?
                               AND item_order=?""", (meeting_id, item_id))
             
             # renumber the rest of the items
-            for item in range(item_id+1, total_items+1):
-                cursor.execute("""UPDATE agenda
-                                  SET item_order=?
-                                  WHERE meeting_id=?
-                                  AND item_order=?""", (item-1, meeting_id, item))
-                
-            db.commit()
+            cursor.execute("""UPDATE agenda
+                              SET item_order=item_order-1
+                              WHERE meeting_id=?
+                              AND item_order>?""", (meeting_id, item_id))
             
             # handle current item
             if total_items == 1:
                 # no more agenda items
-                meeting_singleton._set_current(channel, 'agenda', None)
-            else:
-                current_agenda = meeting_singleton._get_current(channel, 'agenda')
-                # was it among the items that were shifted down?
-                if current_agenda > item_id:
-                    meeting_singleton._set_current(channel, 'agenda', current_agenda - 1)
+                current_agenda = None
+            elif current_agenda > item_id:
+                # it was among the items that were shifted down, its speaker
+                # queue goes along
+                current_agenda -= 1
+                self._meeting._renumber_hands(key, meeting_id, current_agenda + 1,
+                                              current_agenda)
+            cursor.execute("""UPDATE currents
+                              SET value=?
+                              WHERE name='agenda'""", (current_agenda, ))
+                
+            self._meeting._record(key, 'agenda_delete', meeting_id=meeting_id,
+                                  item=item_id)
             
             irc.reply("Agenda item %d has been deleted" % item_id)
             
@@ -593,15 +2002,16 @@ class Meeting(callbacks.Plugin, plugins.ChannelDBHandler):
             
             Progresses the agenda to the next item
             """
+            key = self._meeting._key(irc, channel)
             
             # get the current meeting ID
-            meeting_id = meeting_singleton._get_current(channel, 'meeting')
+            meeting_id = self._meeting._get_current(key, 'meeting')
             if meeting_id is None:
                 irc.error("There is no current meeting in channel %s" % channel)
                 return
 
             # get the database
-            db = meeting_singleton.getDb(channel)
+            db = self._meeting.getDb(key)
 
             # see how many we have now
             total_items = self.get_max_item_order(db, meeting_id)
@@ -610,7 +2020,7 @@ class Meeting(callbacks.Plugin, plugins.ChannelDBHandler):
                 return
             
             # check current item
-            current_item = meeting_singleton._get_current(channel, 'agenda')
+            current_item = self._meeting._get_current(key, 'agenda')
             
             if current_item == total_items:
                 irc.reply("No more items on the agenda for the current meeting")
@@ -623,7 +2033,11 @@ class Meeting(callbacks.Plugin, plugins.ChannelDBHandler):
                 current_item += 1
 
             # set the new value
-            meeting_singleton._set_current(channel, 'agenda', current_item)
+            self._meeting._begin(db)
+            self._meeting._set_current(key, 'agenda', current_item)
+            self._meeting._record(key, 'agenda_next', meeting_id=meeting_id,
+                                  item=current_item)
+            self._meeting._reset_hands(key, meeting_id, current_item)
 
             # get the agenda item
             cursor = db.cursor()            
@@ -639,7 +2053,8 @@ class Meeting(callbacks.Plugin, plugins.ChannelDBHandler):
 
             # display
             item_order, item_text = results[0]
-            irc.reply("Current agenda item no. %d: %s" % (item_order, item_text)) 
+            self._meeting._announce(irc, ircmsgs.privmsg(channel, "Current agenda item no. %d: %s" % (item_order, item_text)),
+                                    announce.NORMAL)
             
         next = wrap(next, ['channel'])
 
@@ -664,28 +2079,31 @@ class Meeting(callbacks.Plugin, plugins.ChannelDBHandler):
             
             Add a motion
             """
+            key = self._meeting._key(irc, channel)
 
             # get the current meeting ID
-            meeting_id = meeting_singleton._get_current(channel, 'meeting')
+            meeting_id = self._meeting._get_current(key, 'meeting')
             if meeting_id is None:
                 irc.error("There is no current meeting in channel %s" % channel)
                 return
 
             # get the database
-            db = meeting_singleton.getDb(channel)
+            db = self._meeting.getDb(key)
             
             # figure out the highest motion item id used so far
             motion_item_order = self.get_max_item_order(db, meeting_id) + 1
             
             # insert the new item
             cursor = db.cursor()
-            cursor.execute("""INSERT INTO motion
-                              VALUES (NULL, ?, ?, ?, 0,
-                              NULL, NULL, NULL, NULL, NULL)""",
+            self._meeting._begin(db)
+            cursor.execute("""INSERT INTO motion (meeting_id, item_order,
+                                                  motion_text, vote_open)
+                              VALUES (?, ?, ?, 0)""",
                               (meeting_id, motion_item_order, motion_text))
-            db.commit()
 
-            meeting_singleton._set_current(channel, 'motion', motion_item_order)
+            self._meeting._set_current(key, 'motion', motion_item_order)
+            self._meeting._record(key, 'motion_add', meeting_id=meeting_id,
+                                  text=motion_text)
             
             irc.reply("Motion %d added to the current meeting" % motion_item_order)
                 
@@ -696,21 +2114,22 @@ class Meeting(callbacks.Plugin, plugins.ChannelDBHandler):
             
             Modify the current motion
             """
+            key = self._meeting._key(irc, channel)
 
             # get the current meeting ID
-            meeting_id = meeting_singleton._get_current(channel, 'meeting')
+            meeting_id = self._meeting._get_current(key, 'meeting')
             if meeting_id is None:
                 irc.error("There is no current meeting in channel %s" % channel)
                 return
 
             # get the current motion
-            motion_order = meeting_singleton._get_current(channel, 'motion')
+            motion_order = self._meeting._get_current(key, 'motion')
             if motion_order is None:
                 irc.error("There is no current motion in the current meeting")
                 return
 
             # get the database
-            db = meeting_singleton.getDb(channel)
+            db = self._meeting.getDb(key)
             
             # check that the motion has not yet been decided
             cursor = db.cursor()
@@ -728,13 +2147,15 @@ class Meeting(callbacks.Plugin, plugins.ChannelDBHandler):
             
             # update the motion
             cursor = db.cursor()
+            self._meeting._begin(db)
             cursor.execute("""UPDATE motion
                               SET motion_text=?
                               WHERE meeting_id=?
-                              AND item_order=?""", (meeting_id, motion_order))
-            db.commit()
+                              AND item_order=?""", (motion_text, meeting_id, motion_order))
+            self._meeting._record(key, 'motion_amend', meeting_id=meeting_id,
+                                  item=motion_order, text=motion_text)
 
-            irc.reply("Motion %d has been amended as requested." % motion_item_order)
+            irc.reply("Motion %d has been amended as requested." % motion_order)
                 
         amend = wrap(amend, ['channel', 'text'])
 
@@ -744,14 +2165,22 @@ class Meeting(callbacks.Plugin, plugins.ChannelDBHandler):
             
             List the motions for the current meeting in the channel
             """
+            self._meeting._run_in_worker(irc, self._list, channel)
+            
+        list = wrap(list, ['channel'])
+
+        def _list(self, irc, channel):
+            """motion list body, run on a worker thread"""
+            key = self._meeting._key(irc, channel)
+
             # get the current meeting ID
-            meeting_id = meeting_singleton._get_current(channel, 'meeting')
+            meeting_id = self._meeting._get_current(key, 'meeting')
             if meeting_id is None:
                 irc.error("There is no current meeting in channel %s" % channel)
                 return
 
             # get the database
-            db = meeting_singleton.getDb(channel)
+            db = self._meeting.getDb(key)
 
             # get the motion items
             cursor = db.cursor()            
@@ -775,8 +2204,100 @@ class Meeting(callbacks.Plugin, plugins.ChannelDBHandler):
                 else:
                     carries_text = "Motion dismissed, votes %d:%d" % (aye, nay)
                 irc.reply("Motion %d: %s - %s" % (item_order, motion_text, carries_text))
+
+        def history(self, irc, msg, args, channel, opts):
+            """[<channel>] [--carried|--failed] [--since <timestamp>] [--until <timestamp>] [--after <motion id>]
             
-        list = wrap(list, ['channel'])
+            List the motions decided in the channel across all meetings, by
+            decision time, a page at a time.  Times are UTC, YYYY-MM-DD or
+            YYYY-MM-DDTHH:MM; --until is not included.  Use --after with the last
+            motion ID listed to get the next page.
+            """
+            opts = dict(opts)
+            if 'carried' in opts and 'failed' in opts:
+                irc.error("Use either --carried or --failed")
+                return
+            bounds = self._meeting._history_range(irc, opts)
+            if bounds is None:
+                return
+            carries = None
+            if 'carried' in opts:
+                carries = True
+            elif 'failed' in opts:
+                carries = False
+            
+            self._meeting._run_in_worker(irc, self._history, channel, bounds,
+                                         carries, opts.get('after'))
+            
+        history = wrap(history, ['channel', getopts({'carried': '',
+                                                     'failed': '',
+                                                     'since': 'something',
+                                                     'until': 'something',
+                                                     'after': 'positiveInt'})])
+
+        def _history(self, irc, channel, bounds, carries, after):
+            """motion history body, run on a worker thread"""
+            key = self._meeting._key(irc, channel)
+            since, until = bounds
+            page_size = self._meeting.registryValue('historyPageSize')
+
+            # get the database
+            db = self._meeting.getDb(key)
+            cursor = db.cursor()
+
+            # seek past the last motion of the previous page, in the order of
+            # the motion_decision index, rather than counting an OFFSET
+            cursor_at, cursor_carries, cursor_id = since, -1, 0
+            if after is not None:
+                cursor.execute("""SELECT decision_at, carries
+                                  FROM motion
+                                  WHERE id=?""", (after, ))
+                results = cursor.fetchall()
+                if len(results) == 0 or results[0][0] is None:
+                    irc.error("There is no decided motion %d in channel %s" % (after, channel))
+                    return
+                if results[0][0] >= since:
+                    cursor_at, cursor_carries, cursor_id = results[0][0], results[0][1], after
+
+            query = """SELECT motion.id, motion.decision_at, motion.carries,
+                              motion.votes_aye, motion.votes_nay,
+                              motion.motion_text, meeting.name
+                       FROM motion
+                       JOIN meeting
+                       ON meeting.id=motion.meeting_id
+                       WHERE motion.decision_at>=?
+                       AND motion.decision_at<?
+                       AND (motion.decision_at>?
+                            OR (motion.decision_at=?
+                                AND (motion.carries>?
+                                     OR (motion.carries=? AND motion.id>?))))"""
+            params = [cursor_at, until, cursor_at, cursor_at,
+                      cursor_carries, cursor_carries, cursor_id]
+            if carries is not None:
+                query += """
+                       AND motion.carries=?"""
+                params.append(carries)
+            query += """
+                       ORDER BY motion.decision_at, motion.carries, motion.id
+                       LIMIT ?"""
+            params.append(page_size + 1)
+            cursor.execute(query, params)
+            page = cursor.fetchall()
+            if len(page) == 0:
+                irc.reply("No decided motions in channel %s" % channel)
+                return
+
+            more = len(page) > page_size
+            page = page[:page_size]
+            parts = []
+            for motion_id, decision_at, motion_carries, aye, nay, motion_text, name in page:
+                parts.append("#%d %s %s: %s %d:%d %s" % (
+                    motion_id, decision_at[:16], name,
+                    "carried" if motion_carries else "dismissed",
+                    aye, nay, motion_text))
+            if more:
+                parts.append("more with --after %d" % page[-1][0])
+            irc.reply(" | ".join(parts))
 
         def delete(self, irc, msg, args, channel, item_id):
             """[<channel>] <item_id>
@@ -784,15 +2305,16 @@ class Meeting(callbacks.Plugin, plugins.ChannelDBHandler):
             Delete a motion from the motion table, renumbering following motions.
             Cannot delete motions that have carried.
             """
+            key = self._meeting._key(irc, channel)
             
             # get the current meeting ID
-            meeting_id = meeting_singleton._get_current(channel, 'meeting')
+            meeting_id = self._meeting._get_current(key, 'meeting')
             if meeting_id is None:
                 irc.error("There is no current meeting in channel %s" % channel)
                 return
 
             # get the database
-            db = meeting_singleton.getDb(channel)
+            db = self._meeting.getDb(key)
 
             # see how many we have now
             total_items = self.get_max_item_order(db, meeting_id)
@@ -816,33 +2338,46 @@ class Meeting(callbacks.Plugin, plugins.ChannelDBHandler):
                 irc.error("Something's wrong, this motion should have existed")
                 return
 
-            if results[0][0] is not None and result[0][0]:
+            if results[0][0]:
                 irc.error("Motion %d cannot be deleted because it has carried. It's not a time machine, James." % item_id)
+                return
 
-            # do the delete
+            current_motion = self._meeting._get_current(key, 'motion')
+
+            # the delete, the renumbering and the current motion change in
+            # one transaction
             cursor = db.cursor()
+            self._meeting._begin(db)
+
+            # do the delete, with the votes cast on the motion
+            cursor.execute("""DELETE FROM vote
+                              WHERE motion_id IN (SELECT id
+                                                  FROM motion
+                                                  WHERE meeting_id=?
+                                                  AND item_order=?)""", (meeting_id, item_id))
             cursor.execute("""DELETE FROM motion
                               WHERE meeting_id=?
                               AND item_order=?""", (meeting_id, item_id))
             
             # renumber the rest of the items
-            for item in range(item_id+1, total_items+1):
-                cursor.execute("""UPDATE motion
-                                  SET item_order=?
-                                  WHERE meeting_id=?
-                                  AND item_order=?""", (item-1, meeting_id, item))
+            cursor.execute("""UPDATE motion
+                              SET item_order=item_order-1
+                              WHERE meeting_id=?
+                              AND item_order>?""", (meeting_id, item_id))
 
             # handle current item
             if total_items == 1:
-                # no more agenda items
-                meeting_singleton._set_current(channel, 'motion', None)
-            else:
-                current_motion = meeting_singleton._get_current(channel, 'motion')
-                # was it among the items that were shifted down?
-                if current_motion > item_id:
-                    meeting_singleton._set_current(channel, 'motion', current_motion - 1)
+                # no more motions
+                current_motion = None
+            elif current_motion > item_id:
+                # it was among the items that were shifted down
+                current_motion -= 1
+            cursor.execute("""UPDATE currents
+                              SET value=?
+                              WHERE name='motion'""", (current_motion, ))
                 
-            db.commit()
+            self._meeting._record(key, 'motion_delete', meeting_id=meeting_id,
+                                  item=item_id)
             
             irc.reply("Motion %d has been deleted" % item_id)
             
@@ -851,25 +2386,29 @@ class Meeting(callbacks.Plugin, plugins.ChannelDBHandler):
 
     class vote(callbacks.Commands):
 
-        def start(self, irc, msg, args, channel):
-            """[<channel>]
+        def start(self, irc, msg, args, channel, secret):
+            """[<channel>] [secret]
             
-            Start the voting on the current motion
+            Start the voting on the current motion.  A secret vote is open to
+            those in the channel now, who vote by private message with: vote
+            cast <aye|nay|abstain> [<channel>]
             """
+            key = self._meeting._key(irc, channel)
 
             # get the current meeting ID
-            meeting_id = meeting_singleton._get_current(channel, 'meeting')
+            meeting_id = self._meeting._get_current(key, 'meeting')
             if meeting_id is None:
                 irc.error("There is no current meeting in channel %s" % channel)
                 return
 
             # get the current motion
-            motion_item_order = meeting_singleton._get_current(channel, 'motion')
+            motion_item_order = self._meeting._get_current(key, 'motion')
             if motion_item_order is None:
                 irc.error("There is no current motion in the meeting")
+                return
             
             # get the database
-            db = meeting_singleton.getDb(channel)
+            db = self._meeting.getDb(key)
 
             # get the motion details
             cursor = db.cursor()
@@ -893,32 +2432,78 @@ class Meeting(callbacks.Plugin, plugins.ChannelDBHandler):
                 irc.error("Voting on the current motion is already open")
                 return
             
-            # set the vote flag in the singleton
-            meeting_singleton._start_vote_cache(channel)
+            if not secret:
+                # set the vote flag in the plugin
+                self._meeting._start_vote_cache(key)
 
-            irc.reply("Voting open! Please vote aye, nay or abstain for motion: %s" % motion_text)
+                self._meeting._announce(irc, ircmsgs.privmsg(channel, "Voting open! Please vote aye, nay or abstain for motion: %s" % motion_text),
+                                        announce.VOTE)
+                return
+            
+            # everyone in the channel now may vote, except the bot, by the
+            # hostmask they have now
+            if channel not in irc.state.channels:
+                irc.error("I'm not in %s, so I can't tell who may vote" % channel)
+                return
+            voters = []
+            for nick in irc.state.channels[channel].users:
+                if ircutils.strEqual(nick, irc.nick):
+                    continue
+                try:
+                    voters.append(irc.state.nickToHostmask(nick))
+                except KeyError:
+                    self._meeting.log.warning("No hostmask for %s in %s, they get no "
+                                     "secret ballot", nick, channel)
+            self._meeting._start_vote_cache(key, voters)
+            with self._meeting._lock:
+                eligible = len(self._meeting._secret.get(key, ()))
+
+            self._meeting._announce(irc, ircmsgs.privmsg(channel, "Secret voting open for the %d of you here! Please vote by private message to me with: vote cast <aye|nay|abstain> %s - for motion: %s" % (eligible, channel, motion_text)),
+                                    announce.VOTE)
                 
-        start = wrap(start, ['channel'])
+        start = wrap(start, ['channel', optional(('literal', ['secret']))])
+
+        def cast(self, irc, msg, args, vote, channel):
+            """<aye|nay|abstain> [<channel>]
+            
+            Cast your ballot in a secret vote; send it to me by private message.
+            The channel is only needed when you may vote in more than one.
+            """
+            if irc.isChannel(msg.args[0]):
+                irc.error("Secret ballots are cast by private message")
+                return
+            
+            channel, error = self._meeting._cast_secret(irc.network, msg.prefix,
+                                                        vote, channel)
+            if error is not None:
+                irc.error(error)
+                return
+            irc.reply("Your ballot in %s has been recorded" % channel,
+                      private=True)
+
+        cast = wrap(cast, [('literal', VALID_VOTE), optional('validChannel')])
 
         def end(self, irc, msg, args, channel):
             """[<channel>]
             
             Finishes (and tallies) the vote results
             """
+            key = self._meeting._key(irc, channel)
 
             # get the current meeting ID
-            meeting_id = meeting_singleton._get_current(channel, 'meeting')
+            meeting_id = self._meeting._get_current(key, 'meeting')
             if meeting_id is None:
                 irc.error("There is no current meeting in channel %s" % channel)
                 return
 
             # get the current motion
-            motion_item_order = meeting_singleton._get_current(channel, 'motion')
+            motion_item_order = self._meeting._get_current(key, 'motion')
             if motion_item_order is None:
                 irc.error("There is no current motion in the meeting")
+                return
             
             # get the database
-            db = meeting_singleton.getDb(channel)
+            db = self._meeting.getDb(key)
 
             # get the motion details
             cursor = db.cursor()
@@ -942,17 +2527,342 @@ class Meeting(callbacks.Plugin, plugins.ChannelDBHandler):
                 irc.error("Voting on the current motion has not been started yet")
                 return 
             
-            # set the vote flag in the singleton
-            result = meeting_singleton._end_vote_cache(channel)
+            # set the vote flag in the plugin
+            result = self._meeting._end_vote_cache(key)
 
             if result is None:
                 irc.error("Vote counting failed.")
                 return
             
-            irc.reply("Voting closed - %d aye | %d nay | %d abstained" % result)
+            counts, weighted = result
+            text = "Voting closed - %d aye | %d nay | %d abstained" % counts
+            if weighted != tuple(float(count) for count in counts):
+                text += " - weighted %g aye | %g nay | %g abstained" % weighted
+            self._meeting._announce(irc, ircmsgs.privmsg(channel, text),
+                                    announce.VOTE)
 
         end = wrap(end, ['channel'])
 
+    class weight(callbacks.Commands):
+
+        def _changed(self, irc, channel):
+            """reload the channel's weights with the next tally"""
+            key = self._meeting._key(irc, channel)
+            with self._meeting._lock:
+                self._meeting._weights.pop(key, None)
+
+        def _member(self, irc, member):
+            """returns the identity of a member given by nick or hostmask, or
+            None after replying with an error"""
+            if '@' not in member:
+                try:
+                    member = irc.state.nickToHostmask(member)
+                except KeyError:
+                    irc.error("I don't know the hostmask of %s, give it as nick!user@host" % member)
+                    return None
+            return weights.identity(member)
+
+        def set(self, irc, msg, args, channel, nick, weight):
+            """[<channel>] <nick|hostmask> <weight>
+            
+            Set the voting weight of a member (default 1)
+            """
+            if weight < 0:
+                irc.error("A voting weight cannot be negative")
+                return
+            member = self._member(irc, nick)
+            if member is None:
+                return
+            key = self._meeting._key(irc, channel)
+            db = self._meeting.getDb(key)
+            cursor = db.cursor()
+            cursor.execute("""INSERT OR REPLACE INTO member_weight
+                              VALUES (?, ?)""", (member, weight))
+            db.commit()
+            self._changed(irc, channel)
+            irc.reply("%s now votes with weight %g" % (nick, weight))
+
+        set = wrap(set, [('checkChannelCapability', 'op'), 'something', 'float'])
+
+        def proxy(self, irc, msg, args, channel, holder, member):
+            """[<channel>] <holder> <member>
+            
+            Let <holder> cast the vote of <member> whenever <member> does not
+            vote themselves; each is a nick or a hostmask
+            """
+            holder_identity = self._member(irc, holder)
+            if holder_identity is None:
+                return
+            member_identity = self._member(irc, member)
+            if member_identity is None:
+                return
+            if holder_identity == member_identity:
+                irc.error("A member cannot hold their own proxy")
+                return
+            key = self._meeting._key(irc, channel)
+            db = self._meeting.getDb(key)
+            cursor = db.cursor()
+            cursor.execute("""INSERT OR REPLACE INTO proxy
+                              VALUES (?, ?)""", (member_identity, holder_identity))
+            db.commit()
+            self._changed(irc, channel)
+            irc.reply("%s holds the proxy of %s" % (holder, member))
+
+        proxy = wrap(proxy, [('checkChannelCapability', 'op'), 'something', 'something'])
+
+        def unproxy(self, irc, msg, args, channel, member):
+            """[<channel>] <nick|hostmask>
+            
+            Withdraw the proxy given by a member
+            """
+            member_identity = self._member(irc, member)
+            if member_identity is None:
+                return
+            key = self._meeting._key(irc, channel)
+            db = self._meeting.getDb(key)
+            cursor = db.cursor()
+            cursor.execute("""DELETE FROM proxy
+                              WHERE member=?""", (member_identity, ))
+            db.commit()
+            if cursor.rowcount == 0:
+                irc.error("%s has not given a proxy" % member)
+                return
+            self._changed(irc, channel)
+            irc.reply("The proxy of %s has been withdrawn" % member)
+
+        unproxy = wrap(unproxy, [('checkChannelCapability', 'op'), 'something'])
+
+        def list(self, irc, msg, args, channel):
+            """[<channel>]
+            
+            List the members with voting weights other than 1, and the proxies
+            """
+            key = self._meeting._key(irc, channel)
+            table = self._meeting._get_weights(key)
+            parts = ["%s %g" % (member, weight)
+                     for member, weight in sorted(table.weights.items())]
+            parts += ["%s for %s" % (holder, member)
+                      for member, holder in sorted(table.proxies.items())]
+            if not parts:
+                irc.reply("Every member votes with weight 1, and there are no proxies")
+                return
+            irc.reply(" | ".join(parts))
+
+        list = wrap(list, ['channel'])
+
+    class election(callbacks.Commands):
+
+        def start(self, irc, msg, args, channel, opts, candidates):
+            """[<channel>] [--seats <n>] <candidate> <candidate> [<candidate> ...]
+            
+            Open a ranked-choice election for <n> seats (default 1) among the
+            candidates.  Voters rank candidates in the channel by name or number,
+            most preferred first: rank <candidate> <candidate> ...
+            """
+            key = self._meeting._key(irc, channel)
+
+            # get the current meeting ID
+            meeting_id = self._meeting._get_current(key, 'meeting')
+            if meeting_id is None:
+                irc.error("There is no current meeting in channel %s" % channel)
+                return
+
+            seats = dict(opts).get('seats', 1)
+            if len(candidates) < 2 or len(candidates) > 255:
+                irc.error("An election needs between 2 and 255 candidates")
+                return
+            if len(set(candidate.lower() for candidate in candidates)) != len(candidates):
+                irc.error("Each candidate may only be listed once")
+                return
+            if seats >= len(candidates):
+                irc.error("There must be more candidates than seats")
+                return
+            if key in self._meeting._ballots:
+                irc.error("There is already an election open in channel %s" % channel)
+                return
+
+            # get the database
+            db = self._meeting.getDb(key)
+
+            # insert the new election
+            cursor = db.cursor()
+            self._meeting._begin(db)
+            cursor.execute("""INSERT INTO election
+                              VALUES (NULL, ?, ?, ?, 1, NULL, NULL, NULL)""",
+                              (meeting_id, seats, json.dumps(candidates)))
+            election_id = cursor.lastrowid
+
+            with self._meeting._lock:
+                self._meeting._ballots[key] = {'election_id': election_id,
+                                               'meeting_id': meeting_id,
+                                               'seats': seats,
+                                               'candidates': candidates,
+                                               'rankings': {}}
+            self._meeting._record(key, 'election_start', meeting_id=meeting_id,
+                                  election_id=election_id, seats=seats,
+                                  candidates=candidates)
+
+            numbered = ", ".join("%d. %s" % (number + 1, candidate)
+                                 for number, candidate in enumerate(candidates))
+            self._meeting._announce(irc, ircmsgs.privmsg(channel, "Election open for %d seat(s)! Candidates: %s. Vote with: rank <candidate> <candidate> ..." % (seats, numbered)),
+                                    announce.VOTE)
+            
+        start = wrap(start, ['channel', getopts({'seats': 'positiveInt'}),
+                             many('something')])
+
+        def end(self, irc, msg, args, channel):
+            """[<channel>]
+            
+            Close the election and count the ranked ballots
+            """
+            key = self._meeting._key(irc, channel)
+
+            # take the ballots away from doPrivmsg
+            self._meeting._settle_flood(key)
+            with self._meeting._lock:
+                election = self._meeting._ballots.pop(key, None)
+            if election is None:
+                irc.error("There is no election open in channel %s" % channel)
+                return
+
+            # identical rankings are stored and counted once
+            import tally
+            groups = tally.group_ballots(election['rankings'].values())
+            result = tally.count(groups, len(election['candidates']), election['seats'])
+            elected = [election['candidates'][candidate] for candidate in result.elected]
+
+            # get the database
+            db = self._meeting.getDb(key)
+
+            cursor = db.cursor()
+            self._meeting._begin(db)
+            cursor.executemany("""INSERT INTO ballot
+                                  VALUES (?, ?, ?)""",
+                               [(election['election_id'],
+                                 sqlite3.Binary(tally.pack_ranking(ranking)), count)
+                                for ranking, count in groups.items()])
+            cursor.execute("""UPDATE election
+                              SET vote_open=0,
+                                  ballots=?,
+                                  elected=?,
+                                  decision_at=datetime('now')
+                              WHERE id=?""",
+                              (result.ballots, json.dumps(elected),
+                               election['election_id']))
+            self._meeting._record(key, 'election_end', meeting_id=election['meeting_id'],
+                                  election_id=election['election_id'],
+                                  ballots=result.ballots, elected=elected)
+
+            self._meeting._announce(irc, ircmsgs.privmsg(channel, "Election closed - %d ballots counted in %d rounds - elected: %s" % (result.ballots, len(result.rounds), ", ".join(elected) or "nobody")),
+                                    announce.VOTE)
+            
+        end = wrap(end, ['channel'])
+
+    class hand(callbacks.Commands):
+
+        def _raise(self, irc, msg, args, channel):
+            """[<channel>]
+            
+            Raise your hand to ask for the floor on the current agenda item
+            """
+            key = self._meeting._key(irc, channel)
+
+            # get the current meeting ID
+            meeting_id = self._meeting._get_current(key, 'meeting')
+            if meeting_id is None:
+                irc.error("There is no current meeting in channel %s" % channel)
+                return
+
+            queue = self._meeting._get_hands(key, meeting_id)
+            place = queue.raise_hand(msg.nick)
+            if place is None:
+                irc.error("Your hand is already raised")
+                return
+            self._meeting._hands_changed(key)
+            
+            irc.reply("Hand raised, you are number %d in the queue" % place)
+            
+        _raise = wrap(_raise, ['channel'], name='raise')
+
+        def lower(self, irc, msg, args, channel, nick):
+            """[<channel>] [<nick>]
+            
+            Lower your hand, or the hand of <nick>; lowering someone else's
+            hand needs the op capability in the channel
+            """
+            if nick and not ircutils.strEqual(nick, msg.nick):
+                capability = ircdb.makeChannelCapability(channel, 'op')
+                if not ircdb.checkCapability(msg.prefix, capability):
+                    irc.errorNoCapability(capability, Raise=True)
+
+            key = self._meeting._key(irc, channel)
+
+            # get the current meeting ID
+            meeting_id = self._meeting._get_current(key, 'meeting')
+            if meeting_id is None:
+                irc.error("There is no current meeting in channel %s" % channel)
+                return
+
+            nick = nick or msg.nick
+            queue = self._meeting._get_hands(key, meeting_id)
+            if not queue.lower(nick):
+                irc.error("%s does not have a hand raised" % nick)
+                return
+            self._meeting._hands_changed(key)
+            
+            irc.reply("%s lowered their hand" % nick)
+            
+        lower = wrap(lower, ['channel', optional('nick')])
+
+        def next(self, irc, msg, args, channel):
+            """[<channel>]
+            
+            Give the floor to the next raised hand
+            """
+            key = self._meeting._key(irc, channel)
+
+            # get the current meeting ID
+            meeting_id = self._meeting._get_current(key, 'meeting')
+            if meeting_id is None:
+                irc.error("There is no current meeting in channel %s" % channel)
+                return
+
+            queue = self._meeting._get_hands(key, meeting_id)
+            nick = queue.next()
+            if nick is None:
+                irc.reply("Nobody has their hand raised")
+                return
+            self._meeting._hands_changed(key)
+            
+            irc.reply("%s has the floor (%d more waiting)" % (nick, len(queue)))
+            
+        next = wrap(next, ['channel'])
+
+        def list(self, irc, msg, args, channel):
+            """[<channel>]
+            
+            List the raised hands in the order they will get the floor
+            """
+            key = self._meeting._key(irc, channel)
+
+            # get the current meeting ID
+            meeting_id = self._meeting._get_current(key, 'meeting')
+            if meeting_id is None:
+                irc.error("There is no current meeting in channel %s" % channel)
+                return
+
+            waiting = self._meeting._get_hands(key, meeting_id).waiting()
+            if len(waiting)==0:
+                irc.reply("Nobody has their hand raised")
+                return
+            
+            irc.reply("Speaker queue: %s" % ", ".join(waiting))
+            
+        list = wrap(list, ['channel'])
+
+    # raise is a python keyword, so that command is attached by name
+    setattr(hand, 'raise', hand.__dict__['_raise'])
+
 Class = Meeting
 
 
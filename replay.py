@@ -0,0 +1,449 @@
+###
+# Copyright (c) 2013, Arik Baratz
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+###
+
+
+"""
+Replays recorded IRC traffic through the plugin, for end-to-end throughput
+testing against real meetings:
+
+    python replay.py [options] <log file>
+
+The log is an irssi or weechat channel log, or raw IRC protocol lines
+(optionally each preceded by a unix time); it is fed to a bot with no
+network connection, loaded with Owner for the command dispatch and this
+plugin, as fast as it can go or at a multiple of the recorded pace.  The
+report is JSON with sorted keys, so that runs can be diffed:
+
+    {"input": {...}, "elapsed_seconds": ..., "messages_per_second": ...,
+     "commands": {"vote end": <latencies>, ...}, "vote_path": <latencies>,
+     "outbound": {"queued": ..., "by_command": {...}, ...}}
+
+The bot is set up in a throwaway directory, and supybot's registry must be
+opened before any other supybot module is imported, so the supybot imports
+here are made when they are needed rather than at the top.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import calendar
+import tempfile
+import optparse
+
+# irssi: "--- Log opened Mon Jan 07 10:00:00 2013", "--- Day changed Tue Jan
+# 08 2013", then "HH:MM[:SS] <@nick> text" and "-!-" events
+IRSSI_OPENED = re.compile(r'^--- Log opened \w+ (\w+ \d+) [\d:]+ (\d+)$')
+IRSSI_DAY = re.compile(r'^--- Day changed \w+ (\w+ \d+) (\d+)$')
+IRSSI_LINE = re.compile(r'^(\d\d):(\d\d)(?::(\d\d))? (.*)$')
+IRSSI_MESSAGE = re.compile(r'^<[ @%+~&]?([^>]+)> (.*)$')
+IRSSI_ACTION = re.compile(r'^ \* (\S+) (.*)$')
+IRSSI_EVENT = re.compile(r'^-!- (\S+) \[([^\]]+)\] has (joined|left|quit)')
+IRSSI_NICK = re.compile(r'^-!- (\S+) is now known as (\S+)$')
+
+# weechat: "YYYY-MM-DD HH:MM:SS<tab>prefix<tab>text"
+WEECHAT_EVENT = re.compile(r'^(\S+) \(([^)]+)\) has (joined|left|quit)')
+WEECHAT_NICK = re.compile(r'^(\S+) is now known as (\S+)$')
+
+# raw: ":prefix COMMAND ...", optionally after a unix time
+RAW_LINE = re.compile(r'^(?:(\d+(?:\.\d+)?) )?(:\S+ .*)$')
+
+# the channel messages the plugin takes as votes
+VALID_VOTE = ['aye', 'nay', 'abstain']
+
+def _prefix(hosts, nick):
+    """the nick!user@host of a nick, made up if it wasn't seen joining"""
+    return '%s!%s' % (nick, hosts.get(nick, '%s@replay.invalid' % nick))
+
+def _event(hosts, channel, nick, host, what, new_nick=None):
+    """the raw line of a join, part, quit or nick change"""
+    if host is not None:
+        hosts[nick] = host
+    prefix = _prefix(hosts, nick)
+    if what == 'joined':
+        return ':%s JOIN %s' % (prefix, channel)
+    if what == 'left':
+        return ':%s PART %s' % (prefix, channel)
+    if what == 'quit':
+        return ':%s QUIT :quit' % prefix
+    hosts[new_nick] = hosts.pop(nick, '%s@replay.invalid' % nick)
+    return ':%s NICK %s' % (prefix, new_nick)
+
+def parse_irssi(lines, channel):
+    """yields (seconds, raw line) for an irssi channel log"""
+    hosts = {}
+    day, last = 0, None
+    for line in lines:
+        line = line.rstrip('\r\n')
+        match = IRSSI_OPENED.match(line) or IRSSI_DAY.match(line)
+        if match:
+            day = calendar.timegm(time.strptime(' '.join(match.groups()), '%b %d %Y'))
+            last = None
+            continue
+        match = IRSSI_LINE.match(line)
+        if not match:
+            continue
+        hours, minutes, seconds, rest = match.groups()
+        at = day + int(hours) * 3600 + int(minutes) * 60 + int(seconds or 0)
+        if last is not None and at < last:
+            # past midnight without a "Day changed" line
+            day += 86400
+            at += 86400
+        last = at
+
+        match = IRSSI_MESSAGE.match(rest)
+        if match:
+            nick, text = match.groups()
+            yield at, ':%s PRIVMSG %s :%s' % (_prefix(hosts, nick), channel, text)
+            continue
+        match = IRSSI_ACTION.match(rest)
+        if match:
+            nick, text = match.groups()
+            yield at, ':%s PRIVMSG %s :\x01ACTION %s\x01' % (_prefix(hosts, nick),
+                                                            channel, text)
+            continue
+        match = IRSSI_EVENT.match(rest)
+        if match:
+            yield at, _event(hosts, channel, *match.groups())
+            continue
+        match = IRSSI_NICK.match(rest)
+        if match:
+            nick, new_nick = match.groups()
+            yield at, _event(hosts, channel, nick, None, 'nick', new_nick)
+
+def parse_weechat(lines, channel):
+    """yields (seconds, raw line) for a weechat channel log"""
+    hosts = {}
+    for line in lines:
+        parts = line.rstrip('\r\n').split('\t', 2)
+        if len(parts) != 3:
+            continue
+        stamp, prefix, text = parts
+        try:
+            at = calendar.timegm(time.strptime(stamp, '%Y-%m-%d %H:%M:%S'))
+        except ValueError:
+            continue
+
+        if prefix in ('-->', '<--'):
+            match = WEECHAT_EVENT.match(text)
+            if match:
+                yield at, _event(hosts, channel, *match.groups())
+        elif prefix == '--':
+            match = WEECHAT_NICK.match(text)
+            if match:
+                nick, new_nick = match.groups()
+                yield at, _event(hosts, channel, nick, None, 'nick', new_nick)
+        elif prefix.strip() == '*':
+            nick, _, text = text.partition(' ')
+            yield at, ':%s PRIVMSG %s :\x01ACTION %s\x01' % (_prefix(hosts, nick),
+                                                            channel, text)
+        elif prefix:
+            nick = prefix.lstrip('@%+~&')
+            yield at, ':%s PRIVMSG %s :%s' % (_prefix(hosts, nick), channel, text)
+
+def parse_raw(lines, channel=None):
+    """yields (seconds or None, raw line) for raw IRC protocol lines"""
+    for line in lines:
+        match = RAW_LINE.match(line.rstrip('\r\n'))
+        if match:
+            at, raw = match.groups()
+            yield (float(at) if at is not None else None), raw
+
+PARSERS = {'irssi': parse_irssi, 'weechat': parse_weechat, 'raw': parse_raw}
+
+def detect_format(lines):
+    """guess the format of a log from its first lines"""
+    for line in lines:
+        if RAW_LINE.match(line):
+            return 'raw'
+        if re.match(r'^\d{4}-\d\d-\d\d \d\d:\d\d:\d\d\t', line):
+            return 'weechat'
+        if line.startswith('--- Log opened') or IRSSI_LINE.match(line):
+            return 'irssi'
+    return None
+
+def parse(lines, format, channel):
+    """returns [(seconds or None, raw line)] of a log"""
+    return list(PARSERS[format](lines, channel))
+
+def latencies(values):
+    """the distribution of a list of seconds, in milliseconds"""
+    if not values:
+        return {'count': 0}
+    values = sorted(values)
+    def at(fraction):
+        return round(values[min(len(values) - 1, int(fraction * len(values)))] * 1000, 3)
+    return {'count': len(values),
+            'mean_ms': round(sum(values) * 1000 / len(values), 3),
+            'p50_ms': at(0.50), 'p95_ms': at(0.95), 'p99_ms': at(0.99),
+            'max_ms': round(values[-1] * 1000, 3)}
+
+class Replay(object):
+    """feeds parsed log lines to an irc object with the plugin loaded,
+    measuring how long each command and vote takes"""
+    def __init__(self, irc, meeting, speed=0, timeout=5.0):
+        self.irc = irc
+        self.meeting = meeting
+        # a multiple of the recorded pace, 0 for as fast as possible
+        self.speed = speed
+        # how long to wait for a command's reply, it may be on a worker
+        self.timeout = timeout
+        self.queued = 0
+        self.by_command = {}
+
+    def _drain(self):
+        """take the messages the bot has queued, returns how many"""
+        taken = 0
+        while True:
+            msg = self.irc.takeMsg()
+            if msg is None:
+                return taken
+            taken += 1
+            self.by_command[msg.command] = self.by_command.get(msg.command, 0) + 1
+        
+    def _tick(self):
+        import supybot.schedule as schedule
+        schedule.run()
+        self.queued += self._drain()
+
+    def _wait_until(self, wall):
+        while True:
+            self._tick()
+            left = wall - time.time()
+            if left <= 0:
+                return
+            time.sleep(min(left, 0.01))
+
+    def _command_name(self, payload):
+        import supybot.callbacks as callbacks
+        try:
+            tokens = callbacks.tokenize(payload)
+        except SyntaxError:
+            return 'other'
+        if len(tokens) > 1 and callbacks.canonicalName(tokens[0]) == self.meeting.canonicalName():
+            tokens = tokens[1:]
+        command = self.meeting.getCommand(tokens)
+        if not command:
+            return 'other'
+        return ' '.join(command)
+
+    def _settle(self, seconds):
+        """let the workers finish and the held back votes and rate limited
+        announcements go out"""
+        self.meeting._workers.join()
+        deadline = time.time() + seconds
+        while time.time() < deadline:
+            self._tick()
+            if not (self.meeting._drain_events or self.meeting._flood_event):
+                break
+            time.sleep(0.01)
+        self._tick()
+
+    def run(self, messages, settle=10.0):
+        """replay [(seconds or None, raw line)], returns the report"""
+        import supybot.ircmsgs as ircmsgs
+        import supybot.callbacks as callbacks
+        irc = self.irc
+        counts = {'messages': 0, 'commands': 0, 'votes': 0, 'other': 0,
+                  'joins_added': 0, 'unanswered_commands': 0}
+        commands, votes = {}, []
+
+        first_at, start = None, time.time()
+        for at, line in messages:
+            msg = ircmsgs.IrcMsg(line)
+            if msg.nick == irc.nick:
+                # the recorded bot's own replies
+                continue
+            if self.speed and at is not None:
+                if first_at is None:
+                    first_at = at
+                self._wait_until(start + (at - first_at) / self.speed)
+
+            kind = 'other'
+            if msg.command == 'PRIVMSG':
+                channel = msg.args[0]
+                if irc.isChannel(channel):
+                    # those already in the channel when the log starts
+                    if channel not in irc.state.channels:
+                        irc.feedMsg(ircmsgs.join(channel, prefix=irc.prefix))
+                    if msg.nick not in irc.state.channels[channel].users:
+                        irc.feedMsg(ircmsgs.join(channel, prefix=msg.prefix))
+                        counts['joins_added'] += 1
+                text = msg.args[1]
+                if ircmsgs.isAction(msg):
+                    text = ircmsgs.unAction(msg)
+                payload = callbacks.addressed(irc.nick, msg)
+                if payload:
+                    kind = 'command'
+                elif text in VALID_VOTE or text.startswith('rank '):
+                    kind = 'vote'
+
+            if kind == 'command':
+                # what the bot still has to send for earlier messages, a
+                # reply from a worker or an announcement, is not this
+                # command's reply
+                self.meeting._workers.join()
+                self._tick()
+
+            sent = time.time()
+            irc.feedMsg(msg)
+            counts['messages'] += 1
+            if kind == 'command':
+                counts['commands'] += 1
+                # the latency of a command runs to its first reply
+                replied = self._drain()
+                while not replied and time.time() < sent + self.timeout:
+                    time.sleep(0.0005)
+                    replied = self._drain()
+                elapsed = time.time() - sent
+                self.queued += replied
+                if not replied:
+                    counts['unanswered_commands'] += 1
+                commands.setdefault(self._command_name(payload), []).append(elapsed)
+            elif kind == 'vote':
+                votes.append(time.time() - sent)
+                counts['votes'] += 1
+            else:
+                counts['other'] += 1
+            self._tick()
+        elapsed = time.time() - start
+
+        self._settle(settle)
+        pending = sum(len(queue) for queue in self.meeting._announcers.values())
+        return {'input': counts,
+                'speed': self.speed,
+                'elapsed_seconds': round(elapsed, 3),
+                'messages_per_second': round(counts['messages'] / max(elapsed, 1e-6), 1),
+                'commands': dict((name, latencies(values))
+                                 for name, values in commands.items()),
+                'vote_path': latencies(votes),
+                'outbound': {'queued': self.queued,
+                             'by_command': self.by_command,
+                             'pending_announcements': pending}}
+
+REGISTRY = """
+supybot.nick: %(nick)s
+supybot.directories.conf: %(directory)s/conf
+supybot.directories.data: %(directory)s/data
+supybot.directories.log: %(directory)s/logs
+supybot.directories.backup: %(directory)s/backup
+supybot.log.stdout: False
+supybot.protocols.irc.throttleTime: 0
+supybot.abuse.flood.command: False
+supybot.reply.whenAddressedBy.chars: %(chars)s
+supybot.networks.%(network)s.server: replay.invalid
+"""
+
+def make_irc(directory, network, nick, chars):
+    """returns an irc with no connection and Owner loaded, its registry and
+    databases in the directory"""
+    filename = os.path.join(directory, 'replay.conf')
+    with open(filename, 'w') as fd:
+        fd.write(REGISTRY % {'directory': directory, 'network': network,
+                             'nick': nick, 'chars': chars})
+    import supybot.registry as registry
+    # supybot has registry.open, limnoria registry.open_registry
+    (getattr(registry, 'open_registry', None) or registry.open)(filename)
+
+    import supybot.conf as conf
+    import supybot.plugin as plugin
+    import supybot.irclib as irclib
+    here = os.path.dirname(os.path.abspath(__file__))
+    conf.supybot.directories.plugins.setValue([os.path.dirname(here)])
+    irc = irclib.Irc(network)
+    plugin.loadPluginClass(irc, plugin.loadPluginModule('Owner'))
+    return irc
+
+def load_meeting(irc):
+    """loads this plugin into the irc, returns its callback"""
+    import supybot.plugin as plugin
+    here = os.path.dirname(os.path.abspath(__file__))
+    return plugin.loadPluginClass(irc, plugin.loadPluginModule(os.path.basename(here)))
+
+def make_bot(directory, network, nick, chars):
+    """returns (irc, Meeting callback) of a bot with no connection, its
+    registry and databases in the directory"""
+    irc = make_irc(directory, network, nick, chars)
+    return irc, load_meeting(irc)
+
+def main(argv):
+    parser = optparse.OptionParser(usage="python replay.py [options] <log file>")
+    parser.add_option('--format', choices=['irssi', 'weechat', 'raw'],
+                      help="the log format, guessed when not given")
+    parser.add_option('--channel', default='#meeting',
+                      help="the channel of an irssi or weechat log")
+    parser.add_option('--network', default='replay')
+    parser.add_option('--nick', default='MeetBot',
+                      help="the bot's nick in the log, its lines are skipped")
+    parser.add_option('--chars', default='@',
+                      help="the command prefix characters")
+    parser.add_option('--speed', type='float', default=0,
+                      help="a multiple of the recorded pace, 0 (the default) "
+                           "replays as fast as possible")
+    parser.add_option('--output', help="write the report here, not stdout")
+    options, args = parser.parse_args(argv)
+    if len(args) != 1:
+        parser.error("give one log file")
+
+    with open(args[0]) as fd:
+        lines = fd.readlines()
+    format = options.format or detect_format(lines)
+    if format is None:
+        parser.error("can't tell the format of %s, use --format" % args[0])
+    messages = parse(lines, format, options.channel)
+
+    directory = tempfile.mkdtemp()
+    try:
+        irc, meeting = make_bot(directory, options.network, options.nick,
+                                options.chars)
+        try:
+            report = Replay(irc, meeting, options.speed).run(messages)
+        finally:
+            meeting.die()
+    finally:
+        shutil.rmtree(directory)
+    report['input']['file'] = os.path.basename(args[0])
+    report['input']['format'] = format
+
+    out = json.dumps(report, sort_keys=True, indent=2)
+    if options.output:
+        with open(options.output, 'w') as fd:
+            fd.write(out + '\n')
+    else:
+        print(out)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
+
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
@@ -0,0 +1,88 @@
+###
+# Copyright (c) 2013, Arik Baratz
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+###
+
+"""
+The read-only JSON status document served over HTTP: it is rendered only
+when the meeting state changed since it was last asked for, and carries an
+ETag so that pollers with an up to date copy get a cheap 304.
+"""
+
+import json
+import time
+
+class StatusSnapshot(object):
+    """a JSON document rebuilt only when the state it describes changes"""
+    def __init__(self, build, lock):
+        # build() returns the document; it is called with lock held, the
+        # same lock that is held while the state changes
+        self._build = build
+        self._lock = lock
+        self.version = 0
+        self._cached = None
+        # tells this process's ETags apart from those of earlier runs
+        self._boot = '%x' % int(time.time())
+
+    def changed(self):
+        """mark the document as stale, call with the lock held"""
+        self.version += 1
+
+    def get(self):
+        """returns (etag, body) of the current document"""
+        cached = self._cached
+        if cached is None or cached[0] != self.version:
+            with self._lock:
+                cached = self._cached
+                if cached is None or cached[0] != self.version:
+                    body = json.dumps(self._build(), sort_keys=True)
+                    if not isinstance(body, bytes):
+                        body = body.encode('utf-8')
+                    etag = '"%s-%d"' % (self._boot, self.version)
+                    cached = self._cached = (self.version, etag, body)
+        return cached[1], cached[2]
+
+def respond(handler, snapshot):
+    """answer a GET on a BaseHTTPRequestHandler with the snapshot"""
+    etag, body = snapshot.get()
+    if handler.headers.get('If-None-Match') == etag:
+        handler.send_response(304)
+        handler.send_header('ETag', etag)
+        handler.send_header('Content-Length', '0')
+        handler.end_headers()
+        return
+    handler.send_response(200)
+    handler.send_header('Content-Type', 'application/json')
+    handler.send_header('Cache-Control', 'no-cache')
+    handler.send_header('ETag', etag)
+    handler.send_header('Content-Length', str(len(body)))
+    handler.end_headers()
+    handler.wfile.write(body)
+
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
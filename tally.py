@@ -0,0 +1,160 @@
+###
+# Copyright (c) 2013, Arik Baratz
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+###
+
+"""
+Ranked-choice election counting.
+
+Ballots are rankings of candidate indices, most preferred first, grouped
+so that identical rankings are stored and counted once with a count.  The
+count is STV with the Droop quota and fractional (Gregory) surplus
+transfers; with one seat that is instant-runoff voting.  Each candidate
+keeps a pile of the ballot groups currently counting for them, so a round
+only looks at the piles being transferred, never at every ballot.
+"""
+
+import array
+import collections
+
+def parse_ranking(candidates, words):
+    """returns the ranking of candidate indices described by the words
+    (candidate names or 1-based numbers), or None if it isn't a valid one"""
+    names = dict((name.lower(), index) for index, name in enumerate(candidates))
+    ranking = []
+    for word in words:
+        if word.isdigit() and 1 <= int(word) <= len(candidates):
+            index = int(word) - 1
+        elif word.lower() in names:
+            index = names[word.lower()]
+        else:
+            return None
+        if index in ranking:
+            return None
+        ranking.append(index)
+    if not ranking:
+        return None
+    return tuple(ranking)
+
+def group_ballots(rankings):
+    """returns {ranking: count} for an iterable of rankings"""
+    return collections.Counter(rankings)
+
+def pack_ranking(ranking):
+    """returns the ranking as a compact byte string, one byte per candidate"""
+    packed = array.array('B', ranking)
+    if hasattr(packed, 'tobytes'):
+        return packed.tobytes()
+    return packed.tostring()
+
+def unpack_ranking(packed):
+    """returns the ranking stored by pack_ranking"""
+    ranking = array.array('B')
+    if hasattr(ranking, 'frombytes'):
+        ranking.frombytes(bytes(packed))
+    else:
+        ranking.fromstring(str(packed))
+    return tuple(ranking)
+
+class Count(object):
+    """an STV count of grouped ballots"""
+    def __init__(self, groups, candidates, seats):
+        self.candidates = candidates
+        self.seats = seats
+        self.continuing = set(range(candidates))
+        self.elected = []
+        self.exhausted = 0.0
+        self.totals = [0.0] * candidates
+        # the (ranking, position, weight, count) groups counting for each
+        self.piles = [[] for candidate in range(candidates)]
+        # each round's totals, for reporting
+        self.rounds = []
+
+        self.ballots = 0
+        for ranking, count in groups.items():
+            self.ballots += count
+            self._place(ranking, 0, 1.0, count)
+        self.quota = self.ballots // (seats + 1) + 1
+
+    def _place(self, ranking, position, weight, count):
+        """put a ballot group on the pile of its next continuing candidate"""
+        while position < len(ranking) and ranking[position] not in self.continuing:
+            position += 1
+        if position == len(ranking):
+            self.exhausted += weight * count
+            return
+        candidate = ranking[position]
+        self.piles[candidate].append((ranking, position, weight, count))
+        self.totals[candidate] += weight * count
+
+    def _transfer(self, candidate, ratio):
+        """move the candidate's pile on to the next preferences"""
+        pile, self.piles[candidate] = self.piles[candidate], []
+        for ranking, position, weight, count in pile:
+            self._place(ranking, position + 1, weight * ratio, count)
+
+    def run(self):
+        """count until every seat is filled, returns the elected candidates"""
+        if self.ballots == 0:
+            return self.elected
+        while len(self.elected) < self.seats and self.continuing:
+            self.rounds.append(list(self.totals))
+
+            # few enough left to fill the remaining seats
+            if len(self.continuing) + len(self.elected) <= self.seats:
+                remaining = sorted(self.continuing,
+                                   key=lambda c: (-self.totals[c], c))
+                self.elected.extend(remaining)
+                self.continuing.clear()
+                break
+
+            top = min(self.continuing, key=lambda c: (-self.totals[c], c))
+            if self.totals[top] >= self.quota:
+                # elected, pass the surplus on at a fraction of its value
+                self.elected.append(top)
+                self.continuing.remove(top)
+                surplus = self.totals[top] - self.quota
+                if surplus > 0 and len(self.elected) < self.seats:
+                    self._transfer(top, surplus / self.totals[top])
+                continue
+
+            # nobody reached the quota, the last candidate is out; ties go
+            # against the candidate listed later
+            lowest = min(self.continuing, key=lambda c: (self.totals[c], -c))
+            self.continuing.remove(lowest)
+            self._transfer(lowest, 1.0)
+        return self.elected
+
+def count(groups, candidates, seats=1):
+    """count grouped ballots, returns the finished Count"""
+    election = Count(groups, candidates, seats)
+    election.run()
+    return election
+
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
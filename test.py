@@ -28,10 +28,867 @@
 
 ###
 
+import io
+import os
+import sys
+import json
+import threading
+
 from supybot.test import *
+import supybot.plugins as plugins
+
+import replay
+import announce
+import events
+import fsck
+import status
 
 class MeetingTestCase(PluginTestCase):
     plugins = ('Meeting',)
 
+    def testAnnouncementsKeepChannelOrder(self):
+        now = [0.0]
+        queue = announce.AnnounceQueue(announce.TokenBucket(1, 1, lambda: now[0]), 60)
+        queue.put('#a', 'agenda a', announce.NORMAL)
+        queue.put('#b', 'agenda b', announce.NORMAL)
+        queue.put('#a', 'topic a1', announce.TOPIC)
+        queue.put('#a', 'vote a', announce.VOTE)
+        queue.put('#a', 'topic a2', announce.TOPIC)
+        sent = []
+        while len(queue):
+            now[0] += 1
+            queue.drain(sent.append)
+        # the vote takes its channel's agenda item along, the first topic
+        # change is superseded
+        self.assertEqual(sent, ['agenda a', 'vote a', 'topic a2', 'agenda b'])
+
+    def testAnnouncementWaitsAtMostMaxWait(self):
+        now = [0.0]
+        queue = announce.AnnounceQueue(announce.TokenBucket(1, 1, lambda: now[0]), 60)
+        queue.put('#b', 'agenda b', announce.NORMAL)
+        sent = []
+        while 'agenda b' not in sent:
+            now[0] += 1
+            queue.put('#a', 'vote a', announce.VOTE)
+            queue.drain(sent.append)
+        self.assertEqual(now[0], 60)
+
+
+class ReplyCollector(object):
+    """stands in for an irc object, remembering the replies it was given"""
+    def __init__(self, network):
+        self.network = network
+        self.replies = []
+        self.errors = []
+
+    def reply(self, s, *args, **kwargs):
+        self.replies.append(s)
+
+    def error(self, s, *args, **kwargs):
+        self.errors.append(s)
+
+
+class FakeRequestHandler(object):
+    """stands in for a BaseHTTPRequestHandler, remembering the response"""
+    def __init__(self, headers):
+        self.headers = headers
+        self.status = None
+        self.response_headers = {}
+        self.wfile = io.BytesIO()
+
+    def send_response(self, code):
+        self.status = code
+
+    def send_header(self, name, value):
+        self.response_headers[name] = value
+
+    def end_headers(self):
+        pass
+
+
+class MeetingChannelTestCase(ChannelPluginTestCase):
+    plugins = ('Meeting',)
+
+    def assertAnnounced(self, query):
+        """start and adjourn change the topic and then announce it, so they
+        answer with two messages; returns the announcement"""
+        m = self.getMsg(query)
+        self.failIf(m is None, '%r timed out' % query)
+        self.assertEqual(m.command, 'TOPIC',
+                         '%r did not change the topic: %r' % (query, m))
+        # past the burst, the announcement waits for the rate limit
+        m = self.nextMsg()
+        self.failIf(m is None, '%r was not announced' % query)
+        return m.args[1]
+
+    def nextMsg(self):
+        """returns the next message of a command that answers with several,
+        or None if none comes"""
+        deadline = time.time() + self.timeout
+        m = self.irc.takeMsg()
+        while m is None and time.time() < deadline:
+            drivers.run()
+            m = self.irc.takeMsg()
+        return m
+
+
+class MeetingThreadingTestCase(MeetingChannelTestCase):
+
+    def setUp(self):
+        MeetingChannelTestCase.setUp(self)
+        self.assertNotError('prepare stress test')
+        self.assertAnnounced('start')
+        self.assertNotError('motion add the plugin survives concurrency')
+        self.assertNotError('vote start')
+
+    def testConcurrentVotingAndListing(self):
+        cb = self.irc.getCallback('Meeting')
+        voters, votes_each = 8, 100
+        errors = []
+
+        def vote(n):
+            for i in range(votes_each):
+                prefix = 'voter%d!user%d@host%d' % (n, n, i)
+                choice = ['aye', 'nay', 'abstain'][i % 3]
+                cb.doPrivmsg(self.irc,
+                             ircmsgs.privmsg(self.channel, choice,
+                                             prefix=prefix))
+
+        def listing():
+            for i in range(20):
+                collector = ReplyCollector(self.irc.network)
+                cb.motion._list(collector, self.channel)
+                errors.extend(collector.errors)
+                cb.agenda._list(collector, self.channel)
+                errors.extend(collector.errors)
+
+        threads = [threading.Thread(target=vote, args=(n,))
+                   for n in range(voters)]
+        threads += [threading.Thread(target=listing) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        # every prefix voted exactly once, so all votes must be counted
+        self.assertResponse('vote end',
+                            'Voting closed - 272 aye | 264 nay | 264 abstained')
+
+    def testFloodShedAndCollapsed(self):
+        cb = self.irc.getCallback('Meeting')
+        key = cb._key(self.irc, self.channel)
+        for i in range(50):
+            cb.doPrivmsg(self.irc, ircmsgs.privmsg(self.channel,
+                                                   ['aye', 'nay'][i % 2],
+                                                   prefix='troll!troll@host'))
+        cb.doPrivmsg(self.irc, ircmsgs.privmsg(self.channel, 'aye',
+                                               prefix='voter!voter@host'))
+        cb.doPrivmsg(self.irc, ircmsgs.privmsg(self.channel, 'nay',
+                                               prefix='voter!voter@host'))
+        guard = cb._flood[key]
+        self.assertTrue(guard.shed > 0)
+        # the status endpoint shows what the open vote has ignored
+        meeting = cb._status_document()['meetings'][0]
+        self.assertEqual(meeting['flood'], {'shed': guard.shed,
+                                            'collapsed': guard.collapsed})
+        # the troll's fifth message is the last within its burst; the
+        # change of mind is held back, but counted when the vote closes
+        self.assertResponse('vote end',
+                            'Voting closed - 1 aye | 1 nay | 0 abstained')
+        self.assertFalse(key in cb._flood)
+
+    def testReportReadsOneSnapshot(self):
+        cb = self.irc.getCallback('Meeting')
+        key = cb._key(self.irc, self.channel)
+        started, written = threading.Event(), threading.Event()
+        counts = []
+
+        def count():
+            cursor = cb.getDb(key).cursor()
+            cursor.execute("""SELECT count(*) FROM motion""")
+            counts.append(cursor.fetchall()[0][0])
+
+        def report():
+            count()
+            started.set()
+            written.wait(10)
+            count()
+            cb._end_snapshots()
+            count()
+
+        thread = threading.Thread(target=report)
+        thread.start()
+        started.wait(10)
+        # the writes don't wait for the report
+        self.assertResponse('vote end',
+                            'Voting closed - 0 aye | 0 nay | 0 abstained')
+        self.assertNotError('motion add a second motion')
+        written.set()
+        thread.join()
+        self.assertEqual(counts, [1, 1, 2])
+
+    def testListingRunsOnWorker(self):
+        self.assertResponse('motion list',
+                            'Motion 1: the plugin survives concurrency - '
+                            'Motion has not been up for vote yet')
+
+    def testWorkerOpensMainConnectionFirst(self):
+        cb = self.irc.getCallback('Meeting')
+        key = (self.irc.network, '#fresh')
+        self.failIf(key in cb._dbs)
+        self.assertRegexp('motion list #fresh', 'no current meeting')
+        # the schema was made by the connection handed to the main loop
+        self.failUnless(key in cb._dbs)
+
+    def testWorkerPoolStopJoinsWorkers(self):
+        cb = self.irc.getCallback('Meeting')
+        exited = []
+        pool = type(cb._workers)('test', 2,
+                                 lambda: exited.append(threading.currentThread()))
+        self.failUnless(pool.stop())
+        self.assertEqual(len(exited), 2)
+        for thread in exited:
+            self.failIf(thread.isAlive())
+
+
+class MeetingMultiNetworkTestCase(MeetingChannelTestCase):
+    networks = ['net%d' % i for i in range(10)]
+
+    def setUp(self):
+        MeetingChannelTestCase.setUp(self)
+        self.originalNetwork = self.irc.network
+
+    def tearDown(self):
+        self.irc.network = self.originalNetwork
+        MeetingChannelTestCase.tearDown(self)
+
+    def onNetwork(self, network):
+        # the command proxies look the network up on the real irc object
+        self.irc.network = network
+
+    def testSameChannelOnManyNetworks(self):
+        cb = self.irc.getCallback('Meeting')
+        for network in self.networks:
+            self.onNetwork(network)
+            self.assertNotError('prepare meeting on %s' % network)
+            self.assertAnnounced('start')
+            self.assertNotError('motion add motion on %s' % network)
+            self.assertNotError('vote start')
+
+        # every network votes in the same channel name at once, with the
+        # same voters, but one network votes differently from the rest
+        for i in range(500):
+            for network in self.networks:
+                self.onNetwork(network)
+                choice = 'nay' if network == 'net0' else 'aye'
+                cb.doPrivmsg(self.irc,
+                             ircmsgs.privmsg(self.channel, choice,
+                                             prefix='voter%d!voter%d@h' % (i, i)))
+
+        for network in self.networks:
+            self.onNetwork(network)
+            self.assertRegexp('motion list', 'motion on %s' % network)
+            if network == 'net0':
+                self.assertResponse('vote end',
+                                    'Voting closed - 0 aye | 500 nay | '
+                                    '0 abstained')
+            else:
+                self.assertResponse('vote end',
+                                    'Voting closed - 500 aye | 0 nay | '
+                                    '0 abstained')
+        self.assertEqual(cb._voter_decision, {})
+
+    def testDatabaseFromBeforeNetworks(self):
+        cb = self.irc.getCallback('Meeting')
+        old = plugins.makeChannelFilename('Meeting.db', self.channel)
+        db = cb.makeDb(old)
+        cursor = db.cursor()
+        cursor.execute("""INSERT INTO meeting
+                          VALUES (NULL, 'older than networks', NULL, NULL)""")
+        # it predates the event log too
+        cursor.execute("""DROP TABLE event""")
+        cursor.execute("""DROP TABLE snapshot""")
+        db.commit()
+        db.close()
+
+        self.onNetwork('legacy')
+        self.assertRegexp('switchid 1', 'older than networks')
+        self.failIf(os.path.exists(old))
+
+
+class MeetingEventLogTestCase(MeetingChannelTestCase):
+
+    def testAsOf(self):
+        self.assertRegexp('asof 1999-01-01 00:00', 'no current meeting')
+        self.assertNotError('prepare history lesson')
+        self.assertAnnounced('start')
+        self.assertNotError('agenda add the past')
+        self.assertNotError('agenda next')
+        self.assertRegexp('asof 2999-01-01 00:00',
+                          'history lesson .* in progress; '
+                          'agenda item 1 of 1: the past')
+        self.assertError('asof yesterday-ish')
+
+    def testAsOfAgendaOfEarlierMeeting(self):
+        self.assertNotError('prepare first')
+        self.assertNotError('agenda add one')
+        self.assertNotError('agenda add two')
+        self.assertNotError('prepare second')
+        # the current agenda item is one of the first meeting's
+        self.assertNotRegexp('asof 2999-01-01 00:00', 'agenda item|Error')
+        self.assertRegexp('asof 2999-01-01 00:00', 'second .* not started')
+
+    def testStateRebuiltFromLog(self):
+        cb = self.irc.getCallback('Meeting')
+        self.assertNotError('prepare rebuild')
+        self.assertNotError('motion add we replay the log')
+        key = cb._key(self.irc, self.channel)
+        live = cb._get_state(key)
+
+        # forget the live state, as a restart would
+        del cb._states[key]
+        self.assertEqual(cb._get_state(key), live)
+
+    def testSnapshotsHoldChangedMeetings(self):
+        cb = self.irc.getCallback('Meeting')
+        conf.supybot.plugins.Meeting.snapshotInterval.setValue(2)
+        try:
+            self.assertNotError('prepare first')
+            self.assertNotError('agenda add one')
+            self.assertNotError('prepare second')
+            self.assertNotError('agenda add two')
+        finally:
+            conf.supybot.plugins.Meeting.snapshotInterval.setValue(100)
+        key = cb._key(self.irc, self.channel)
+        cursor = cb.getDb(key).cursor()
+        cursor.execute("""SELECT state
+                          FROM snapshot
+                          WHERE event_id>0
+                          ORDER BY event_id""")
+        stored = [json.loads(row[0]) for row in cursor.fetchall()]
+        self.assertEqual([sorted(snapshot['meetings']) for snapshot in stored],
+                         [['1'], ['2']])
+
+        live = cb._get_state(key)
+        del cb._states[key]
+        self.assertEqual(cb._get_state(key), live)
+
+    def testRebuiltFromLastWholeSnapshot(self):
+        cb = self.irc.getCallback('Meeting')
+        conf.supybot.plugins.Meeting.snapshotInterval.setValue(1)
+        conf.supybot.plugins.Meeting.fullSnapshotInterval.setValue(3)
+        try:
+            self.assertNotError('prepare first')
+            self.assertNotError('agenda add one')
+            self.assertNotError('prepare second')
+            self.assertNotError('agenda add two')
+            self.assertNotError('agenda add three')
+        finally:
+            conf.supybot.plugins.Meeting.snapshotInterval.setValue(100)
+            conf.supybot.plugins.Meeting.fullSnapshotInterval.setValue(10)
+        key = cb._key(self.irc, self.channel)
+        db = cb.getDb(key)
+        cursor = db.cursor()
+        cursor.execute("""SELECT event_id, full
+                          FROM snapshot
+                          ORDER BY event_id""")
+        self.assertEqual(cursor.fetchall(),
+                         [(0, 1), (1, 0), (2, 0), (3, 1), (4, 0), (5, 0)])
+
+        # nothing before the last whole snapshot is read
+        cursor.execute("""DELETE FROM snapshot
+                          WHERE event_id<3""")
+        live = cb._get_state(key)
+        del cb._states[key]
+        self.assertEqual(cb._get_state(key), live)
+
+    def testOpenVoteRestored(self):
+        cb = self.irc.getCallback('Meeting')
+        self.assertNotError('prepare restart')
+        self.assertNotError('motion add survive a restart')
+        self.assertNotError('vote start')
+        key = cb._key(self.irc, self.channel)
+
+        # forget everything in memory, as a restart would
+        del cb._states[key]
+        cb._voter_decision.clear()
+        cb._warm(key, cb.makeFilename(key))
+        self.irc.feedMsg(ircmsgs.privmsg(self.channel, 'aye',
+                                         prefix='voter!user@host.domain'))
+        self.assertResponse('vote end',
+                            'Voting closed - 1 aye | 0 nay | 0 abstained')
+
+    def testMotionOfEarlierMeetingRestored(self):
+        cb = self.irc.getCallback('Meeting')
+        self.assertNotError('prepare first')
+        self.assertNotError('motion add one')
+        self.assertNotError('motion add two')
+        self.assertNotError('prepare second')
+        key = cb._key(self.irc, self.channel)
+
+        # the current motion is the second of the first meeting
+        del cb._states[key]
+        cb._voter_decision.clear()
+        self.assertEqual(cb._get_state(key)['currents']['motion'], 2)
+        self.assertNotIn(key, cb._voter_decision)
+
+
+    def testStartupWarmsIndexedMeetings(self):
+        cb = self.irc.getCallback('Meeting')
+        self.assertNotError('prepare warm up')
+        key = cb._key(self.irc, self.channel)
+
+        # the index as the next process reads it from its file
+        cb._active = type(cb._active)(cb._active.filename)
+        del cb._states[key]
+        cb._dbs.pop(key).close()
+        cb._startup()
+        self.failUnless(key in cb._states)
+        self.failUnless(key in cb._dbs)
+
+
+class MeetingHistoryTestCase(MeetingChannelTestCase):
+
+    def testHistory(self):
+        self.assertRegexp('history', 'No meetings')
+        self.assertRegexp('motion history', 'No decided motions')
+        conf.supybot.plugins.Meeting.historyPageSize.setValue(1)
+        try:
+            for name in ('first', 'second'):
+                self.assertNotError('prepare %s' % name)
+                self.assertAnnounced('start')
+                self.assertNotError('motion add motion of the %s meeting' % name)
+                self.assertNotError('vote start')
+                self.assertNotError('vote end')
+                self.assertAnnounced('adjourn')
+            self.assertRegexp('history', '#1 .* first \\| more with --after 1')
+            self.assertRegexp('history --after 1', '#2 .* second$')
+            self.assertRegexp('motion history --failed', 'dismissed 0:0 motion of the first meeting')
+            self.assertRegexp('motion history --carried', 'No decided motions')
+            self.assertRegexp('history --until 2000-01-01', 'No meetings')
+            self.assertRegexp('history --since 2000-01-01', '#1 .* first')
+            self.assertRegexp('motion history --since 2000-01-01',
+                              'dismissed 0:0 motion of the first meeting')
+            self.assertError('motion history --carried --failed')
+            self.assertError('history --since tomorrow')
+        finally:
+            conf.supybot.plugins.Meeting.historyPageSize.setValue(20)
+
+
+class MeetingMinutesTestCase(MeetingChannelTestCase):
+
+    def testMinutesGrowWithTheMeeting(self):
+        self.assertError('minutes tail')
+        self.assertNotError('prepare minuted')
+        self.assertRegexp('minutes tail', 'no minutes yet')
+        self.assertNotError('agenda add budget')
+        self.assertAnnounced('start')
+        self.assertNotError('agenda next')
+        self.assertNotError('motion add spend less')
+        self.assertRegexp('minutes tail 2',
+                          'Agenda item 1: budget \\| .* Motion 1 proposed: spend less$')
+        self.assertNotError('vote start')
+        self.assertNotError('vote end')
+        self.assertAnnounced('adjourn')
+        self.assertRegexp('minutes tail 1', 'Meeting adjourned: minuted$')
+        self.assertRegexp('minutes tail 50', 'Meeting started: minuted')
+
+
+class MeetingBatchTestCase(MeetingChannelTestCase):
+
+    def testBatch(self):
+        self.assertNotError('prepare batched')
+        self.assertAnnounced('start')
+        self.assertResponse('batch agenda add budget; agenda add staffing; '
+                            'motion add adopt the budget',
+                            'Agenda item 1 added to the current meeting | '
+                            'Agenda item 2 added to the current meeting | '
+                            'Motion 1 added to the current meeting')
+        self.assertResponse('agenda list', 'Item 1: budget')
+        self.assertTrue(self.nextMsg().args[1].endswith('Item 2: staffing'))
+        self.assertRegexp('batch status; meeting agenda list',
+                          'in progress \\| Item 1: budget \\| Item 2: staffing$')
+
+    def testBatchRollsBack(self):
+        self.assertNotError('prepare batched')
+        self.assertRegexp('batch motion add doomed; agenda delete 7',
+                          'rolled back, step 2 \\(agenda delete 7\\)')
+        self.assertRegexp('motion list', 'does not have any motions')
+        self.assertRegexp('batch motion add fine; vote start; bogus command',
+                          'step 3')
+        self.assertRegexp('motion list', 'does not have any motions')
+        self.assertNotError('motion add fine')
+        self.assertNotError('vote start')
+
+    def testBatchChecksCapabilities(self):
+        self.assertNotError('prepare batched')
+        # capabilities are not checked at all while testing
+        chan = ircdb.channels.getChannel(self.channel)
+        chan.addCapability('-delete')
+        ircdb.channels.setChannel(self.channel, chan)
+        world.testing = False
+        try:
+            self.assertRegexp('batch agenda add undone; agenda delete 1',
+                              'rolled back, step 2 .*#test,delete capability',
+                              frm='member!user@host.domain')
+        finally:
+            world.testing = True
+        self.assertResponse('agenda list',
+                            'The current meeting does not have an agenda yet')
+
+
+class MeetingFsckTestCase(MeetingChannelTestCase):
+
+    def testFsck(self):
+        cb = self.irc.getCallback('Meeting')
+        self.assertNotError('prepare checked')
+        self.assertAnnounced('start')
+        self.assertNotError('motion add first')
+        self.assertNotError('vote start')
+        self.irc.feedMsg(ircmsgs.privmsg(self.channel, 'nay',
+                                         prefix='voter!user@host.domain'))
+        self.assertNotError('vote end')
+        self.assertNotError('motion add second')
+        self.assertResponse('motion amend second, amended',
+                            'Motion 2 has been amended as requested.')
+        self.assertResponse('motion delete 1', 'Motion 1 has been deleted')
+        self.assertRegexp('motion list', 'Motion 1: second, amended')
+        self.assertRegexp('fsck', 'no problems found')
+
+        # number the motions as a crash half way through a delete could
+        db = cb.getDb(cb._key(self.irc, self.channel))
+        db.cursor().execute("""UPDATE motion
+                               SET item_order=item_order+4""")
+        self.assertRegexp('fsck', 'found .* motions out of sequence')
+        self.assertRegexp('fsck --repair', 'repaired')
+        self.assertRegexp('fsck', 'no problems found')
+        self.assertRegexp('motion list', 'Motion 1: second, amended')
+
+        # a decided motion with counts but no votes behind them
+        self.assertNotError('vote start')
+        self.assertNotError('vote end')
+        db.cursor().execute("""UPDATE motion
+                               SET votes_aye=3, weighted_aye=3, carries=1""")
+        self.assertRegexp('fsck', "found .* vote counts don't match")
+        self.assertRegexp('fsck --repair', 'repaired')
+        cursor = db.cursor()
+        cursor.execute("""SELECT votes_aye, weighted_aye, carries
+                          FROM motion""")
+        self.assertEqual(cursor.fetchall(), [(0, 0.0, 0)])
+
+        # the repairs are logged, and the state is rebuilt from the tables
+        cursor.execute("""SELECT count(*)
+                          FROM event
+                          WHERE kind='repair'""")
+        self.assertEqual(cursor.fetchall(), [(2, )])
+        key = cb._key(self.irc, self.channel)
+        motion = cb._get_state(key)['meetings']['1']['motions'][0]
+        self.assertEqual((motion['aye'], motion['carries']), (0, False))
+
+    def testOfflineRepairIsLogged(self):
+        cb = self.irc.getCallback('Meeting')
+        self.assertNotError('prepare checked offline')
+        self.assertAnnounced('start')
+        self.assertNotError('motion add first')
+        self.assertNotError('motion add second')
+        key = cb._key(self.irc, self.channel)
+
+        # leftovers of a deleted meeting and election, and a motion gone
+        # from the middle of the meeting with the other not renumbered
+        cursor = cb.getDb(key).cursor()
+        cursor.execute("""INSERT INTO hand
+                          VALUES (99, 1, 1, 'speaker')""")
+        cursor.execute("""INSERT INTO election
+                          VALUES (NULL, 99, 1, 'a b', 0, 1, 'a', NULL)""")
+        cursor.execute("""INSERT INTO ballot
+                          VALUES (98, 'a', 1)""")
+        cursor.execute("""DELETE FROM motion
+                          WHERE item_order=1""")
+        problems = dict(fsck.check_file(cb.makeFilename(key), repair=True))
+        for name in ('orphan_hand', 'orphan_election', 'orphan_ballot',
+                     'motion_order'):
+            self.assertTrue(name in problems, name)
+        for table in ('hand', 'election', 'ballot'):
+            cursor.execute("""SELECT count(*)
+                              FROM %s""" % table)
+            self.assertEqual(cursor.fetchall(), [(0, )])
+
+        # the state rebuilt at the next start is that of the repaired tables
+        cursor.execute("""SELECT snapshot.full
+                          FROM event
+                          JOIN snapshot
+                          ON snapshot.event_id=event.id
+                          WHERE event.kind='repair'""")
+        self.assertEqual(cursor.fetchall(), [(1, )])
+        state, replayed = events.load_state(cb.getDb(key))
+        self.assertEqual(replayed, 0)
+        self.assertEqual([motion['text'] for motion in state['meetings']['1']['motions']],
+                         ['second'])
+
+
+class MeetingReplayTestCase(MeetingChannelTestCase):
+
+    def testReplayIrssiLog(self):
+        log = ['--- Log opened Mon Jan 07 10:00:00 2013',
+               '10:00 -!- chair [chair@host.domain] has joined %s' % self.channel,
+               '10:00 <@chair> @prepare replayed',
+               '10:01 <@chair> @motion add replay the log',
+               '10:01 <@chair> @vote start',
+               '10:02 < voter> aye',
+               '10:02 < voter> what are we voting on?',
+               '10:03 <@chair> @vote end']
+        self.assertEqual(replay.detect_format(log), 'irssi')
+        messages = replay.parse(log, 'irssi', self.channel)
+        report = replay.Replay(self.irc, self.irc.getCallback('Meeting')).run(messages,
+                                                                              settle=0)
+        self.assertEqual(report['input']['commands'], 4)
+        self.assertEqual(report['input']['votes'], 1)
+        self.assertEqual(report['input']['joins_added'], 1)
+        self.assertEqual(report['input']['unanswered_commands'], 0)
+        self.assertEqual(report['commands']['vote end']['count'], 1)
+        self.assertEqual(report['vote_path']['count'], 1)
+        self.assertTrue(report['outbound']['queued'] >= 4)
+
+    def testReplayLeftoverIsNoReply(self):
+        conf.supybot.reply.whenNotCommand.setValue(False)
+        try:
+            # left over from before, the command itself gets no reply
+            self.irc.queueMsg(ircmsgs.privmsg(self.channel, 'left over'))
+            messages = replay.parse([':chair!chair@host.domain PRIVMSG %s :@nosuchcommand'
+                                     % self.channel], 'raw', self.channel)
+            report = replay.Replay(self.irc, self.irc.getCallback('Meeting'),
+                                   timeout=0.1).run(messages, settle=0)
+        finally:
+            conf.supybot.reply.whenNotCommand.setValue(True)
+        self.assertEqual(report['input']['unanswered_commands'], 1)
+        self.assertEqual(report['outbound']['queued'], 1)
+
+
+class MeetingHandTestCase(MeetingChannelTestCase):
+
+    def setUp(self):
+        MeetingChannelTestCase.setUp(self)
+        self.assertNotError('prepare speakers')
+        self.assertNotError('agenda add first item')
+        self.assertNotError('agenda add second item')
+        self.assertAnnounced('start')
+
+    def testRaiseLowerNext(self):
+        self.assertResponse('hand list', 'Nobody has their hand raised')
+        self.assertResponse('hand raise',
+                            'Hand raised, you are number 1 in the queue')
+        self.assertError('hand raise')
+        self.assertResponse('hand list', 'Speaker queue: %s' % self.nick)
+        self.assertNotError('hand lower')
+        self.assertError('hand lower')
+        self.assertNotError('hand raise')
+        self.assertResponse('hand next',
+                            '%s has the floor (0 more waiting)' % self.nick)
+        self.assertResponse('hand next', 'Nobody has their hand raised')
+
+    def testLowerSomeoneElse(self):
+        self.assertNotError('hand raise')
+        # only ops may lower someone else's hand; capabilities are not
+        # checked at all while testing
+        chan = ircdb.channels.getChannel(self.channel)
+        chan.addCapability('-op')
+        ircdb.channels.setChannel(self.channel, chan)
+        world.testing = False
+        try:
+            self.assertRegexp('hand lower %s' % self.nick,
+                              'Error: .* #test,op capability',
+                              frm='member!user@host.domain')
+        finally:
+            world.testing = True
+        self.assertResponse('hand list', 'Speaker queue: %s' % self.nick)
+        self.assertNotError('hand raise', frm='member!user@host.domain')
+        self.assertNotError('hand lower member')
+        self.assertResponse('hand list', 'Speaker queue: %s' % self.nick)
+
+    def testQueueResetOnAgendaNext(self):
+        self.assertNotError('hand raise')
+        self.assertNotError('agenda next')
+        self.assertResponse('hand list', 'Nobody has their hand raised')
+
+    def testQueueKeptWhenAgendaRenumbered(self):
+        cb = self.irc.getCallback('Meeting')
+        key = cb._key(self.irc, self.channel)
+        self.assertNotError('agenda next')
+        self.assertNotError('agenda next')
+        self.assertNotError('hand raise')
+        cb._flush_hands()
+        self.assertNotError('hand raise', frm='member!user@host.domain')
+        # the second item becomes the first
+        self.assertNotError('agenda delete 1')
+        self.assertResponse('hand list', 'Speaker queue: %s, member' % self.nick)
+        # and the queue is found under its new number after a restart
+        cb._flush_hands()
+        cb._hands.pop(key)
+        self.assertResponse('hand list', 'Speaker queue: %s, member' % self.nick)
+
+
+class MeetingSecretVoteTestCase(MeetingChannelTestCase):
+
+    def setUp(self):
+        MeetingChannelTestCase.setUp(self)
+        self.assertNotError('prepare secret ballot')
+        self.assertAnnounced('start')
+        self.assertNotError('motion add we vote in private')
+        for nick in ('voter1', 'voter2'):
+            self.irc.feedMsg(ircmsgs.join(self.channel,
+                                          prefix='%s!%s@host.domain' % (nick, nick)))
+
+    def testSecretVote(self):
+        self.assertError('vote cast aye', private=True,
+                         frm='voter1!voter1@host.domain')
+        self.assertNotError('vote start secret')
+        # channel votes don't count, nor do ballots from outside the channel
+        self.irc.feedMsg(ircmsgs.privmsg(self.channel, 'nay',
+                                         prefix='voter1!voter1@host.domain'))
+        self.assertError('vote cast aye')
+        self.assertError('vote cast aye', private=True,
+                         frm='stranger!stranger@host.domain')
+        self.assertNotError('vote cast nay', private=True,
+                            frm='voter1!voter1@host.domain')
+        self.assertNotError('vote cast aye', private=True,
+                            frm='voter1!voter1@host.domain')
+        # the ballot stays with the voter across a nick change, and doesn't
+        # go to whoever takes the old nick
+        self.irc.feedMsg(ircmsgs.nick('voter3', prefix='voter2!voter2@host.domain'))
+        self.assertError('vote cast nay', private=True,
+                         frm='voter2!someone@else.domain')
+        self.assertNotError('vote cast aye %s' % self.channel, private=True,
+                            frm='voter3!voter2@host.domain')
+        self.assertRegexp('vote end', '2 aye \| 0 nay')
+
+        # the stored ballots don't name the voters
+        cb = self.irc.getCallback('Meeting')
+        db = cb.getDb(cb._key(self.irc, self.channel))
+        cursor = db.cursor()
+        cursor.execute("""SELECT voter FROM vote""")
+        for (voter, ) in cursor.fetchall():
+            self.assertFalse('voter' in voter)
+
+
+class MeetingStatusTestCase(MeetingChannelTestCase):
+
+    def setUp(self):
+        MeetingChannelTestCase.setUp(self)
+        self.assertNotError('prepare on the web')
+        self.assertAnnounced('start')
+        self.assertNotError('motion add publish the tally')
+
+    def get(self, etag=None):
+        """GET the status endpoint, returns the handler with the response"""
+        cb = self.irc.getCallback('Meeting')
+        headers = {}
+        if etag is not None:
+            headers['If-None-Match'] = etag
+        handler = FakeRequestHandler(headers)
+        callback = getattr(sys.modules[cb.__class__.__module__],
+                           'MeetingHTTPCallback', None)
+        if callback is None:
+            # a supybot without the HTTP server, respond as it would
+            status.respond(handler, cb._status)
+        else:
+            callback(cb._status).doGet(handler, '/meeting/')
+        return handler
+
+    def testStatusDocument(self):
+        self.assertNotError('vote start')
+        self.irc.feedMsg(ircmsgs.privmsg(self.channel, 'aye',
+                                         prefix='voter!user@host.domain'))
+        handler = self.get()
+        self.assertEqual(handler.status, 200)
+        self.assertEqual(handler.response_headers['Content-Type'], 'application/json')
+        body = handler.wfile.getvalue()
+        self.assertEqual(handler.response_headers['Content-Length'], str(len(body)))
+        meeting = json.loads(body.decode('utf-8'))['meetings'][0]
+        self.assertEqual((meeting['channel'], meeting['name']),
+                         (self.channel, 'on the web'))
+        self.assertEqual(meeting['motions'][0]['text'], 'publish the tally')
+        self.assertEqual(meeting['tally'], {'aye': 1, 'nay': 0, 'abstain': 0})
+
+        # a poller with an up to date copy gets a 304 and no body
+        etag = handler.response_headers['ETag']
+        handler = self.get(etag)
+        self.assertEqual(handler.status, 304)
+        self.assertEqual(handler.response_headers['ETag'], etag)
+        self.assertEqual(handler.wfile.getvalue(), b'')
+
+        # until the state changes
+        self.assertNotError('vote end')
+        handler = self.get(etag)
+        self.assertEqual(handler.status, 200)
+        self.assertNotEqual(handler.response_headers['ETag'], etag)
+        meeting = json.loads(handler.wfile.getvalue().decode('utf-8'))['meetings'][0]
+        self.assertEqual((meeting['motions'][0]['aye'], meeting['tally']), (1, None))
+
+    def testTallyHiddenDuringSecretVote(self):
+        self.irc.feedMsg(ircmsgs.join(self.channel,
+                                      prefix='voter1!voter1@host.domain'))
+        self.assertNotError('vote start secret')
+        self.assertNotError('vote cast aye', private=True,
+                            frm='voter1!voter1@host.domain')
+        meeting = json.loads(self.get().wfile.getvalue().decode('utf-8'))['meetings'][0]
+        self.assertEqual(meeting['tally'], None)
+        self.assertRegexp('vote end', '1 aye')
+        meeting = json.loads(self.get().wfile.getvalue().decode('utf-8'))['meetings'][0]
+        self.assertEqual(meeting['motions'][0]['aye'], 1)
+
+
+class MeetingWeightTestCase(MeetingChannelTestCase):
+
+    def testWeightedAndProxyVoting(self):
+        self.assertRegexp('weight list', 'weight 1')
+        self.assertError('weight set chair 2.5')
+        for nick in ('chair', 'holder', 'other'):
+            self.irc.feedMsg(ircmsgs.join(self.channel,
+                                          prefix='%s!%s@host.domain' % (nick, nick)))
+        self.assertNotError('weight set chair 2.5')
+        self.assertNotError('weight proxy holder absent!absent@host.domain')
+        self.assertError('weight proxy holder holder')
+        self.assertRegexp('weight list', 'chair@host.domain 2.5 \\| '
+                          'holder@host.domain for absent@host.domain')
+        self.assertNotError('prepare weighted')
+        self.assertNotError('motion add weigh the votes')
+        self.assertNotError('vote start')
+        # a second prefix of the same member is not counted again, and a
+        # stranger votes with the default weight
+        for prefix, vote in (('chair!chair@host.domain', 'nay'),
+                             ('holder!holder@host.domain', 'aye'),
+                             ('other!other@host.domain', 'aye'),
+                             ('other_!other@host.domain', 'aye'),
+                             ('stranger!someone@else.domain', 'aye')):
+            self.irc.feedMsg(ircmsgs.privmsg(self.channel, vote, prefix=prefix))
+        self.assertResponse('vote end',
+                            'Voting closed - 3 aye | 1 nay | 0 abstained - '
+                            'weighted 4 aye | 2.5 nay | 0 abstained')
+        self.assertNotError('weight unproxy absent!absent@host.domain')
+        self.assertError('weight unproxy absent!absent@host.domain')
+
+
+class MeetingElectionTestCase(MeetingChannelTestCase):
+
+    def testRankedElection(self):
+        self.assertError('election start alice bob')
+        self.assertNotError('prepare officers')
+        self.assertError('election start alice')
+        self.assertError('election start --seats 2 alice bob')
+        self.assertNotError('election start alice bob carol')
+        self.assertError('election start dave erin')
+        self.irc.feedMsg(ircmsgs.privmsg(self.channel, 'rank carol alice',
+                                         prefix='voter1!user@host.domain'))
+        self.irc.feedMsg(ircmsgs.privmsg(self.channel, 'rank 3 2',
+                                         prefix='voter2!user@host.domain'))
+        self.irc.feedMsg(ircmsgs.privmsg(self.channel, 'rank bob',
+                                         prefix='voter3!user@host.domain'))
+        self.irc.feedMsg(ircmsgs.privmsg(self.channel, 'rank alice',
+                                         prefix='voter4!user@host.domain'))
+        self.irc.feedMsg(ircmsgs.privmsg(self.channel, 'rank nobody',
+                                         prefix='voter5!user@host.domain'))
+        self.assertRegexp('election end', '4 ballots .* elected: carol')
+        self.assertError('election end')
 
 # vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
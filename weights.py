@@ -0,0 +1,100 @@
+###
+# Copyright (c) 2013, Arik Baratz
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+###
+
+"""
+Weighted and proxy voting.  A channel may give its members voting weights
+other than one, and let a member's vote be cast by a proxy holder when the
+member doesn't vote themselves.  The table is loaded once per channel, so
+that a weighted tally is a single pass over the ballots.
+
+Members are known by the user@host of their hostmask rather than by nick,
+so that whoever takes a nick over doesn't take its weight with it.
+"""
+
+import collections
+
+def identity(voter):
+    """returns the identity that weights and proxies are keyed by, for the
+    prefix or hostmask a vote was cast from"""
+    return voter.split('!', 1)[-1].lower()
+
+class Weights(object):
+    """a channel's voting weights and proxies, keyed by normalized identity
+    (the lower cased user@host)"""
+    def __init__(self, weights=None, proxies=None):
+        # identity -> weight, for members not weighing one
+        self.weights = dict(weights or {})
+        # member -> proxy holder, and holder -> members
+        self.proxies = dict(proxies or {})
+        self.held = collections.defaultdict(list)
+        for member, holder in sorted(self.proxies.items()):
+            self.held[holder].append(member)
+
+    @classmethod
+    def load(cls, db):
+        cursor = db.cursor()
+        cursor.execute("""SELECT member, weight
+                          FROM member_weight""")
+        weights = dict(cursor.fetchall())
+        cursor.execute("""SELECT member, holder
+                          FROM proxy""")
+        return cls(weights, dict(cursor.fetchall()))
+
+    def weight(self, identity):
+        return self.weights.get(identity, 1.0)
+
+    def tally(self, ballots):
+        """returns ({vote: weighted total}, number of members counted) for
+        the (identity, vote) ballots, one per identity.
+
+        a member's own vote always beats the vote cast for them by proxy,
+        whichever is seen first"""
+        totals = collections.defaultdict(float)
+        # member -> (vote, weight, cast by the member themselves?)
+        counted = {}
+
+        def count(member, vote, own):
+            previous = counted.get(member)
+            if previous is not None:
+                if previous[2] and not own:
+                    return
+                totals[previous[0]] -= previous[1]
+            weight = self.weight(member)
+            counted[member] = (vote, weight, own)
+            totals[vote] += weight
+
+        for identity, vote in ballots:
+            count(identity, vote, True)
+            for member in self.held.get(identity, ()):
+                count(member, vote, False)
+        return dict(totals), len(counted)
+
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79: